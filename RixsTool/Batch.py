@@ -0,0 +1,179 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module processes lists of images by a chain of operations in a
+pool of worker processes. A chain is a list of
+:py:class:`Steps.ProcessingStep` instances or (name, parameters) tuples
+describing them. Steps are picklable, so they can be sent to the worker
+processes. Spectra can be kept in a :py:class:`Cache.ResultCache`. The module
+does not depend on Qt."""
+
+import numpy
+from multiprocessing import Pool, TimeoutError, cpu_count
+
+from RixsTool.Steps import createStep
+from RixsTool.Cache import ResultCache
+from RixsTool.SharedArrays import JobWindow
+
+DEBUG = 0
+
+
+def processChain(image, chain):
+    """
+    :param ndarray image: Two dimensional numpy.ndarray
+    :param list chain: Processing steps or tuples of step name and
+        parameters, c.f. :func:`Steps.createStep`
+    :returns ndarray: Result of the last step
+    :raises KeyError: if a step name is unknown
+    """
+    for step in chain:
+        if isinstance(step, tuple):
+            step = createStep(*step)
+        image = step(image)
+    return image
+
+
+def spectrumScale(numberOfPoints, oversamp=1):
+    """
+    :param int numberOfPoints: Length of the spectrum
+    :param int oversamp: Oversampling used by the alignment
+    :returns ndarray: Pixel scale starting at 1
+    """
+    stop = (numberOfPoints - 1) / float(oversamp) + 1
+    return numpy.linspace(1., stop, num=numberOfPoints)
+
+
+def exportKey(chain, oversamp, source):
+    """
+    :param list chain: Processing steps, c.f. :func:`processChain`
+    :param int oversamp: Oversampling used by the alignment
+    :param source: Image or its digest, c.f. :func:`Cache.ResultCache.key`
+    :returns: Cache key of the spectrum
+    :rtype: str
+    """
+    descriptions = [step if isinstance(step, tuple) else step.description()
+        for step in chain]
+    return ResultCache.key('exportSpectrum',
+        {'chain': descriptions, 'oversamp': oversamp}, source)
+
+
+def exportSpectrum(job):
+    """
+    Worker function turning an image into a spectrum.
+
+    :param tuple job: Index, image, chain ending with a 'sum' step, the
+        oversampling of the alignment, a ResultCache or None and the cache
+        key of the spectrum (c.f. :func:`exportKey`)
+    :returns: Index, spectrum and scale
+    :rtype: tuple
+    """
+    idx, image, chain, oversamp, cache, key = job
+    spectrum = processChain(image, chain)
+    if cache is not None:
+        cache.put(key, spectrum)
+    return idx, spectrum, spectrumScale(len(spectrum), oversamp)
+
+
+class BatchProcessor(object):
+    __doc__ = """Maps a module level function over jobs in a pool of worker
+    processes. Results are returned in the order of the jobs as soon as they
+    are available. A batch can be cancelled from another thread, the pool is
+    then terminated.
+
+    Given a :py:class:`SharedArrays.SharedArrayManager`, large arrays in the
+    jobs and the results are transported through shared memory instead of
+    being pickled (c.f. :py:class:`SharedArrays.JobWindow`).
+
+     .. py:attribute:: POLL_INTERVAL
+
+        Seconds between checks for cancellation while waiting for results"""
+
+    POLL_INTERVAL = .2
+
+    def __init__(self, function, workers=None, shared=None):
+        """
+        :param function: Module level function taking one job
+        :param int workers: Number of processes, default: number of CPUs
+        :param SharedArrayManager shared: Owner of the shared blocks,
+            default: None, i.e. jobs and results are pickled
+        """
+        self.function = function
+        self.workers = workers or cpu_count()
+        self.shared = shared
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def imap(self, jobs, count=None):
+        """
+        :param iterable jobs: Jobs, consumed while the pool is working
+        :param int count: Number of jobs, limits the number of processes
+        :returns: Generator of results
+        """
+        workers = self.workers
+        if count is not None:
+            workers = max(min(workers, count), 1)
+        function = self.function
+        window = None
+        if self.shared is not None:
+            # Two jobs per process keep the workers busy
+            window = JobWindow(self.shared, 2 * workers, self.POLL_INTERVAL)
+            function = window.task(function)
+            jobs = window.jobs(jobs)
+        pool = Pool(workers)
+        finished = False
+        try:
+            iterator = pool.imap(function, jobs)
+            while not self._cancelled:
+                try:
+                    result = iterator.next(self.POLL_INTERVAL)
+                except TimeoutError:
+                    continue
+                except StopIteration:
+                    finished = True
+                    break
+                if window is not None:
+                    result = window.done(result)
+                yield result
+        finally:
+            if window is not None:
+                # Unblocks the pool feeding the jobs
+                window.stop()
+            if finished:
+                pool.close()
+            else:
+                # Cancelled, failed or abandoned by the caller
+                if DEBUG >= 1:
+                    print('BatchProcessor.imap -- terminating pool')
+                pool.terminate()
+            pool.join()
+            if window is not None:
+                window.close()
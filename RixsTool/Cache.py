@@ -0,0 +1,282 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module implements a persistent cache for the results of image
+operations. Results are addressed by a hash of their source, the name of the
+operation and its parameters, i.e. a result is found again after a restart as
+long as the source is unchanged. The source is either an array, hashed by its
+content, or an image file, identified by its path, size and modification
+time (c.f. :func:`ResultCache.sourceDigest`). The module does not depend on
+Qt."""
+
+import hashlib
+import json
+import numpy
+from os import listdir as OsListdir
+from os import makedirs as OsMakedirs
+from os import remove as OsRemove
+from os import rename as OsRename
+from os import stat as OsStat
+from os import utime as OsUtime
+from os import fdopen as OsFdopen
+from os.path import abspath as OsPathAbspath
+from os.path import expanduser as OsPathExpanduser
+from os.path import isdir as OsPathIsdir
+from os.path import isfile as OsPathIsfile
+from os.path import join as OsPathJoin
+from tempfile import mkstemp as TempfileMkstemp
+
+from RixsTool.Utils import plain
+
+DEBUG = 0
+
+
+def arrayDigest(array):
+    """
+    :param ndarray array: Array or array like object
+    :returns: Hash of type, shape and content of the array
+    :rtype: str
+    """
+    array = numpy.ascontiguousarray(array)
+    digest = hashlib.sha1()
+    digest.update(('%s %s' % (array.dtype.str, str(array.shape))).encode())
+    digest.update(array.view(numpy.uint8).ravel())
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    __doc__ = """Cache storing arrays as compressed NumPy archives (.npz) in a
+    directory. When the files exceed the size limit, the least recently used
+    ones are removed. Files are written under a temporary name and renamed,
+    so worker processes can share one cache directory. Results that are not
+    numpy arrays are not cached.
+
+    The size of the cache is tracked by every instance for the files it
+    writes. Files written by copies in other processes are picked up by
+    :func:`refresh`.
+
+     .. py:attribute:: DEFAULT_DIRECTORY
+
+        Default cache directory
+
+     .. py:attribute:: DEFAULT_LIMIT
+
+        Default size limit in bytes
+
+     .. py:attribute:: limit
+
+        Current size limit in bytes"""
+
+    DEFAULT_DIRECTORY = OsPathJoin(OsPathExpanduser('~'), '.rixstool', 'cache')
+    DEFAULT_LIMIT = 1024 ** 3
+    EXTENSION = '.npz'
+
+    def __init__(self, directory=None, limit=None):
+        """
+        :param str directory: Cache directory, created if necessary.
+            Default: DEFAULT_DIRECTORY
+        :param int limit: Size limit in bytes, default: DEFAULT_LIMIT
+        """
+        self.directory = self.DEFAULT_DIRECTORY if directory is None \
+            else directory
+        self.limit = self.DEFAULT_LIMIT if limit is None else int(limit)
+        if not OsPathIsdir(self.directory):
+            OsMakedirs(self.directory)
+        self._usage = 0
+        self.refresh()
+
+    @staticmethod
+    def sourceDigest(item):
+        """
+        :param DataItem item: Item read from a file
+        :returns: Hash of the file location, size and modification time and
+            the key of the item, which distinguishes the frames of a file.
+            None if the item does not stem from an existing file.
+        :rtype: str
+        """
+        fileLocation = getattr(item, 'fileLocation', '')
+        if not fileLocation or not OsPathIsfile(fileLocation):
+            return None
+        stat = OsStat(fileLocation)
+        description = json.dumps([OsPathAbspath(fileLocation), stat.st_size,
+            stat.st_mtime, item.key()])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    @staticmethod
+    def key(op, params, source):
+        """
+        :param str op: Name of the operation
+        :param dict params: Parameters of the operation, must be JSON
+            serializable after numpy types are converted (c.f.
+            :func:`Utils.plain`)
+        :param source: Input of the operation, either an array or a digest
+            (c.f. :func:`sourceDigest`, :func:`arrayDigest`)
+        :returns: Key of the result
+        :rtype: str
+        """
+        if not isinstance(source, str):
+            source = arrayDigest(source)
+        description = json.dumps([op, plain(params), source], sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def fileName(self, key):
+        return OsPathJoin(self.directory, key + self.EXTENSION)
+
+    def __contains__(self, key):
+        return OsPathIsfile(self.fileName(key))
+
+    def get(self, key):
+        """
+        :param str key: Key of the result, c.f. :func:`key`
+        :returns: Cached array, None if there is none. A hit marks the result
+            as most recently used.
+        :rtype: ndarray
+        """
+        fileName = self.fileName(key)
+        try:
+            archive = numpy.load(fileName)
+            try:
+                result = archive['result']
+            finally:
+                archive.close()
+        except (IOError, OSError, KeyError, ValueError):
+            # Missing, evicted or truncated
+            return None
+        try:
+            OsUtime(fileName, None)
+        except OSError:
+            pass
+        if DEBUG >= 1:
+            print("ResultCache.get -- hit '%s'" % key)
+        return result
+
+    def put(self, key, result):
+        """
+        :param str key: Key of the result, c.f. :func:`key`
+        :param ndarray result: Result of an operation, other types are
+            ignored
+        :returns: True if the result was stored
+        :rtype: bool
+        """
+        if not isinstance(result, numpy.ndarray) or result.dtype == object:
+            return False
+        fileName = self.fileName(key)
+        handle, tmpName = TempfileMkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with OsFdopen(handle, 'wb') as fileHandle:
+                numpy.savez_compressed(fileHandle, result=result)
+            if OsPathIsfile(fileName):
+                # Written by another process in the meantime
+                OsRemove(tmpName)
+                return True
+            OsRename(tmpName, fileName)
+        except (IOError, OSError):
+            try:
+                OsRemove(tmpName)
+            except OSError:
+                pass
+            return False
+        self._usage += OsStat(fileName).st_size
+        self.enforce()
+        return True
+
+    def _entries(self):
+        """
+        :returns: Modification time, size and name of the cached files
+        :rtype: list
+        """
+        entries = []
+        for name in OsListdir(self.directory):
+            if not name.endswith(self.EXTENSION):
+                continue
+            fileName = OsPathJoin(self.directory, name)
+            try:
+                stat = OsStat(fileName)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fileName))
+        return entries
+
+    def usage(self):
+        """
+        :returns: Size of the cached files in bytes as of the last
+            :func:`refresh` plus the files written since
+        :rtype: int
+        """
+        return self._usage
+
+    def refresh(self):
+        """
+        :returns: Size of the cached files in bytes
+        :rtype: int
+        """
+        self._usage = sum(size for mtime, size, fileName in self._entries())
+        return self._usage
+
+    def setLimit(self, limit):
+        """
+        :param int limit: Size limit in bytes
+        """
+        self.limit = int(limit)
+        self.enforce()
+
+    def enforce(self):
+        """
+        Removes the least recently used files until the size is below the
+        limit.
+
+        :returns: Number of bytes released
+        :rtype: int
+        """
+        if self._usage <= self.limit:
+            return 0
+        released = 0
+        entries = sorted(self._entries())
+        self._usage = sum(size for mtime, size, fileName in entries)
+        for mtime, size, fileName in entries:
+            if self._usage <= self.limit:
+                break
+            try:
+                OsRemove(fileName)
+            except OSError:
+                continue
+            self._usage -= size
+            released += size
+        if DEBUG >= 1:
+            print('ResultCache.enforce -- released %d bytes' % released)
+        return released
+
+    def clear(self):
+        """
+        Removes all cached files.
+        """
+        for mtime, size, fileName in self._entries():
+            try:
+                OsRemove(fileName)
+            except OSError:
+                pass
+        self._usage = 0
@@ -0,0 +1,511 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module processes data larger than the memory with the recipes
+of :py:mod:`Pipeline`. The data is read in chunks of about
+:py:attr:`CHUNK_BYTES` from array like sources that read on demand, e.g.
+numpy.memmap, h5py datasets or :py:class:`IO.EdfFrameStack`, and the results
+are written incrementally by a writer (c.f. :py:class:`ArrayWriter`,
+:py:class:`NpyWriter`, :py:class:`HDF5Writer`). The memory needed depends on
+the chunk size, not on the size of the data.
+
+Stacks are processed frame by frame, several frames per chunk, by any
+recipe. Images, and frames exceeding the chunk size, are split into tiles of
+rows. Row tiles can only be processed by linear recipes of the operations in
+:py:attr:`ROW_OPS`, none of which needs neighbouring rows. Parameters
+depending on the whole input, e.g. the baseline of the ID32 filter, are
+determined before the tiles are processed (c.f. :func:`bindParameters`). The
+module does not depend on Qt."""
+
+import numpy
+from numpy.lib.format import open_memmap as NumpyOpenMemmap
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from RixsTool.Operations import Filter
+from RixsTool.Pipeline import SOURCE, registry
+
+DEBUG = 0
+
+#
+# CHUNK_BYTES: Default size of the chunks read from a source
+#
+CHUNK_BYTES = 64 * 1024 ** 2
+
+#
+# ROW_OPS: Operations that can process row tiles. The output rows of a tile
+# only depend on its input rows.
+#
+ROW_OPS = ('bandpass', 'bandpassID32', 'zeroToOne', 'blockMean', 'axisSum')
+
+
+class ArrayWriter(object):
+    __doc__ = """Collects the result in memory, for results that fit into
+    memory, e.g. spectra or decimated images. Writers are opened once the
+    shape of the result is known, parts of the result are assigned by
+    :func:`write`."""
+
+    def __init__(self):
+        self.array = None
+
+    def isOpen(self):
+        return self.array is not None
+
+    def open(self, shape, dtype):
+        """
+        :param tuple shape: Shape of the whole result
+        :param dtype: Type of the result
+        """
+        self.array = numpy.zeros(shape, dtype=dtype)
+
+    def write(self, key, block):
+        """
+        :param key: Index of the part, e.g. a slice of rows
+        :param ndarray block: Values of the part
+        """
+        self.array[key] = block
+
+    def close(self):
+        """
+        :returns: The result
+        """
+        return self.array
+
+
+class NpyWriter(ArrayWriter):
+    __doc__ = """Writes the result to a NumPy (.npy) file through a memory
+    map. :func:`close` returns a read only memory map of the file."""
+
+    def __init__(self, fileName):
+        ArrayWriter.__init__(self)
+        self.fileName = fileName
+
+    def open(self, shape, dtype):
+        self.array = NumpyOpenMemmap(self.fileName, mode='w+', dtype=dtype,
+            shape=shape)
+
+    def close(self):
+        if self.array is None:
+            return None
+        self.array.flush()
+        self.array = None
+        return numpy.load(self.fileName, mmap_mode='r')
+
+
+class HDF5Writer(ArrayWriter):
+    __doc__ = """Writes the result to a dataset of a HDF5 file.
+    :func:`close` returns the file name and the path of the dataset."""
+
+    def __init__(self, fileName, path='data', compression=None):
+        """
+        :param str fileName: HDF5 file, created or truncated
+        :param str path: Path of the dataset in the file
+        :param str compression: Compression filter of the dataset
+        :raises ImportError: if h5py is not available
+        """
+        if h5py is None:
+            raise ImportError('HDF5Writer -- h5py is required')
+        ArrayWriter.__init__(self)
+        self.fileName = fileName
+        self.path = path
+        self.compression = compression
+        self._file = None
+
+    def open(self, shape, dtype):
+        self._file = h5py.File(self.fileName, 'w')
+        chunks = None
+        if len(shape) > 1:
+            # One chunk per row or frame
+            chunks = (1,) + tuple(shape[1:])
+        self.array = self._file.create_dataset(self.path, shape=shape,
+            dtype=dtype, chunks=chunks, compression=self.compression)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.array = None
+        return self.fileName, self.path
+
+
+class _FrameWriter(object):
+    __doc__ = """Writes the result of a frame processed in row tiles into the
+    writer of the stack."""
+
+    def __init__(self, writer, frameCount, idx):
+        self.writer = writer
+        self.frameCount = frameCount
+        self.idx = idx
+
+    def isOpen(self):
+        return self.writer.isOpen()
+
+    def open(self, shape, dtype):
+        self.writer.open((self.frameCount,) + tuple(shape), dtype)
+
+    def write(self, key, block):
+        if not isinstance(key, tuple):
+            key = (key,)
+        self.writer.write((self.idx,) + key, block)
+
+    def close(self):
+        return None
+
+
+class FrameView(object):
+    __doc__ = """Array like view of one frame of a stack that reads rows on
+    demand."""
+
+    def __init__(self, stack, idx):
+        self.stack = stack
+        self.idx = idx
+        self.shape = tuple(stack.shape[1:])
+        self.dtype = numpy.dtype(stack.dtype)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.stack[(self.idx,) + key]
+
+
+def rowTiles(source, rows, stop=None):
+    """
+    Reads a two dimensional source in tiles of rows.
+
+    :param source: Array or array like object supporting slicing of rows
+    :param int rows: Number of rows per tile
+    :param int stop: Number of rows to read, default: all
+    :returns: Generator of the first and the last row (exclusive) of a tile
+        and the tile
+    """
+    if stop is None:
+        stop = source.shape[0]
+    for lower in range(0, stop, rows):
+        upper = min(lower + rows, stop)
+        yield lower, upper, numpy.asarray(source[lower:upper])
+
+
+def rowChain(recipe):
+    """
+    :param Recipe recipe: Recipe to process row tiles with
+    :returns: Operation names and parameters of the nodes
+    :rtype: list
+    :raises ValueError: if the recipe is not linear, contains operations
+        not in ROW_OPS or sums over an unspecified axis
+    """
+    recipe.validate()
+    chain = []
+    for idx, node in enumerate(recipe.nodes):
+        if node.op not in ROW_OPS:
+            raise ValueError("rowChain -- Operation '%s' can not process "
+                "tiles of rows" % node.op)
+        previous = recipe.nodes[idx - 1].name if idx else SOURCE
+        if node.references() or recipe.inputName(idx) != previous:
+            raise ValueError("rowChain -- Node '%s' does not process the "
+                "output of the previous node" % node.name)
+        if node.op == 'axisSum':
+            if idx != len(recipe.nodes) - 1:
+                raise ValueError("rowChain -- Node '%s': 'axisSum' must be "
+                    "the last node" % node.name)
+            if node.params.get('axis', -1) not in (0, 1):
+                raise ValueError("rowChain -- Node '%s': 'axisSum' needs an "
+                    "explicit axis 0 or 1" % node.name)
+        chain.append((node.op, dict(node.params)))
+    if recipe.outputNames() != [recipe.nodes[-1].name]:
+        raise ValueError('rowChain -- The last node must be the only output')
+    return chain
+
+
+def _rowMultiple(chain):
+    """
+    :returns: Number of input rows making up one output row of the chain
+    :rtype: int
+    """
+    multiple = 1
+    for op, params in chain:
+        if op == 'blockMean':
+            multiple *= int(params.get('factor', 4))
+    return multiple
+
+
+def _apply(chain, image):
+    """
+    :returns: Result of the chain, c.f. :func:`Pipeline.Recipe.run`
+    """
+    ops = registry()
+    for op, params in chain:
+        image = ops[op][0](image, dict(params))
+        if isinstance(image, dict) and 'image' in image:
+            image = image['image']
+    return image
+
+
+def _tileRows(source, chain, chunkBytes):
+    """
+    :returns: Number of rows per tile, a multiple of the rows needed for one
+        output row of the chain
+    :rtype: int
+    """
+    multiple = _rowMultiple(chain)
+    rowBytes = max(source.shape[1], 1) * max(numpy.dtype(source.dtype).itemsize,
+        numpy.dtype(numpy.float64).itemsize)
+    rows = max(chunkBytes // rowBytes, 1)
+    return max(rows // multiple, 1) * multiple
+
+
+def _tiles(source, chain, chunkBytes):
+    """
+    :returns: Generator of the first row, the last row (exclusive) and the
+        result of the chain for the tiles of the source. Rows not filling a
+        block of a 'blockMean' are dropped.
+    """
+    multiple = _rowMultiple(chain)
+    stop = source.shape[0] - source.shape[0] % multiple
+    rows = _tileRows(source, chain, chunkBytes)
+    for lower, upper, tile in rowTiles(source, rows, stop):
+        yield lower, upper, _apply(chain, tile)
+
+
+def bindParameters(chain, source, chunkBytes=CHUNK_BYTES):
+    """
+    Sets the parameters that depend on the whole input of an operation, so
+    the operation gives the same result on row tiles. These are the minimum
+    and maximum used by 'bandpass' and 'zeroToOne' and the baseline of
+    'bandpassID32'. Parameters already given are kept. Determining the
+    minimum and maximum of the input of a node requires one pass over the
+    source.
+
+    :param list chain: Operation names and parameters, c.f. :func:`rowChain`
+    :param source: Two dimensional array or array like object
+    :param int chunkBytes: Size of the tiles in bytes
+    :returns: Chain with the parameters set
+    :rtype: list
+    """
+    bound = []
+    for op, params in chain:
+        params = dict(params)
+        if op == 'bandpassID32' and 'baseline' not in params:
+            rows = int(params.get('baselineRows', 100)) * _rowMultiple(bound)
+            head = _apply(bound, numpy.asarray(source[:rows]))
+            params['baseline'] = float(Filter.id32Baseline(head, params))
+        needsMin = needsMax = False
+        if op == 'bandpass':
+            needsMin = not ('low' in params and 'replace' in params)
+            needsMax = 'high' not in params
+        elif op == 'zeroToOne':
+            needsMin = needsMax = True
+        needsMin = needsMin and 'min' not in params
+        needsMax = needsMax and 'max' not in params
+        if needsMin or needsMax:
+            lo, hi = None, None
+            for lower, upper, result in _tiles(source, bound, chunkBytes):
+                if not result.size:
+                    continue
+                lo = result.min() if lo is None else min(lo, result.min())
+                hi = result.max() if hi is None else max(hi, result.max())
+            if needsMin and lo is not None:
+                params['min'] = float(lo)
+            if needsMax and hi is not None:
+                params['max'] = float(hi)
+        if DEBUG >= 1:
+            print('bindParameters -- %s: %s' % (op, str(params)))
+        bound.append((op, params))
+    return bound
+
+
+def processRows(source, recipe, writer=None, chunkBytes=CHUNK_BYTES):
+    """
+    Processes a two dimensional source in tiles of rows.
+
+    :param source: Array or array like object supporting slicing of rows
+    :param Recipe recipe: Linear recipe of operations in ROW_OPS
+    :param writer: Receives the result, default: :py:class:`ArrayWriter`
+    :param int chunkBytes: Size of the tiles in bytes
+    :returns: Result of the writer
+    :raises ValueError: if the recipe can not process row tiles
+    """
+    if writer is None:
+        writer = ArrayWriter()
+    chain = bindParameters(rowChain(recipe), source, chunkBytes)
+    multiple = _rowMultiple(chain)
+    outputRows = source.shape[0] // multiple
+    columnSum = chain[-1][0] == 'axisSum' and chain[-1][1]['axis'] == 0
+    total = None
+    for lower, upper, result in _tiles(source, chain, chunkBytes):
+        if columnSum:
+            total = result if total is None else total + result
+            continue
+        if not writer.isOpen():
+            writer.open((outputRows,) + result.shape[1:], result.dtype)
+        start = lower // multiple
+        writer.write(slice(start, start + result.shape[0]), result)
+    if columnSum and total is not None:
+        if not writer.isOpen():
+            writer.open(total.shape, total.dtype)
+        writer.write(slice(None), total)
+    return writer.close()
+
+
+def processStack(stack, recipe, writer=None, chunkBytes=CHUNK_BYTES):
+    """
+    Processes the frames of a three dimensional source. The frames are read
+    in chunks of chunkBytes. Frames exceeding the chunk size are processed in
+    tiles of rows (c.f. :func:`processRows`).
+
+    :param stack: Array or array like object supporting slicing of frames,
+        e.g. :py:class:`IO.EdfFrameStack`
+    :param Recipe recipe: Recipe with a single output
+    :param writer: Receives the results of all frames along the first axis,
+        default: :py:class:`ArrayWriter`
+    :param int chunkBytes: Size of the chunks in bytes
+    :returns: Result of the writer
+    :raises ValueError: if the recipe has more than one output
+    """
+    if writer is None:
+        writer = ArrayWriter()
+    recipe.validate()
+    outputs = recipe.outputNames()
+    if len(outputs) != 1:
+        raise ValueError('processStack -- Recipe must have a single output')
+    frameCount = stack.shape[0]
+    frameBytes = int(numpy.prod(stack.shape[1:])) * \
+        numpy.dtype(stack.dtype).itemsize
+    if frameBytes > chunkBytes:
+        for idx in range(frameCount):
+            processRows(FrameView(stack, idx), recipe,
+                _FrameWriter(writer, frameCount, idx), chunkBytes)
+        return writer.close()
+    frames = max(chunkBytes // max(frameBytes, 1), 1)
+    for lower in range(0, frameCount, frames):
+        chunk = numpy.asarray(stack[lower:min(lower + frames, frameCount)])
+        for offset, frame in enumerate(chunk):
+            result = recipe.run(frame)[outputs[0]]
+            if not writer.isOpen():
+                writer.open((frameCount,) + numpy.shape(result),
+                    numpy.asarray(result).dtype)
+            writer.write(lower + offset, result)
+        del(chunk)
+    return writer.close()
+
+
+def _openSource(source):
+    """
+    :param source: Item or array like object
+    :returns: Array like object and a function releasing it or None. Items
+        restored from a project file whose data has not been read are read
+        from their dataset (c.f. :func:`HDF5Backend.HDF5DatasetLoader.dataset`)
+        instead of being loaded as a whole.
+    :rtype: tuple
+    """
+    if not hasattr(source, 'loader'):
+        return getattr(source, 'array', source), None
+    while not source.isLoaded() and source.original() is not None:
+        # Duplicates read the data of their original
+        source = source.original()
+    loader = source.loader()
+    if hasattr(loader, 'dataset'):
+        dataset = loader.dataset()
+        if dataset is not None:
+            return dataset, dataset.file.close
+    return source.array, None
+
+
+def process(source, recipe, writer=None, chunkBytes=CHUNK_BYTES):
+    """
+    :param source: Image or stack, an item or its array
+    :param Recipe recipe: Recipe to apply
+    :param writer: Receives the result, default: :py:class:`ArrayWriter`
+    :param int chunkBytes: Size of the chunks in bytes
+    :returns: Result of the writer
+    :raises ValueError: if the source is neither two nor three dimensional
+    """
+    source, release = _openSource(source)
+    try:
+        if len(source.shape) == 3:
+            return processStack(source, recipe, writer, chunkBytes)
+        if len(source.shape) == 2:
+            return processRows(source, recipe, writer, chunkBytes)
+        raise ValueError('process -- Source of shape %s is neither an image '
+            'nor a stack' % str(source.shape))
+    finally:
+        if release is not None:
+            release()
+
+
+def unitTest_process():
+    from RixsTool.Pipeline import Recipe
+    image = numpy.random.RandomState(0).random_sample((1003, 257)) * 1000.
+    recipes = [
+        Recipe().add('bandpass', {'low': 100., 'high': 800., 'offset': 5.}),
+        Recipe().add('bandpass', {'offset': 5.}).add('zeroToOne'),
+        Recipe().add('blockMean', {'factor': 4}).add('zeroToOne')
+            .add('axisSum', {'axis': 0}),
+        Recipe().add('blockMean', {'factor': 3}).add('bandpassID32',
+            {'energy': 900., 'baselineRows': 10}).add('axisSum', {'axis': 1})
+    ]
+    rowBytes = image.shape[1] * image.dtype.itemsize
+    success = True
+    for recipe in recipes:
+        expected = list(recipe.run(image).values())[0]
+        # Tiles of 7 rows, tiles of 64 rows and a single tile
+        for chunkBytes in (7 * rowBytes, 64 * rowBytes, CHUNK_BYTES):
+            result = process(image, recipe, chunkBytes=chunkBytes)
+            if result.shape != expected.shape or \
+                    not numpy.allclose(result, expected):
+                print('Chunked.unitTest_process -- Tiled result differs: '
+                    '%s, %d bytes per chunk' % (str(recipe), chunkBytes))
+                success = False
+
+    stack = numpy.random.RandomState(1).random_sample((5, 120, 64))
+    recipe = Recipe().add('bandpass', {'offset': .5}).add('axisSum',
+        {'axis': 1})
+    expected = numpy.array([list(recipe.run(frame).values())[0]
+        for frame in stack])
+    frameBytes = stack[0].nbytes
+    # Two frames per chunk, one frame per chunk and frames split into rows
+    for chunkBytes in (2 * frameBytes, frameBytes, frameBytes // 4):
+        result = process(stack, recipe, chunkBytes=chunkBytes)
+        if not numpy.allclose(result, expected):
+            print('Chunked.unitTest_process -- Stack result differs: %d '
+                'bytes per chunk' % chunkBytes)
+            success = False
+
+    if success:
+        print('Chunked.unitTest_process -- Success!')
+    else:
+        print('Chunked.unitTest_process -- Failure!')
+    return success
+
+if __name__ == '__main__':
+    unitTest_process()
@@ -0,0 +1,279 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module writes spectra, i.e. :py:class:`Items.ScanItem` and
+:py:class:`Items.SpecItem` instances, to files. Every spectrum is written
+directly to the file, so the memory needed does not grow with the number of
+spectra. Supported formats are SPEC text files, NumPy archives (npz) and
+HDF5."""
+
+import numpy
+import sys
+import zipfile
+from multiprocessing.pool import ThreadPool
+from numpy.lib.format import write_array as NumpyWriteArray
+from os import fdopen as OsFdopen
+from os import remove as OsRemove
+from os.path import splitext as OsPathSplitExt
+from tempfile import mkstemp as TempfileMkstemp
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from RixsTool.Items import ScanItem, SpecItem
+
+DEBUG = 0
+NEWLINE = '\n'
+
+#
+# ZIP_STREAMING: Members of zip archives can be written directly (Python 3.6)
+#
+ZIP_STREAMING = sys.version_info >= (3, 6)
+
+
+class SpectraExporter(object):
+    __doc__ = """Writes a list of spectra in one of the formats listed in
+    :py:attr:`FORMATS`. The format is derived from the extension of the file
+    name, unknown extensions are written as SPEC text files.
+
+     .. py:attribute:: BUFFER_SIZE
+
+        Size of the write buffer of text files in bytes
+
+     .. py:attribute:: WORKERS
+
+        Default number of threads writing individual files"""
+
+    SPEC_FORMAT = 'spec'
+    NPZ_FORMAT = 'npz'
+    HDF5_FORMAT = 'hdf5'
+    FORMATS = {
+        '.npz': NPZ_FORMAT,
+        '.h5': HDF5_FORMAT,
+        '.hdf5': HDF5_FORMAT
+    }
+    BUFFER_SIZE = 1024 ** 2
+    WORKERS = 4
+
+    def __init__(self, itemList):
+        """
+        :param list itemList: List of ScanItems and SpecItems
+        :raises NotImplementedError: if the list contains other items
+        """
+        for item in itemList:
+            if not (isinstance(item, ScanItem) or isinstance(item, SpecItem)):
+                raise NotImplementedError("SpectraExporter -- Unknown item " \
+                    "type: %s" % type(item))
+        self.itemList = itemList
+
+    @staticmethod
+    def fileFormat(fileName):
+        """
+        :param str fileName: File name including extension
+        :returns: One of the format identifiers
+        :rtype: str
+        """
+        ext = OsPathSplitExt(fileName)[1].lower()
+        return SpectraExporter.FORMATS.get(ext, SpectraExporter.SPEC_FORMAT)
+
+    @staticmethod
+    def columns(item):
+        """
+        :param DataItem item: ScanItem or SpecItem
+        :returns: Scale and data of the spectrum. SpecItems do not have a
+            scale, in this case the scale counts the points.
+        :rtype: tuple
+        """
+        scale = item.scale() if isinstance(item, ScanItem) else None
+        if scale is None:
+            scale = numpy.arange(
+                start=0,
+                stop=len(item.array),
+                dtype=item.array.dtype)
+        return scale, item.array
+
+    @staticmethod
+    def numberedFileName(fileName, idx, count):
+        """
+        :param str fileName: Base file name
+        :param int idx: Number of the spectrum
+        :param int count: Total number of spectra, determines the zero padding
+        :returns: File name with appended, zero padded number
+        :rtype: str
+        """
+        path, ext = OsPathSplitExt(fileName)
+        return '{path}_{idx:0>{width}}{ext}'.format(
+            path=path,
+            idx=idx,
+            width=len(str(max(count - 1, 0))),
+            ext=ext
+        )
+
+    def write(self, fileName, singleFile=True, workers=None):
+        """
+        :param str fileName: Name of the file. If singleFile is False, the
+            number of the spectrum is appended to the name.
+        :param bool singleFile: Write all spectra into one file. HDF5 files
+            always contain all spectra.
+        :param int workers: Number of threads writing individual files.
+            Default: :py:attr:`WORKERS`
+        :returns: List of written file names
+        :rtype: list
+        """
+        fileFormat = self.fileFormat(fileName)
+        if fileFormat == self.HDF5_FORMAT:
+            self.writeHDF5(fileName)
+            return [fileName]
+        if singleFile:
+            if fileFormat == self.NPZ_FORMAT:
+                self.writeNPZ(fileName)
+            else:
+                self.writeSpec(fileName)
+            return [fileName]
+        return self.writeIndividual(fileName, workers)
+
+    def writeSpec(self, fileName, itemList=None, firstScan=1):
+        """
+        Writes the spectra as scans of a SPEC file.
+
+        :param str fileName: Name of the SPEC file
+        :param list itemList: Spectra to write, default: all spectra
+        :param int firstScan: Scan number of the first spectrum
+        """
+        if itemList is None:
+            itemList = self.itemList
+        with open(fileName, 'w', self.BUFFER_SIZE) as fileHandle:
+            for scanNo, item in enumerate(itemList, firstScan):
+                self._writeScan(fileHandle, scanNo, item)
+
+    def _writeScan(self, fileHandle, scanNo, item):
+        scale, array = self.columns(item)
+        fileHandle.write(NEWLINE)
+        fileHandle.write('#S %d %s' % (scanNo, item.key()) + NEWLINE)
+        fileHandle.write('#N %d' % 2 + NEWLINE)  # Number of columns
+        fileHandle.write('#L PixelNo  Counts' + NEWLINE)  # Column labels
+        numpy.savetxt(
+            fileHandle,
+            numpy.column_stack((scale, array)),
+            fmt='%.6f',
+            delimiter=' ',
+            newline=NEWLINE
+        )
+        if DEBUG >= 1:
+            print("SpectraExporter._writeScan -- wrote scan %d '%s'" %
+                (scanNo, item.key()))
+
+    def writeNPZ(self, fileName, itemList=None):
+        """
+        Writes the spectra into a NumPy archive. For the n-th spectrum the
+        archive contains the arrays 'scale_n' and 'data_n', the array 'keys'
+        holds the item keys. The arrays are written one by one, as
+        :func:`numpy.savez` would write them.
+
+        :param str fileName: Name of the archive
+        :param list itemList: Spectra to write, default: all spectra
+        """
+        if itemList is None:
+            itemList = self.itemList
+        with zipfile.ZipFile(fileName, 'w', zipfile.ZIP_STORED,
+                allowZip64=True) as archive:
+            self._writeMember(archive, 'keys',
+                numpy.array([item.key() for item in itemList]))
+            for idx, item in enumerate(itemList):
+                scale, array = self.columns(item)
+                self._writeMember(archive, 'scale_%d' % idx, scale)
+                self._writeMember(archive, 'data_%d' % idx, array)
+
+    @staticmethod
+    def _writeMember(archive, name, array):
+        """
+        Writes an array as member '<name>.npy' of a zip archive.
+        """
+        array = numpy.asanyarray(array)
+        if ZIP_STREAMING:
+            with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+                NumpyWriteArray(member, array, allow_pickle=False)
+            return
+        # Members are written from files
+        handle, tmpName = TempfileMkstemp(suffix='.npy')
+        try:
+            with OsFdopen(handle, 'wb') as fileHandle:
+                NumpyWriteArray(fileHandle, array, allow_pickle=False)
+            archive.write(tmpName, name + '.npy')
+        finally:
+            OsRemove(tmpName)
+
+    def writeHDF5(self, fileName, compression='lzf'):
+        """
+        Writes every spectrum into a group of a HDF5 file using
+        :func:`Items.ProjectItem.hdf5Dump`.
+
+        :param str fileName: Name of the HDF5 file
+        :param str compression: Compression filter for the datasets
+        :raises ImportError: if h5py is not available
+        """
+        if h5py is None:
+            raise ImportError('SpectraExporter.writeHDF5 -- h5py is required')
+        count = len(self.itemList)
+        with h5py.File(fileName, 'w') as h5:
+            for idx, item in enumerate(self.itemList):
+                name = 'spectrum_{idx:0>{width}}'.format(
+                    idx=idx, width=len(str(max(count - 1, 0))))
+                item.hdf5Dump(h5.create_group(name), compression)
+
+    def writeIndividual(self, fileName, workers=None):
+        """
+        Writes every spectrum into its own file. The files are written in
+        parallel by a pool of threads.
+
+        :param str fileName: Base name, the number of the spectrum is
+            appended
+        :param int workers: Number of threads. Default: :py:attr:`WORKERS`
+        :returns: List of written file names
+        :rtype: list
+        """
+        count = len(self.itemList)
+        fileFormat = self.fileFormat(fileName)
+        jobs = [(self.numberedFileName(fileName, idx, count), item)
+            for idx, item in enumerate(self.itemList)]
+
+        def writeOne(job):
+            numberedName, item = job
+            if fileFormat == self.NPZ_FORMAT:
+                self.writeNPZ(numberedName, [item])
+            else:
+                self.writeSpec(numberedName, [item])
+            return numberedName
+
+        pool = ThreadPool(workers or self.WORKERS)
+        try:
+            return pool.map(writeOne, jobs)
+        finally:
+            pool.close()
+            pool.join()
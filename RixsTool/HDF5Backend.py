@@ -0,0 +1,246 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module stores a :py:class:`Project.RixsProject` in a HDF5 file
+and restores it. The group hierarchy of the file mirrors the tree of
+:py:class:`ItemContainer.ItemContainer` instances. Every container becomes a
+group carrying the attributes 'label' and 'row', containers holding an item
+are filled by :func:`Items.ProjectItem.hdf5Dump`.
+
+Restoring a project only reads the group attributes. The datasets are read
+when the array of an item is accessed for the first time."""
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from RixsTool.Items import ScanItem, SpecItem, ImageItem, StackItem, \
+    FunctionItem
+
+DEBUG = 0
+
+#
+# Item classes that can be restored, c.f. ProjectItem.hdf5Dump
+#
+ITEM_CLASSES = dict((cls.__name__, cls) for cls in
+    [ScanItem, SpecItem, ImageItem, StackItem, FunctionItem])
+
+#
+# Only the parameters of a FunctionItem are stored. The expression is
+# restored from its argument names, all functions used in RixsTool are
+# polynomials with coefficients in descending order.
+#
+EXPRESSIONS = {
+    ('x', 'a', 'b'): lambda x, a, b: a * x + b,
+    ('x', 'a', 'b', 'c'): lambda x, a, b, c: a * x ** 2 + b * x + c
+}
+
+
+def _checkH5py():
+    if h5py is None:
+        raise ImportError('HDF5Backend -- h5py is required to read or ' \
+            'write HDF5 projects')
+
+
+def _str(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+class HDF5DatasetLoader(object):
+    __doc__ = """Deferred loader for items restored from a HDF5 file (c.f.
+    :func:`Items.DataItem.setLoader`). The file is opened for every access,
+    so no file handle is kept open between reads."""
+
+    def __init__(self, fileName, path):
+        self.fileName = fileName
+        self.path = path
+
+    def __call__(self, item):
+        with h5py.File(self.fileName, 'r') as h5:
+            group = h5[self.path]
+            if isinstance(item, ScanItem) and 'scale' in group and \
+                    isinstance(group['scale'], h5py.Dataset):
+                item.setScale(group['scale'][()])
+            if 'data' not in group:
+                return None
+            return group['data'][()]
+
+    def dataset(self):
+        """
+        Opens the dataset of the item without reading it, e.g. to process it
+        chunk by chunk (c.f. :py:mod:`Chunked`). The caller closes the file
+        using dataset.file.close().
+
+        :returns: Dataset holding the array of the item, None if there is
+            none
+        :rtype: h5py.Dataset
+        """
+        h5 = h5py.File(self.fileName, 'r')
+        group = h5[self.path]
+        if 'data' not in group:
+            h5.close()
+            return None
+        return group['data']
+
+
+def saveProject(project, fileName, compression='lzf'):
+    """
+    :param RixsProject project: Project to be stored
+    :param str fileName: Name of the HDF5 file, an existing file is replaced
+    :param str compression: Compression filter for the datasets, e.g. 'lzf'
+        (fast) or 'gzip' (small). Use None to store uncompressed data.
+    """
+    _checkH5py()
+    with h5py.File(fileName, 'w') as h5:
+        h5.attrs['creator'] = 'RixsTool'
+        _dumpContainer(project.projectRoot, h5, compression)
+
+
+def _dumpContainer(container, group, compression):
+    names = set()
+    for row, child in enumerate(container.children):
+        name = str(child.label).replace('/', '_') or 'unnamed'
+        while name in names:
+            name += '_'
+        names.add(name)
+        childGroup = group.create_group(name)
+        childGroup.attrs['label'] = str(child.label)
+        childGroup.attrs['row'] = row
+        if child.hasItem():
+            child.item().hdf5Dump(childGroup, compression)
+        else:
+            _dumpContainer(child, childGroup, compression)
+        if DEBUG >= 1:
+            print("HDF5Backend._dumpContainer -- wrote '%s'" % childGroup.name)
+
+
+def loadProject(project, fileName):
+    """
+    Adds the groups and items stored in a HDF5 file to the project. Top level
+    groups already present in the project (e.g. 'Spectra') are reused. The
+    items of a group are inserted at once (c.f.
+    :func:`Project.RixsProject.addItems`).
+
+    :param RixsProject project: Project that receives the stored tree
+    :param str fileName: Name of the HDF5 file
+    :raises ValueError: if an item key is already present in the project or
+        stored twice. Nothing is added in that case.
+    """
+    _checkH5py()
+    with h5py.File(fileName, 'r') as h5:
+        _checkKeys(project, h5)
+        _loadGroup(project, h5, project.projectRoot, fileName)
+
+
+def _sortedChildren(group):
+    children = [child for child in group.values()
+        if isinstance(child, h5py.Group)]
+    return sorted(children, key=lambda child: child.attrs.get('row', 0))
+
+
+def _checkKeys(project, group, keys=None):
+    """
+    :raises ValueError: if an item key stored in the group or its subgroups
+        is present in the project or stored twice
+    """
+    if keys is None:
+        keys = set()
+    for child in _sortedChildren(group):
+        if 'class' not in child.attrs:
+            _checkKeys(project, child, keys)
+            continue
+        key = _str(child.attrs['key'])
+        if key in project or key in keys:
+            raise ValueError("HDF5Backend.loadProject -- Item key '%s' " \
+                "already present" % key)
+        keys.add(key)
+
+
+def _loadGroup(project, group, node, fileName):
+    itemList = []
+    for child in _sortedChildren(group):
+        if 'class' in child.attrs:
+            itemList.append(_restoreItem(child, fileName))
+            continue
+        if itemList:
+            # Keeps the order of items and groups
+            project.addItems(itemList, node)
+            itemList = []
+        label = _str(child.attrs.get('label', child.name.split('/')[-1]))
+        if label not in project:
+            # ProjectModel.addGroup returns a bool, look the container up
+            project.addGroup(label, node)
+        _loadGroup(project, child, project[label], fileName)
+    if itemList:
+        project.addItems(itemList, node)
+
+
+def _restoreHeader(group):
+    if 'header' in group and isinstance(group['header'], h5py.Group):
+        return dict((str(key), _str(value)) for key, value in
+            group['header'].attrs.items())
+    return _str(group.attrs.get('header', ''))
+
+
+def _restoreFunction(group):
+    function = FunctionItem(_str(group.attrs['key']), _restoreHeader(group))
+    arguments = tuple(_str(arg) for arg in group.attrs.get('arguments', []))
+    if arguments in EXPRESSIONS:
+        function.setExpression(EXPRESSIONS[arguments])
+    elif DEBUG >= 1:
+        print("HDF5Backend._restoreFunction -- unknown expression with " \
+            "arguments %s" % str(arguments))
+    function.setParameters(dict((str(key), value) for key, value in
+        group['parameters'].attrs.items()))
+    return function
+
+
+def _restoreItem(group, fileName):
+    cls = ITEM_CLASSES[_str(group.attrs['class'])]
+    if cls is FunctionItem:
+        return _restoreFunction(group)
+    item = cls(
+        key=_str(group.attrs['key']),
+        header=_restoreHeader(group),
+        array=None,
+        fileLocation=_str(group.attrs.get('fileLocation', ''))
+    )
+    if 'data' in group:
+        dataset = group['data']
+        item.setLoader(HDF5DatasetLoader(fileName, group.name),
+            shape=dataset.shape, dtype=dataset.dtype)
+    if isinstance(item, ScanItem) and 'scale' in group and \
+            isinstance(group['scale'], h5py.Group):
+        item.setScale(_restoreFunction(group['scale']))
+    if isinstance(item, ImageItem):
+        for name in ['scaleX', 'scaleY']:
+            if name in group.attrs:
+                setattr(item, name, group.attrs[name])
+    return item
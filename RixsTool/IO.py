@@ -31,46 +31,146 @@ __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
 #
 from PyMca5.PyMcaIO.EdfFile import EdfFile
 
-#
-# Imports for spec file I/O
-#
-#from PyMca.PyMcaIO.specfilewrapper import specfilewrapper as SpecFile
-#from PyMca.PyMcaIO.specfilewrapper import myscandata
-
 #
 # Imports for file access
 #
 from os.path import split as OsPathSplit
-from os import linesep as NEWLINE
+from os import fstat as OsFStat
+from os import stat as OsStat
 from os import access as OsAccess
 from os import R_OK as OS_R_OK
+from tempfile import TemporaryFile
 
 #
 # Utilities
 #
 import numpy as np
+from functools import partial
+import hashlib
+import re
 import time
+import warnings
 
 #
 # ProjectItem to wrap data in
 #
-from RixsTool.Items import ImageItem, SpecItem, ScanItem
+from RixsTool.Items import ImageItem, SpecItem, ScanItem, StackItem
 
 DEBUG = 0
 
+#
+# Plain text parsing: Files are read in binary mode and line endings are
+# unified before tokenizing. Lines starting with one of the characters
+# '#', '!', '%' or ';' are comments. Every non blank line of a data block is
+# a row.
+#
+NEWLINE = b'\n'
+COMMENT_CHARS = (b'#', b'!', b'%', b';')
+COMMENT_PATTERN = re.compile(br'^[ \t]*[#!%;].*$', re.MULTILINE)
+
+#
+# EDF files: Headers are written in blocks of 512 bytes. The data types and
+# byte orders follow the conventions of PyMca5.PyMcaIO.EdfFile
+#
+EDF_HEADER_BLOCK = 512
+EDF_DATATYPES = {
+    'SignedByte': np.int8,
+    'UnsignedByte': np.uint8,
+    'UnsignedChar': np.uint8,
+    'SignedShort': np.int16,
+    'UnsignedShort': np.uint16,
+    'SignedInteger': np.int32,
+    'UnsignedInteger': np.uint32,
+    'SignedLong': np.int32,
+    'UnsignedLong': np.uint32,
+    'Signed64': np.int64,
+    'Unsigned64': np.uint64,
+    'Float': np.float32,
+    'FloatValue': np.float32,
+    'FLOATVALUE': np.float32,
+    'Double': np.float64,
+    'DoubleValue': np.float64
+}
+EDF_BYTEORDER = {
+    'LowByteFirst': '<',
+    'HighByteFirst': '>'
+}
+
+#
+# SPEC files: Scans start with a '#S' line, header lines start with '#', MCA
+# data with '@'
+#
+SPEC_SCAN_TAG = b'\n#S '
+SPEC_HEADER_PATTERN = re.compile(br'^#.*$', re.MULTILINE)
+SPEC_MCA_PATTERN = re.compile(br'^@.*$', re.MULTILINE)
+
+
+#
+# Content fingerprints: The fingerprint hashes the file size, the first
+# FINGERPRINT_HEADER bytes and FINGERPRINT_SAMPLES blocks spread over the
+# file. Files with equal fingerprints are compared by a hash of their whole
+# content.
+#
+FINGERPRINT_HEADER = 1 << 16
+FINGERPRINT_SAMPLES = 4
+FINGERPRINT_BLOCK = 1 << 12
+DIGEST_BLOCK = 1 << 22
+
+
+def fileFingerprint(fileName):
+    """
+    Fast fingerprint of a file that reads at most
+    FINGERPRINT_HEADER + FINGERPRINT_SAMPLES * FINGERPRINT_BLOCK bytes.
+    Identical files have identical fingerprints, different files most
+    likely do not (c.f. :func:`fileDigest`).
+
+    :param str fileName: File name including path
+    :returns: Hexadecimal fingerprint
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(fileName, 'rb') as fileHandle:
+        size = OsFStat(fileHandle.fileno()).st_size
+        md5.update(str(size).encode('ascii'))
+        md5.update(fileHandle.read(FINGERPRINT_HEADER))
+        if size > FINGERPRINT_HEADER:
+            step = (size - FINGERPRINT_HEADER) // FINGERPRINT_SAMPLES
+            for idx in range(FINGERPRINT_SAMPLES):
+                fileHandle.seek(FINGERPRINT_HEADER + idx * step)
+                md5.update(fileHandle.read(FINGERPRINT_BLOCK))
+    return md5.hexdigest()
+
+
+def fileDigest(fileName):
+    """
+    :param str fileName: File name including path
+    :returns: Hexadecimal SHA-1 hash of the whole file content
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as fileHandle:
+        block = fileHandle.read(DIGEST_BLOCK)
+        while block:
+            sha1.update(block)
+            block = fileHandle.read(DIGEST_BLOCK)
+    return sha1.hexdigest()
+
+
+def _openBinary(fileName):
+    return open(fileName, 'rb')
+
 
 class IODict(object):
     EDF_TYPE = 'edf'    # -> Wrapper for edf files
     DAT_TYPE = 'dat'    # -> Wrapper for plaintext data
-
-    # TODO: Use these type too
-    SPEC_TYPE = 'stack'  # -> Wrapper for spec files
+    SPEC_TYPE = 'spec'  # -> Wrapper for spec files
 
     @staticmethod
     def inputReaderDict():
         ddict = {
             IODict.EDF_TYPE: EdfReader(),
-            IODict.DAT_TYPE: RawReader()
+            IODict.DAT_TYPE: RawReader(),
+            IODict.SPEC_TYPE: SpecReader()
         }
         return ddict
 
@@ -129,36 +229,240 @@ class InputReader(object):
                 "InputReader.itemize -- Invalid file '%s'" % fileName)
 
 
+class EdfFrameIndex(object):
+    __doc__ = """Index of the frames contained in an EDF file. The file is
+    scanned once, reading nothing but the headers: starting from the beginning
+    of the file, every header is parsed and the position of the next one is
+    derived from the data size given in the header. No frame data is read.
+
+     .. py:attribute:: headers
+
+        List of header dictionaries, one per frame
+
+     .. py:attribute:: offsets
+
+        List of byte offsets of the frame data in the file
+
+     .. py:attribute:: shapes
+
+        List of frame shapes
+
+     .. py:attribute:: dtypes
+
+        List of numpy data types including byte order"""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.headers = []
+        self.offsets = []
+        self.shapes = []
+        self.dtypes = []
+        self._scan()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def _parseHeader(text):
+        """
+        :param str text: Header block between the curly braces
+        :returns: Header key value pairs
+        :rtype: dict
+        """
+        header = {}
+        for line in text.split('\n'):
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            header[key.strip()] = value.strip().rstrip(';').strip()
+        return header
+
+    def _scan(self):
+        with open(self.fileName, 'rb') as fileHandle:
+            fileSize = OsFStat(fileHandle.fileno()).st_size
+            pos = 0
+            while pos < fileSize:
+                fileHandle.seek(pos)
+                block = fileHandle.read(EDF_HEADER_BLOCK)
+                start = block.find(b'{')
+                if start < 0:
+                    break
+                stop = block.find(b'}', start)
+                while stop < 0:
+                    # Header exceeds the block size
+                    more = fileHandle.read(EDF_HEADER_BLOCK)
+                    if not len(more):
+                        raise IOError("EdfFrameIndex -- Unterminated header " \
+                            "in '%s'" % self.fileName)
+                    block += more
+                    stop = block.find(b'}', start)
+                header = self._parseHeader(
+                    block[start + 1:stop].decode('latin-1'))
+
+                # Data starts after the line break that follows the brace
+                dataStart = stop + 1
+                if block[dataStart:dataStart + 1] == b'\r':
+                    dataStart += 1
+                if block[dataStart:dataStart + 1] == b'\n':
+                    dataStart += 1
+
+                dims = [int(header[key]) for key in ['Dim_3', 'Dim_2', 'Dim_1']
+                    if key in header]
+                dtype = np.dtype(EDF_DATATYPES.get(header.get('DataType'),
+                    np.uint16))
+                dtype = dtype.newbyteorder(
+                    EDF_BYTEORDER.get(header.get('ByteOrder'), '='))
+                size = int(header.get('Size',
+                    dtype.itemsize * int(np.prod(dims))))
+
+                self.headers += [header]
+                self.offsets += [pos + dataStart]
+                self.shapes += [tuple(dims)]
+                self.dtypes += [dtype]
+                pos += dataStart + size
+        if DEBUG >= 1:
+            print("EdfFrameIndex._scan -- Found %d frame(s) in '%s'" %
+                (len(self), self.fileName))
+
+    def isUniform(self):
+        """
+        :returns: True if all frames share shape and data type
+        :rtype: bool
+        """
+        return len(set(self.shapes)) <= 1 and len(set(self.dtypes)) <= 1
+
+    def isCompressed(self):
+        """
+        :returns: True if any frame is stored compressed
+        :rtype: bool
+        """
+        for header in self.headers:
+            if 'Compression' in header or \
+                    header.get('DataType') not in EDF_DATATYPES:
+                return True
+        return False
+
+    def frame(self, idx):
+        """
+        :param int idx: Frame number
+        :returns: Read only memory map of the frame data
+        :rtype: numpy.memmap
+        """
+        return np.memmap(self.fileName, dtype=self.dtypes[idx], mode='r',
+            offset=self.offsets[idx], shape=self.shapes[idx])
+
+
+class EdfFrameStack(object):
+    __doc__ = """Array like view of the frames in an
+    :py:class:`EdfFrameIndex`. All frames must share shape and data type.
+    Indexing the first axis memory maps only the requested frames, the whole
+    stack is only read when the instance is converted using
+    :func:`numpy.asarray`."""
+
+    def __init__(self, index):
+        if not index.isUniform():
+            raise ValueError("EdfFrameStack -- Frames in '%s' differ in " \
+                "shape or data type" % index.fileName)
+        self._index = index
+        self.shape = (len(index),) + index.shapes[0]
+        self.dtype = index.dtypes[0].newbyteorder('=')
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '%s %s, %s' % \
+            (self.__class__.__name__, str(self.shape), str(self.dtype))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, slice):
+            frames = [self.frame(idx) for idx in
+                range(*first.indices(len(self)))]
+            result = np.asarray(frames, dtype=self.dtype)
+            return result[(slice(None),) + rest] if rest else result
+        frame = self.frame(int(first))
+        return frame[rest] if rest else frame
+
+    def __array__(self, dtype=None, copy=None):
+        if copy is False:
+            # NumPy 2 protocol: the frames are only available as copy
+            raise ValueError("EdfFrameStack.__array__ -- Frames of '%s' can " \
+                "not be converted without copying" % self._index.fileName)
+        result = np.empty(self.shape, dtype=dtype or self.dtype)
+        for idx in range(len(self)):
+            result[idx] = self._index.frame(idx)
+        return result
+
+    def frame(self, idx):
+        """
+        :param int idx: Frame number, negative values count from the end
+        :returns: Read only memory map of the frame
+        :rtype: numpy.memmap
+        """
+        if idx < 0:
+            idx += len(self)
+        if not (0 <= idx < len(self)):
+            raise IndexError('EdfFrameStack.frame -- Index out of range')
+        return self._index.frame(idx)
+
+    def header(self, idx):
+        """
+        :param int idx: Frame number
+        :returns: Header of the frame
+        :rtype: dict
+        """
+        return self._index.headers[idx]
+
+
 class EdfReader(InputReader):
+    __doc__ = """Reader for EDF files. The file is indexed by a
+    :py:class:`EdfFrameIndex` first. Files containing a single image are read
+    using :py:class:`PyMca5.PyMcaIO.EdfFile.EdfFile`, files with multiple
+    frames of equal shape become a :py:class:`Items.StackItem` whose frames
+    are only read on access."""
+
     def __init__(self):
         super(EdfReader, self).__init__()
-        self._srcType = EdfFile
+        self._srcType = EdfFrameIndex
 
     def itemize(self, fileName):
         timeStart = time.time()
         InputReader.itemize(self, fileName)
 
-        numImages = self.reader.GetNumImages()
+        index = self.reader
+        numImages = len(index)
         llist = []
-        if numImages > 1:
-            raise NotImplementedError("EdfReader.itemize -- No support for " \
-                "edfs containing multiple images")
-            #for idx in range(numImages):
-            #    arr = reader.GetData(idx)
-            #    newItem = ImageItem(
-            #        key=key,
-            #        header=reader.GetHeader(0),
-            #        array=np.ascontiguousarray(arr, arr.dtype),
-            #        fileLocation=reader.FileName
-            #    )
-        else:
-            arr = self.reader.GetData(0)
-            newItem = ImageItem(
+        if numImages > 1 and index.isUniform() and not index.isCompressed():
+            newItem = StackItem(
                 key=self.key,
-                header=self.reader.GetHeader(0),
-                array=np.ascontiguousarray(arr, arr.dtype),
-                fileLocation=self.reader.FileName)
+                header=index.headers[0],
+                array=EdfFrameStack(index),
+                fileLocation=fileName)
             llist += [newItem]
+        elif numImages > 0:
+            #
+            # Single images, compressed or inhomogeneous frames are read
+            # completely
+            #
+            edf = EdfFile(fileName)
+            for idx in range(edf.GetNumImages()):
+                if numImages > 1:
+                    key = '%s [%d]' % (self.key, idx)
+                else:
+                    key = self.key
+                arr = edf.GetData(idx)
+                newItem = ImageItem(
+                    key=key,
+                    header=edf.GetHeader(idx),
+                    array=np.ascontiguousarray(arr, arr.dtype),
+                    fileLocation=edf.FileName)
+                llist += [newItem]
 
         timeEnd = time.time()
         if DEBUG >= 1:
@@ -168,12 +472,176 @@ class EdfReader(InputReader):
 
 
 class RawReader(InputReader):
+    __doc__ = """Reader for plain text column data. The whole buffer is
+    tokenized by a single call to :func:`numpy.fromstring`. Lines starting with
+    one of the characters '#', '!', '%' or ';' are treated as comments and non
+    numeric lines at the top of the file as header. Files larger than
+    :py:attr:`STREAM_THRESHOLD` are parsed block by block into a scratch file
+    that is memory mapped afterwards, so the memory used while parsing is
+    bounded by :py:attr:`BLOCK_SIZE`.
+
+    .. py:attribute:: STREAM_THRESHOLD
+
+        File size in bytes above which the file is parsed block wise
+
+    .. py:attribute:: BLOCK_SIZE
+
+        Number of bytes read per block while streaming"""
+
+    STREAM_THRESHOLD = 256 * 1024 ** 2
+    BLOCK_SIZE = 16 * 1024 ** 2
+
     def __init__(self):
         super(RawReader, self).__init__()
-        self._srcType = open
+        self._srcType = _openBinary
+
+    @staticmethod
+    def _unifyLineEndings(buf):
+        """
+        :param bytes buf: Raw file content
+        :returns: Content with '\\r\\n' and '\\r' line endings replaced by
+            '\\n'
+        :rtype: bytes
+        """
+        if b'\r' in buf:
+            buf = buf.replace(b'\r\n', NEWLINE).replace(b'\r', NEWLINE)
+        return buf
+
+    @staticmethod
+    def _stripComments(buf):
+        """
+        :param bytes buf: Data block with unified line endings
+        :returns: Data block without comment lines
+        :rtype: bytes
+        """
+        # Searching for the characters is much cheaper than the regular
+        # expression, most data blocks do not contain comments at all
+        for char in COMMENT_CHARS:
+            if char in buf:
+                return COMMENT_PATTERN.sub(b'', buf)
+        return buf
+
+    @staticmethod
+    def _splitHeader(buf):
+        """
+        Separates non numeric lines at the beginning of the buffer from the
+        data block.
+
+        :param bytes buf: Normalized file content
+        :returns: List of header lines, the data block and its number of
+            columns. The number of columns is zero if no data was found.
+        :rtype: tuple
+        """
+        header = []
+        pos = 0
+        while pos < len(buf):
+            end = buf.find(NEWLINE, pos)
+            if end < 0:
+                end = len(buf)
+            line = buf[pos:end].strip()
+            if len(line):
+                try:
+                    nCols = len([float(token) for token in line.split()])
+                    return header, buf[pos:], nCols
+                except ValueError:
+                    header += [line.decode('latin-1')]
+            pos = end + 1
+        return header, b'', 0
+
+    @staticmethod
+    def _tokenize(buf, nCols):
+        """
+        :param bytes buf: Normalized data block
+        :param int nCols: Number of columns in the data block
+        :returns: Data block as array of shape (nRows, nCols)
+        :rtype: ndarray
+        :raises ValueError: if the block contains non-numeric values or a
+            row does not have nCols values
+        """
+        with warnings.catch_warnings():
+            # Older numpy versions only warn about unparsable content
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(buf, dtype=float, sep=' ')
+            except (ValueError, DeprecationWarning):
+                raise ValueError('RawReader -- Non-numeric data in data block')
+        # Count the values of every row: a value starts with a non blank
+        # character following a blank one. Blanks are the space and the
+        # control characters, the latter are not valid in numbers anyway.
+        chars = np.frombuffer(buf, dtype=np.uint8)
+        blank = chars <= ord(b' ')
+        starts = ~blank
+        starts[1:] &= blank[:-1]
+        lineEnds = np.flatnonzero(chars == ord(NEWLINE))
+        counts = np.bincount(np.searchsorted(lineEnds, np.flatnonzero(starts)))
+        counts = counts[counts > 0]
+        ragged = np.flatnonzero(counts != nCols)
+        if len(ragged):
+            raise ValueError("RawReader -- Row %d of the data block has %d " \
+                "values, expected %d columns" %
+                (ragged[0] + 1, counts[ragged[0]], nCols))
+        if values.size != counts.sum():
+            raise ValueError('RawReader -- Non-numeric data in data block')
+        return values.reshape((len(counts), nCols))
+
+    def _parse(self, fileHandle):
+        """
+        Reads and tokenizes the whole file at once.
+
+        :returns: Header lines and data of shape (nRows, nCols)
+        :rtype: tuple
+        """
+        raw = self._unifyLineEndings(fileHandle.read())
+        header, body, nCols = self._splitHeader(raw)
+        if not nCols:
+            return header, np.zeros((0, 0))
+        return header, self._tokenize(self._stripComments(body), nCols)
+
+    def _streamParse(self, fileHandle):
+        """
+        Tokenizes the file block by block. Every block is cut at its last line
+        break, the remainder is carried over to the next block. Parsed values
+        are appended to an anonymous scratch file which is memory mapped once
+        the whole file has been read.
+
+        :returns: Header lines and memory mapped data of shape (nRows, nCols)
+        :rtype: tuple
+        """
+        scratch = TemporaryFile()
+        header, nCols, nRows = [], 0, 0
+        remainder = b''
+        while True:
+            block = fileHandle.read(self.BLOCK_SIZE)
+            eof = not len(block)
+            block = self._unifyLineEndings(remainder + block)
+            if eof:
+                remainder = b''
+            else:
+                cut = block.rfind(NEWLINE) + 1
+                block, remainder = block[:cut], block[cut:]
+            if not nCols:
+                # Header lines may span several blocks
+                lines, block, nCols = self._splitHeader(block)
+                header += lines
+            block = self._stripComments(block)
+            if nCols and len(block.strip()):
+                data = self._tokenize(block, nCols)
+                data.tofile(scratch)
+                nRows += data.shape[0]
+            if eof:
+                break
+        if not nRows:
+            scratch.close()
+            return header, np.zeros((0, 0))
+        scratch.flush()
+        data = np.memmap(scratch, dtype=float, mode='r+',
+            shape=(nRows, nCols))
+        # Mapping keeps its own file descriptor, scratch space is released
+        # together with the array
+        scratch.close()
+        return header, data
 
     def itemize(self, fileName):
-        #raise NotImplementedError('Not ready yet...')
         timeStart = time.time()
         InputReader.itemize(self, fileName)
 
@@ -187,46 +655,36 @@ class RawReader(InputReader):
         if DEBUG >= 1:
             print("RawReader -- key: '%s'" % key)
 
-        raw = self.reader.read()
-        raw = raw.strip().split(NEWLINE)
-        if DEBUG >= 1:
-            print("RawReader -- raw: %s" % str(raw))
-
-        if not len(raw):
+        try:
+            if OsFStat(self.reader.fileno()).st_size > self.STREAM_THRESHOLD:
+                header, data = self._streamParse(self.reader)
+            else:
+                header, data = self._parse(self.reader)
+        finally:
+            self.reader.close()
+
+        if not data.size:
+            if len(header):
+                raise ValueError("RawReader.itemize -- No numeric data " \
+                    "found in '%s'" % fileName)
             if DEBUG >= 1:
                 print('RawReader.itemize -- Received empty file')
             return []
 
-        #
-        # Try to determine the number of columns
-        #
-        nRows = len(raw)
-        if DEBUG >= 1:
-            print('RawReader.itemize -- Determined %d rows' % nRows)
-
-        #
-        # Try to determine the number of columns
-        #
-        nCols = len(raw[0].split())
         if DEBUG >= 1:
-            print('RawReader.itemize -- Determined %d columns' % nCols)
-
-        data = np.zeros((nRows, nCols))
-
-        for idx, line in enumerate(raw):
-            # is list even in python3(.2.3)
-            iterator = [float(number.strip()) for number in line.split()]
-            data[idx, :] = np.fromiter(iterator, dtype=float)
+            print('RawReader.itemize -- Determined %d rows, %d columns' %
+                data.shape)
         data = np.squeeze(data.T)
 
         if DEBUG >= 1:
             print('RawReader.itemize -- data.shape %s, data:\n%s' %
                 (str(data.shape), data))
 
+        header = '\n'.join(header)
         if len(data.shape) == 1:
             item = SpecItem(
                 key=key,
-                header='',
+                header=header,
                 array=data,
                 fileLocation=fileName
             )
@@ -237,7 +695,7 @@ class RawReader(InputReader):
             #
             item = ScanItem(
                 key=key,
-                header='',
+                header=header,
                 array=data[1],
                 fileLocation=fileName
             )
@@ -254,6 +712,260 @@ class RawReader(InputReader):
         return llist
 
 
+class SpecFileIndex(object):
+    __doc__ = """Index of the scans in a SPEC file. The file is searched once
+    for lines starting with '#S', the data blocks are not parsed. For every
+    scan the scan number, its order (scan numbers may repeat within a file) and
+    the byte offset of the '#S' line are stored.
+
+    If caching is enabled, the index is written next to the file (file name
+    plus :py:attr:`CACHE_SUFFIX`) and reused as long as size and modification
+    time of the SPEC file do not change.
+
+     .. py:attribute:: scans
+
+        List of 3-tuples (number, order, offset) in the order of the file"""
+
+    CACHE_SUFFIX = '.rixsidx'
+    BLOCK_SIZE = 4 * 1024 ** 2
+
+    def __init__(self, fileName, useCache=False):
+        self.fileName = fileName
+        self.scans = []
+        stat = OsStat(fileName)
+        self._signature = '%d %d' % (stat.st_size, int(stat.st_mtime))
+        self._fileSize = stat.st_size
+        self._fileHeader = None
+        if not (useCache and self._readCache()):
+            self._scan()
+            if useCache:
+                self._writeCache()
+
+    def __len__(self):
+        return len(self.scans)
+
+    def _scan(self):
+        occurrences = {}
+        with open(self.fileName, 'rb') as fileHandle:
+            blockStart = 0
+            # Leading line break allows to find '#S' in the first line
+            carry = NEWLINE
+            while True:
+                block = fileHandle.read(self.BLOCK_SIZE)
+                eof = not len(block)
+                buf = carry + block
+                # Offset of buf[0] in the file
+                bufStart = blockStart - len(carry)
+                pos = buf.find(SPEC_SCAN_TAG)
+                while pos >= 0:
+                    lineEnd = buf.find(NEWLINE, pos + 1)
+                    if lineEnd < 0 and not eof:
+                        # Scan line continues in the next block
+                        break
+                    line = buf[pos + 1:lineEnd if lineEnd >= 0 else len(buf)]
+                    try:
+                        number = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        # Malformed scan line, numbered by its position
+                        number = len(self.scans) + 1
+                        if DEBUG >= 1:
+                            print("SpecFileIndex._scan -- Malformed scan " \
+                                "line '%s' in '%s'" % (
+                                line.decode('latin-1').strip(), self.fileName))
+                    order = occurrences.get(number, 0) + 1
+                    occurrences[number] = order
+                    self.scans += [(number, order, bufStart + pos + 1)]
+                    pos = buf.find(SPEC_SCAN_TAG, pos + 1)
+                if eof:
+                    break
+                # Keep the tail, it may contain an incomplete '#S' line
+                cut = buf.rfind(NEWLINE) if pos < 0 else pos
+                carry = buf[cut:]
+                blockStart += len(block)
+        if DEBUG >= 1:
+            print("SpecFileIndex._scan -- Found %d scan(s) in '%s'" %
+                (len(self), self.fileName))
+
+    def _readCache(self):
+        try:
+            with open(self.fileName + self.CACHE_SUFFIX, 'r') as fileHandle:
+                if fileHandle.readline().strip() != self._signature:
+                    return False
+                self.scans = [tuple(int(val) for val in line.split())
+                    for line in fileHandle if len(line.strip())]
+        except (IOError, OSError, ValueError):
+            self.scans = []
+            return False
+        return True
+
+    def _writeCache(self):
+        try:
+            with open(self.fileName + self.CACHE_SUFFIX, 'w') as fileHandle:
+                fileHandle.write(self._signature + '\n')
+                for scan in self.scans:
+                    fileHandle.write('%d %d %d\n' % scan)
+        except (IOError, OSError):
+            # Directory might be read only, the index is kept in memory
+            if DEBUG >= 1:
+                print("SpecFileIndex._writeCache -- Cannot write cache for " \
+                    "'%s'" % self.fileName)
+
+    def fileHeader(self):
+        """
+        Header lines of the file preceding the first scan, e.g. the motor
+        names ('#O' lines). Read on the first call.
+
+        :returns: Header lines
+        :rtype: list
+        """
+        if self._fileHeader is None:
+            stop = self.scans[0][2] if len(self.scans) else self._fileSize
+            with open(self.fileName, 'rb') as fileHandle:
+                buf = RawReader._unifyLineEndings(fileHandle.read(stop))
+            self._fileHeader = [line.decode('latin-1').strip() for line in
+                SPEC_HEADER_PATTERN.findall(buf)]
+        return self._fileHeader
+
+    def motorHeader(self):
+        """
+        :returns: Motor name lines ('#O') of the file header. The positions
+            in the '#P' lines of a scan refer to them.
+        :rtype: list
+        """
+        return [line for line in self.fileHeader() if line.startswith('#O')]
+
+    def readHeader(self, idx, fileHandle=None):
+        """
+        Reads the header lines at the beginning of a scan block, i.e. up to
+        the first data line. The data is not read.
+
+        :param int idx: Position of the scan in :py:attr:`scans`
+        :param file fileHandle: SPEC file opened in binary mode, allows to
+            read several headers without reopening the file
+        :returns: Header lines
+        :rtype: list
+        """
+        if fileHandle is None:
+            with open(self.fileName, 'rb') as fileHandle:
+                return self.readHeader(idx, fileHandle)
+        start = self.scans[idx][2]
+        if idx + 1 < len(self.scans):
+            stop = self.scans[idx + 1][2]
+        else:
+            stop = self._fileSize
+        fileHandle.seek(start)
+        header = []
+        while fileHandle.tell() < stop:
+            buf = fileHandle.readline()
+            if not len(buf):
+                break
+            for line in RawReader._unifyLineEndings(buf).split(NEWLINE):
+                line = line.strip()
+                if not len(line):
+                    continue
+                if not line.startswith(b'#'):
+                    return header
+                header += [line.decode('latin-1')]
+        return header
+
+    def readScan(self, idx):
+        """
+        Reads and parses the block of a single scan.
+
+        :param int idx: Position of the scan in :py:attr:`scans`
+        :returns: Header lines, column labels and data of shape
+            (nRows, nCols)
+        :rtype: tuple
+        """
+        start = self.scans[idx][2]
+        if idx + 1 < len(self.scans):
+            stop = self.scans[idx + 1][2]
+        else:
+            stop = self._fileSize
+        with open(self.fileName, 'rb') as fileHandle:
+            fileHandle.seek(start)
+            buf = RawReader._unifyLineEndings(fileHandle.read(stop - start))
+
+        header, labels = [], []
+        for line in SPEC_HEADER_PATTERN.findall(buf):
+            line = line.decode('latin-1').strip()
+            header += [line]
+            if line.startswith('#L'):
+                labels = line[2:].split('  ')
+                labels = [label.strip() for label in labels if label.strip()]
+        body = SPEC_HEADER_PATTERN.sub(b'', buf)
+        body = SPEC_MCA_PATTERN.sub(b'', body)
+        lines = body.strip().split(NEWLINE, 1)
+        if not len(lines[0].strip()):
+            return header, labels, np.zeros((0, 0))
+        nCols = len(lines[0].split())
+        return header, labels, RawReader._tokenize(body, nCols)
+
+
+class SpecScanLoader(object):
+    __doc__ = """Deferred loader for a single scan of a SPEC file (c.f.
+    :func:`Items.DataItem.setLoader`). The first column is used as scale, the
+    last column as data."""
+
+    def __init__(self, index, idx):
+        self.index = index
+        self.idx = idx
+
+    def __call__(self, item):
+        header, labels, data = self.index.readScan(self.idx)
+        item.header = '\n'.join(self.index.motorHeader() + header)
+        if not data.size:
+            item.setScale(np.zeros(0))
+            return np.zeros(0)
+        if data.shape[1] > 1:
+            item.setScale(np.ascontiguousarray(data[:, 0]))
+        else:
+            item.setScale(np.arange(data.shape[0], dtype=float))
+        return np.ascontiguousarray(data[:, -1])
+
+
+class SpecReader(InputReader):
+    __doc__ = """Reader for SPEC files. Opening a file builds a
+    :py:class:`SpecFileIndex` and reads the scan headers, every scan becomes a
+    :py:class:`Items.ScanItem` whose columns are read on first access. The
+    headers are read in advance, so the project metadata of a scan (c.f.
+    :py:class:`Metadata.MetadataTable`) is complete before its data is
+    loaded. The motor names of the file header are prepended to the header
+    of every scan."""
+
+    def __init__(self, cacheIndex=False):
+        """
+        :param bool cacheIndex: Store the scan index next to the SPEC file
+        """
+        super(SpecReader, self).__init__()
+        self._srcType = partial(SpecFileIndex, useCache=cacheIndex)
+
+    def itemize(self, fileName):
+        timeStart = time.time()
+        InputReader.itemize(self, fileName)
+
+        index = self.reader
+        llist = []
+        motors = index.motorHeader()
+        with open(fileName, 'rb') as fileHandle:
+            for idx, (number, order, offset) in enumerate(index.scans):
+                item = ScanItem(
+                    key='%s %d.%d' % (self.key, number, order),
+                    header='\n'.join(motors +
+                        index.readHeader(idx, fileHandle)),
+                    array=None,
+                    fileLocation=fileName
+                )
+                item.setLoader(SpecScanLoader(index, idx))
+                llist += [item]
+
+        timeEnd = time.time()
+        if DEBUG >= 1:
+            print('SpecReader.itemize -- Indexed %d scans in %.3f s' %
+                (len(llist), (timeEnd - timeStart)))
+        return llist
+
+
 def unitTest_RawReader():
     fname = '/home/truter/lab/rixs/rixs_data/Spectra/test0483.DAT'
 
@@ -271,7 +983,7 @@ def unitTest_InputReader():
 
     edfReader = EdfReader()
     for elem in sum([edfReader.itemize(fn) for fn in edfImageList], []):
-        print elem.key
+        print(elem.key())
     print(edfReader)
 
 if __name__ == '__main__':
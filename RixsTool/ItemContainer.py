@@ -26,10 +26,15 @@
 #############################################################################*/
 __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
 
-from uuid import uuid4
+from itertools import count
 
 DEBUG = 0
 
+#
+# Source of container identifiers, c.f. Items._identifiers
+#
+_identifiers = count()
+
 
 class ItemContainer(object):
     __doc__ = """The :class:`ItemContainer` class is the basic building block of
@@ -38,13 +43,13 @@ class ItemContainer(object):
     reference an instance of the class :py:class:`Items.ProjectItem`. Both uses
     of the item container can be distinguished using :func:`hasItem`
     respectively :py:func:`hasChildren`. Every item container except for the top
-    most has a parent pointer and a unique identifier. The identifier can safely
-    be assumed to be random and is provided at the moment of instantiation by
-    the :func:`uuid.uuid4`
+    most has a parent pointer and a unique identifier. The identifier is an
+    integer drawn from a session wide counter at the moment of instantiation.
+    Containers use __slots__, projects can hold tens of thousands of them.
 
      .. py:attribute:: __identifier
 
-        Randomly generated identifier for the container
+        Identifier for the container, unique within the session
 
      .. py:attribute:: _item
 
@@ -52,9 +57,10 @@ class ItemContainer(object):
 
      .. py:attribute:: _data
 
-        List containing the names of attributes of a
+        Tuple containing the names of attributes of a
         :py:class:`Items.ProjectItem` that might be of interest for a display
-        (c.f. :py:class:`Models.ProjectView`)
+        (c.f. :py:class:`Models.ProjectView`). Refers to the shared
+        :py:attr:`COLUMNS` unless changed by :func:`setData`
 
      .. py:attribute:: parent
 
@@ -64,20 +70,29 @@ class ItemContainer(object):
      .. py:attribute:: children
 
         List of :class:`ItemContainer` instance that are lower in the tree
-        hierarchie than the current instance
+        hierarchie than the current instance. Use :func:`addChildren` and
+        :func:`removeChildren` to modify the list, they keep the row indices
+        of the children up to date.
+
+     .. py:attribute:: _row
+
+        Index of the container in the children list of its parent
 
      .. py:attribute:: label
 
         String naming the container."""
 
+    __slots__ = ('__identifier', '_item', '_data', 'parent', 'children',
+                 'label', '_row')
+    COLUMNS = ('key', 'description', 'shape', 'dtype')
+
     def __init__(self, item=None, parent=None, label=None):
-        # Dict or OrderedDict here?
-        #self._data = data if data is not None else []
-        self.__identifier = uuid4()
+        self.__identifier = next(_identifiers)
         self._item = item
-        self._data = ['key', 'description', 'shape', 'dtype']
+        self._data = self.COLUMNS
         self.parent = parent
         self.children = []
+        self._row = -1
         if label:
             self.label = label
         elif item:
@@ -94,6 +109,12 @@ class ItemContainer(object):
     def __eq__(self, other):
         return self.getID() == other.getID()
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.__identifier)
+
     #
     # Methods acting on ItemContainer.children or ItemContainer.parent
     #
@@ -109,12 +130,13 @@ class ItemContainer(object):
             returned
         :rtype: int
         """
-        if self.parent:
-            siblings = self.parent.children
-            idx = siblings.index(self)
-        else:
-            idx = -1
-        return idx
+        if self.parent is None:
+            return -1
+        return self._row
+
+    def _renumberChildren(self, start=0):
+        for row in range(start, len(self.children)):
+            self.children[row]._row = row
 
     #
     # Methods acting on ItemContainer._data
@@ -143,7 +165,7 @@ class ItemContainer(object):
             return False
         head = self._data[0:pos]
         tail = self._data[pos:]
-        self._data = head + [attr] + tail
+        self._data = head + (attr,) + tail
         return True
 
     def data(self, idx):
@@ -219,12 +241,16 @@ class ItemContainer(object):
             return False
         if False in [isinstance(child, ItemContainer) for child in containerList]:
             return False
-        if pos == -1:
-            pos = len(self.children)
-
-        head = self.children[0:pos]
-        tail = self.children[pos:]
-        self.children = head + containerList + tail
+        for child in containerList:
+            child.parent = self
+        if pos == -1 or pos == len(self.children):
+            # Appending does not change the rows of the present children
+            start = len(self.children)
+            self.children.extend(containerList)
+        else:
+            start = pos
+            self.children[pos:pos] = containerList
+        self._renumberChildren(start)
         return True
 
     def removeChildren(self, pos, count=1):
@@ -238,9 +264,74 @@ class ItemContainer(object):
         if (pos < 0) or (pos >= len(self.children)):
             return False
 
+        for child in self.children[pos:pos+count]:
+            child._row = -1
         del(self.children[pos:pos+count])
+        self._renumberChildren(pos)
         return True
 
+    def removeChildRows(self, rowList):
+        """
+        Removes an arbitrary set of children in a single pass over the
+        children list.
+
+        :param list rowList: Rows of the children to be deleted
+        :returns: Depending on success or failure of the method it returns True
+            or False
+        :rtype: bool
+        """
+        rowSet = set(rowList)
+        if not rowSet:
+            return True
+        if min(rowSet) < 0 or max(rowSet) >= len(self.children):
+            return False
+        remaining = []
+        for child in self.children:
+            if child._row in rowSet:
+                child._row = -1
+            else:
+                remaining.append(child)
+        self.children = remaining
+        self._renumberChildren(min(rowSet))
+        return True
+
+
+def benchmark_ItemContainer(count=100000):
+    """
+    Measures construction time and memory of count spectra wrapped in
+    containers, i.e. the representation used by the project tree.
+
+    :param int count: Number of items
+    :returns: Construction time in seconds and allocated memory in bytes.
+        The memory is None if tracemalloc is not available.
+    :rtype: tuple
+    """
+    import time
+    import numpy
+    from RixsTool.Items import ScanItem
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    array = numpy.zeros(1)
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    root = ItemContainer(label='root')
+    root.addChildren([ItemContainer(
+        item=ScanItem('scan%d' % idx, '', array, ''),
+        parent=root) for idx in range(count)])
+    elapsed = time.time() - start
+    memory = None
+    if tracemalloc:
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    print('ItemContainer.benchmark -- %d items: %.3f s, %s' % (count, elapsed,
+        '%.1f MB' % (memory / 1024. ** 2) if memory is not None else
+        'memory not traced'))
+    return elapsed, memory
+
 
 if __name__ == '__main__':
-    pass
+    benchmark_ItemContainer()
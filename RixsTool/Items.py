@@ -25,22 +25,34 @@
 # is a problem for you.
 #############################################################################*/
 __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
-from uuid import uuid4
+from itertools import count
 from inspect import getargspec as getArgSpec
 import numpy
 
+from RixsTool.Metadata import MetadataTable
+from RixsTool.Utils import statistics as arrayStatistics
+
 DEBUG = 1
 
+#
+# Source of item identifiers. Identifiers increase monotonically and are
+# unique within a session, which is all the project tree requires.
+#
+_identifiers = count()
+
 
 class ProjectItem(object):
-    __doc__ = """Base class to be contained in a project"""
+    __doc__ = """Base class to be contained in a project. Items define
+    __slots__ instead of an instance dictionary, projects keep tens of
+    thousands of them."""
+    __slots__ = ('_key', 'header', '__identifier', '__weakref__')
     interpretation = 'Abstract DataItem'
 
     def __init__(self, key, header):
         super(ProjectItem, self).__init__()
         self._key = key
         self.header = header
-        self.__identifier = uuid4()
+        self.__identifier = next(_identifiers)
 
     def __repr__(self):
         return '%s: %s' % (self.key(), str(self.interpretation))
@@ -54,33 +66,192 @@ class ProjectItem(object):
     def getID(self):
         return self.__identifier
 
-    def hdf5Dump(self):
-        raise NotImplementedError('DataItem.hdfDump -- to be implemented here?')
+    def hdf5Dump(self, group, compression=None):
+        """
+        Writes the item into a HDF5 group. The base class stores the class
+        name, the key and the header as attributes, subclasses add their data.
+        Dictionary headers (e.g. from EDF files) become a sub group 'header'
+        with one attribute per entry.
+
+        :param h5py.Group group: Group reserved for the item
+        :param str compression: Compression filter for datasets, e.g. 'lzf'
+            or 'gzip'. Default: None, i.e. no compression
+        """
+        group.attrs['class'] = self.__class__.__name__
+        group.attrs['key'] = self.key()
+        if isinstance(self.header, dict):
+            headerGroup = group.create_group('header')
+            for key, value in self.header.items():
+                headerGroup.attrs[str(key)] = str(value)
+        elif self.header is not None:
+            group.attrs['header'] = str(self.header)
 
 
 class DataItem(ProjectItem):
-    __doc__ = """Generic class to contain numeric data"""
+    __doc__ = """Generic class to contain numeric data
+
+     .. py:attribute:: HISTOGRAM_BINS
+
+        Number of bins of the histogram returned by :func:`statistics`"""
+    __slots__ = ('fileLocation', '_loader', '_hint', '_stats', '_array',
+                 '_original')
     interpretation = 'Dataset'
+    HISTOGRAM_BINS = 64
 
     def __init__(self, key, header, array, fileLocation):
         ProjectItem.__init__(self, key, header)
         self.fileLocation = fileLocation
+        self._loader = None
+        self._hint = None
+        self._stats = None
+        self._original = None
         self.array = array
 
     def __repr__(self):
         return '%s %s: %s' % \
             (self.interpretation, self.key(), str(self.shape()))
 
+    def description(self):
+        if self._original is not None:
+            return '%s (duplicate of %s)' % \
+                (self.interpretation, self._original.key())
+        return self.interpretation
+
+    def original(self):
+        """
+        :returns: Item with identical content read from another file, None if
+            the item is not a duplicate
+        :rtype: DataItem or None
+        """
+        return self._original
+
+    def duplicate(self, key, fileLocation):
+        """
+        Creates an item for a file with the same content. The duplicate shares
+        the array of the original, the data is read at most once.
+
+        :param str key: Key of the duplicate
+        :param str fileLocation: File the duplicate stems from
+        :returns: Item of the same type flagged as duplicate
+        :rtype: DataItem
+        """
+        item = self.__class__(key, self.header, None, fileLocation)
+        item._original = self
+        if self.isLoaded():
+            item.array = self.array
+        else:
+            item.setLoader(_originalArray, self.shape(), self.dtype())
+        return item
+
+    @property
+    def array(self):
+        """
+        Numeric data of the item. If a loader is set (c.f.
+        :func:`setLoader`), the data is materialized on first access.
+        """
+        if self._loader is not None:
+            loader = self._loader
+            self._loader = None
+            self._array = loader(self)
+        return self._array
+
+    @array.setter
+    def array(self, array):
+        self._loader = None
+        self._stats = None
+        self._array = array
+
+    def statistics(self):
+        """
+        Minimum, maximum, mean, sum and a coarse histogram of the array (c.f.
+        :func:`Utils.statistics`). The values are computed on the first call
+        and cached until the array is replaced.
+
+        :returns: Dictionary with keys 'min', 'max', 'mean', 'sum' and
+            'histogram'
+        :rtype: dict
+        """
+        if self._stats is None:
+            self._stats = arrayStatistics(self.array, self.HISTOGRAM_BINS)
+        return self._stats
+
+    def setLoader(self, loader, shape=None, dtype=None):
+        """
+        Defers reading the data until :py:attr:`array` is accessed.
+
+        :param callable loader: Called once with the item as only argument,
+            must return the array
+        :param tuple shape: Shape of the array if known in advance. Allows to
+            display the item without loading its data.
+        :param dtype: Data type of the array if known in advance
+        """
+        self._array = None
+        self._stats = None
+        self._loader = loader
+        self._hint = (shape, dtype) if shape is not None else None
+
+    def loader(self):
+        """
+        :returns: Loader set by :func:`setLoader` that has not been called
+            yet, None if the data is materialized
+        """
+        return self._loader
+
+    def isLoaded(self):
+        """
+        :returns: False if the data has not been materialized yet
+        :rtype: bool
+        """
+        return self._loader is None
+
     def shape(self):
+        if self._hint is not None and not self.isLoaded():
+            return self._hint[0]
         return self.array.shape
 
     def dtype(self):
+        if self._hint is not None and not self.isLoaded():
+            return self._hint[1]
         return self.array.dtype
 
+    def hdf5Dump(self, group, compression=None):
+        """
+        Stores the array as chunked dataset 'data'. Array like objects that
+        read their data on demand (c.f. :py:class:`IO.EdfFrameStack`) are
+        written frame by frame.
+        """
+        ProjectItem.hdf5Dump(self, group, compression)
+        group.attrs['fileLocation'] = str(self.fileLocation)
+        array = self.array
+        if array is None:
+            return
+        if isinstance(array, numpy.ndarray):
+            group.create_dataset('data', data=array,
+                chunks=True if array.size else None,
+                compression=compression if array.size else None)
+        else:
+            dataset = group.create_dataset('data', shape=array.shape,
+                dtype=array.dtype, chunks=(1,) + tuple(array.shape[1:]),
+                compression=compression)
+            for idx in range(array.shape[0]):
+                dataset[idx] = array[idx]
+
+
+def _originalArray(item):
+    """
+    Loader of duplicates (c.f. :func:`DataItem.duplicate`), materializes the
+    array of the original item and shares it.
+    """
+    original = item.original()
+    if isinstance(item, ScanItem):
+        item.setScale(original.scale())
+    return original.array
+
 
 class FunctionItem(ProjectItem):
     __doc__ = """Class to contain a real valued function in terms of an
     analytical expression and a set of parameters"""
+    __slots__ = ('expression', 'parameters', '_argspec')
     interpretation = 'Function'
 
     def __init__(self, key, header):
@@ -102,6 +273,22 @@ class FunctionItem(ProjectItem):
         """
         self.parameters = parameters
 
+    def hdf5Dump(self, group, compression=None):
+        """
+        Stores the argument names of the expression in the attribute
+        'arguments' and the parameters as attributes of the sub group
+        'parameters'. The expression itself is not stored.
+        """
+        ProjectItem.hdf5Dump(self, group, compression)
+        group.attrs['arguments'] = \
+            numpy.array([str(arg) for arg in self._argspec.args], dtype='S')
+        parameterGroup = group.create_group('parameters')
+        for name, value in self.parameters.items():
+            if name == 'x':
+                # Sample range, c.f. FunctionItem.sample
+                continue
+            parameterGroup.attrs[name] = value
+
     def consistencyCheck(self):
         # TODO: Improve consistency check
         args = self._argspec.args
@@ -131,12 +318,19 @@ class FunctionItem(ProjectItem):
 
 class ScanItem(DataItem):
     __doc__ = """Class to contain data in multiple 1D numpy arrays"""
+    __slots__ = ('_scale',)
     interpretation = 'Scan'
 
     def __init__(self, key, header, array, fileLocation):
         DataItem.__init__(self, key, header, array, fileLocation)
         self._scale = None
 
+    def duplicate(self, key, fileLocation):
+        item = DataItem.duplicate(self, key, fileLocation)
+        if self.isLoaded():
+            item.setScale(self._scale)
+        return item
+
     def scale(self, sampleRange=None):
         """
         :param ndarray sampleRange: In case the scale of the scan has been
@@ -145,6 +339,9 @@ class ScanItem(DataItem):
             on the range from 0 to len(array).
         :returns: ndarray scale or None
         """
+        if self._scale is None and not self.isLoaded():
+            # Loaders set the scale together with the array
+            self.array
         if isinstance(self._scale, numpy.ndarray):
             return self._scale
         elif isinstance(self._scale, FunctionItem):
@@ -160,26 +357,103 @@ class ScanItem(DataItem):
     def setScale(self, scale):
         self._scale = scale
 
+    def hdf5Dump(self, group, compression=None):
+        """
+        Stores the scale as dataset 'scale' or, if the scale is a
+        :py:class:`FunctionItem`, as sub group 'scale'.
+        """
+        DataItem.hdf5Dump(self, group, compression)
+        if isinstance(self._scale, FunctionItem):
+            self._scale.hdf5Dump(group.create_group('scale'), compression)
+        elif self.scale() is not None:
+            group.create_dataset('scale', data=self.scale())
+
 
 class SpecItem(DataItem):
     __doc__ = """Class to contain data in a 1D numpy array"""
+    __slots__ = ()
     interpretation = 'Spec'
-    pass
 
 class ImageItem(DataItem):
     __doc__ = """Class to contain data in a 2D numpy array"""
+    __slots__ = ('scaleX', 'scaleY', '_parameters', '_parametersHeader')
     interpretation = 'Image'
 
     def __init__(self, key, header, array, fileLocation):
         DataItem.__init__(self, key, header, array, fileLocation)
         self.scaleX = None
         self.scaleY = None
+        self._parameters = None
+        self._parametersHeader = None
+
+    def duplicate(self, key, fileLocation):
+        item = DataItem.duplicate(self, key, fileLocation)
+        item.scaleX = self.scaleX
+        item.scaleY = self.scaleY
+        return item
+
+    def headerParameters(self):
+        """
+        Acquisition parameters found in the header, e.g. 'energy', 'preset'
+        or 'binning' (c.f. :func:`Metadata.MetadataTable.parseHeader`). The
+        header is parsed once, the result is cached until the header is
+        replaced.
+
+        :returns: Parameter names and values, missing values are left out
+        :rtype: dict
+        """
+        if self._parameters is None or self._parametersHeader is not self.header:
+            parameters = MetadataTable.parseHeader(self.header)
+            self._parameters = dict((key, value) for key, value in
+                parameters.items() if not numpy.isnan(value))
+            self._parametersHeader = self.header
+        return self._parameters
+
+    def hdf5Dump(self, group, compression=None):
+        """
+        Stores scaleX and scaleY as attributes, if set.
+        """
+        DataItem.hdf5Dump(self, group, compression)
+        for name in ['scaleX', 'scaleY']:
+            scale = getattr(self, name)
+            if scale is not None:
+                group.attrs[name] = scale
 
 
 class StackItem(DataItem):
-    __doc__ = """Class to contain data in a 3D numpy array"""
+    __doc__ = """Class to contain data in a 3D numpy array or an array like
+    object that reads its frames on demand (c.f.
+    :py:class:`IO.EdfFrameStack`)"""
+    __slots__ = ()
     interpretation = 'Stack'
-    pass
+
+    def frameCount(self):
+        return self.shape()[0]
+
+    def frame(self, idx):
+        """
+        :param int idx: Number of the frame
+        :returns: Two dimensional frame, only this frame is read
+        :rtype: ndarray
+        """
+        return self.array[idx]
+
+    def frameItem(self, idx):
+        """
+        :param int idx: Number of the frame
+        :returns: Frame wrapped in an image item. The key is composed of the
+            stack key and the frame number.
+        :rtype: ImageItem
+        """
+        if hasattr(self.array, 'header'):
+            header = self.array.header(idx)
+        else:
+            header = self.header
+        return ImageItem(
+            key='%s [%d]' % (self.key(), idx),
+            header=header,
+            array=self.frame(idx),
+            fileLocation=self.fileLocation)
 
 
 if __name__ == '__main__':
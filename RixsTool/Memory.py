@@ -0,0 +1,322 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module keeps track of the memory used by the arrays of the items
+in a :py:class:`Project.RixsProject`. Once the usage exceeds a limit, the
+arrays used least recently are written to scratch files and replaced by
+memory maps of these files, which the operating system can page out."""
+
+import numpy
+from collections import OrderedDict
+from os import remove as OsRemove
+from os.path import join as OsPathJoin
+from shutil import rmtree as ShutilRmTree
+from tempfile import mkdtemp as TempfileMkdtemp
+
+try:
+    from weakref import finalize as WeakrefFinalize
+except ImportError:
+    # Python 2: scratch files are only removed by close()
+    WeakrefFinalize = None
+
+DEBUG = 0
+
+
+def _removeScratch(spilled, directory):
+    """
+    Removes the scratch files of an accountant, the whole directory if the
+    accountant created it.
+
+    :param dict spilled: Item keys mapped to scratch file names
+    :param str directory: Directory created by the accountant or None
+    """
+    if directory is not None:
+        ShutilRmTree(directory, ignore_errors=True)
+    else:
+        for fileName in set(spilled.values()):
+            try:
+                OsRemove(fileName)
+            except OSError:
+                pass
+    spilled.clear()
+
+
+class SpillLoader(object):
+    __doc__ = """Loader of spilled items (c.f.
+    :func:`Items.DataItem.setLoader`). The scratch file is mapped copy on
+    write, i.e. modifications of the array do not alter the file."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+    def __call__(self, item):
+        return numpy.load(self.fileName, mmap_mode='c')
+
+
+class MemoryAccountant(object):
+    __doc__ = """Sums the number of bytes of all item arrays held in memory
+    and spills arrays to disk in least recently used order once the limit is
+    exceeded. Arrays that are memory maps, array like objects reading their
+    data on demand and items whose data has not been read yet do not count.
+    Items sharing one array (c.f. :func:`Items.DataItem.duplicate`) are
+    accounted and spilled together.
+
+    The usage is tracked incrementally when items are registered, removed or
+    spilled. Arrays that are read or replaced later are picked up by
+    :func:`refresh`, which :func:`enforce` calls before spilling anything.
+
+     .. py:attribute:: DEFAULT_LIMIT
+
+        Default memory limit in bytes
+
+     .. py:attribute:: limit
+
+        Current memory limit in bytes"""
+
+    DEFAULT_LIMIT = 2 * 1024 ** 3
+
+    def __init__(self, limit=None, scratchDirectory=None):
+        """
+        :param int limit: Memory limit in bytes, default: DEFAULT_LIMIT
+        :param str scratchDirectory: Directory for the scratch files. A
+            temporary directory is created on the first spill by default.
+        """
+        self.limit = self.DEFAULT_LIMIT if limit is None else int(limit)
+        self._scratchDirectory = scratchDirectory
+        self._ownsScratch = False
+        self._items = OrderedDict()  # Least recently used first
+        self._spilled = {}
+        self._scratchUsers = {}  # scratch file name -> number of items
+        self._counter = 0
+        #
+        # Incremental usage: key -> id of the accounted array and
+        # array id -> [nbytes, keys of the items sharing the array]
+        #
+        self._accounted = {}
+        self._arrays = {}
+        self._usage = 0
+        #
+        # Removes the scratch files once the accountant is garbage collected
+        # or the interpreter exits, set on the first spill
+        #
+        self._finalizer = None
+
+    @staticmethod
+    def _resident(item):
+        """
+        :returns: The array of the item if it occupies memory, otherwise None
+        """
+        if not item.isLoaded():
+            return None
+        array = item.array
+        if not isinstance(array, numpy.ndarray) or \
+                isinstance(array, numpy.memmap):
+            return None
+        return array
+
+    def register(self, item):
+        """
+        :param DataItem item: Item to be accounted, becomes the most recently
+            used one
+        """
+        if not hasattr(item, 'isLoaded'):
+            # FunctionItems do not hold arrays
+            return
+        self._items[item.key()] = item
+        self.touch(item)
+        self._account(item.key(), self._resident(item))
+
+    def unregister(self, key):
+        """
+        :param str key: Key of an item removed from the project
+        """
+        self._items.pop(key, None)
+        self._account(key, None)
+        self._releaseScratch(key)
+
+    def _account(self, key, array):
+        """
+        Sets the array accounted for an item, None if the item does not
+        occupy memory.
+        """
+        previous = self._accounted.pop(key, None)
+        if previous is not None:
+            entry = self._arrays[previous]
+            entry[1].discard(key)
+            if not entry[1]:
+                self._usage -= entry[0]
+                del(self._arrays[previous])
+        if array is None:
+            return
+        arrayId = id(array)
+        self._accounted[key] = arrayId
+        if arrayId in self._arrays:
+            self._arrays[arrayId][1].add(key)
+        else:
+            self._arrays[arrayId] = [array.nbytes, set([key])]
+            self._usage += array.nbytes
+
+    def _releaseScratch(self, key):
+        fileName = self._spilled.pop(key, None)
+        if fileName is None:
+            return
+        self._scratchUsers[fileName] -= 1
+        if not self._scratchUsers[fileName]:
+            del(self._scratchUsers[fileName])
+            try:
+                OsRemove(fileName)
+            except OSError:
+                # Still mapped on some platforms, removed by close()
+                pass
+
+    def touch(self, item):
+        """
+        Marks an item as most recently used, e.g. when it is displayed.
+
+        :param DataItem item: Accounted item
+        """
+        key = item.key()
+        if key in self._items:
+            self._items[key] = self._items.pop(key)
+
+    def usage(self):
+        """
+        :returns: Number of bytes held in memory by the accounted arrays as
+            of the last modification or :func:`refresh`
+        :rtype: int
+        """
+        return self._usage
+
+    def refresh(self):
+        """
+        Recounts the memory of all items, e.g. after arrays have been read
+        or replaced.
+
+        :returns: Number of bytes held in memory
+        :rtype: int
+        """
+        self._accounted.clear()
+        self._arrays.clear()
+        self._usage = 0
+        for key, item in self._items.items():
+            self._account(key, self._resident(item))
+        return self._usage
+
+    def spilledCount(self):
+        """
+        :returns: Number of items whose arrays live in scratch files
+        :rtype: int
+        """
+        return len(self._spilled)
+
+    def setLimit(self, limit):
+        """
+        :param int limit: Memory limit in bytes
+        """
+        self.limit = int(limit)
+        self.enforce()
+
+    def _scratchFileName(self):
+        if self._scratchDirectory is None:
+            self._scratchDirectory = TempfileMkdtemp(prefix='rixstool-')
+            self._ownsScratch = True
+        if self._finalizer is None and WeakrefFinalize is not None:
+            # The finalizer must not refer to the accountant itself
+            self._finalizer = WeakrefFinalize(self, _removeScratch,
+                self._spilled,
+                self._scratchDirectory if self._ownsScratch else None)
+        self._counter += 1
+        return OsPathJoin(self._scratchDirectory, 'spill%06d.npy' %
+            self._counter)
+
+    def spill(self, item):
+        """
+        Writes the array of an item to a scratch file and replaces it, and
+        the arrays of all items sharing it as of the last modification or
+        :func:`refresh`, by a memory map of that file.
+
+        :param DataItem item: Accounted item
+        :returns: Number of bytes released
+        :rtype: int
+        """
+        array = self._resident(item)
+        if array is None:
+            return 0
+        fileName = self._scratchFileName()
+        numpy.save(fileName, array)
+        keys = set([item.key()])
+        if self._accounted.get(item.key()) == id(array):
+            keys |= self._arrays[id(array)][1]
+        for key in keys:
+            other = self._items.get(key, item)
+            if self._resident(other) is not array:
+                continue
+            other.setLoader(SpillLoader(fileName), array.shape, array.dtype)
+            self._account(key, None)
+            self._releaseScratch(key)
+            self._spilled[key] = fileName
+            self._scratchUsers[fileName] = \
+                self._scratchUsers.get(fileName, 0) + 1
+        if DEBUG >= 1:
+            print("MemoryAccountant.spill -- '%s' (%d bytes) to '%s'" %
+                (item.key(), array.nbytes, fileName))
+        return array.nbytes
+
+    def enforce(self):
+        """
+        Spills arrays in least recently used order until the usage is below
+        the limit. The most recently used item is never spilled.
+
+        :returns: Number of bytes released
+        :rtype: int
+        """
+        if self._usage <= self.limit:
+            return 0
+        if self.refresh() <= self.limit:
+            return 0
+        released = 0
+        candidates = list(self._items.values())[:-1]
+        for item in candidates:
+            if self._usage <= self.limit:
+                break
+            released += self.spill(item)
+        return released
+
+    def close(self):
+        """
+        Removes the scratch files. Spilled items that have not been paged in
+        lose their data.
+        """
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        _removeScratch(self._spilled,
+            self._scratchDirectory if self._ownsScratch else None)
+        self._scratchUsers.clear()
+        if self._ownsScratch:
+            self._scratchDirectory = None
+            self._ownsScratch = False
@@ -0,0 +1,448 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module keeps the acquisition parameters found in the item headers
+in a columnar table. Every item of a :py:class:`Project.RixsProject` occupies
+one row, every parameter (energy, preset, binning, time, motor positions) one
+numpy.ndarray column. Queries are answered by vectorized masks over the
+columns."""
+
+import re
+import time
+import numpy
+from collections import OrderedDict
+
+DEBUG = 0
+
+#
+# Columns present in every table and the header keys they are read from. The
+# first key found in a header is used.
+#
+HEADER_KEYS = OrderedDict([
+    ('energy', ['energy', 'Energy', 'photon_energy', 'mono_energy']),
+    ('preset', ['preset', 'Preset', 'count_time', 'exposure_time',
+                'acq_expo_time']),
+    ('binning', ['binning', 'Binning', 'bin', 'row_bin', 'bin_y']),
+    ('time', ['time_of_day', 'timestamp', 'epoch'])
+])
+
+#
+# Header keys containing a date string, used if none of the HEADER_KEYS of
+# the 'time' column is present.
+#
+DATE_KEYS = ['date', 'Date', 'time', 'Time']
+DATE_FORMATS = ['%a %b %d %H:%M:%S %Y', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S']
+
+NUMBER_PATTERN = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+
+def _toFloat(value):
+    """
+    :param value: Number or string starting with a number, e.g. '300 (sec)'
+    :returns: Numerical value or NaN
+    :rtype: float
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    match = NUMBER_PATTERN.search(str(value))
+    if match:
+        return float(match.group(0))
+    return numpy.nan
+
+
+def _toTimestamp(value):
+    """
+    :param str value: Date string in one of the DATE_FORMATS
+    :returns: Seconds since the epoch or NaN
+    :rtype: float
+    """
+    value = str(value).strip()
+    for dateFormat in DATE_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, dateFormat))
+        except ValueError:
+            continue
+    return numpy.nan
+
+
+def _specHeaderDict(header):
+    """
+    Translates a text header, i.e. 'key = value' lines or SPEC header lines,
+    to a dictionary resembling an EDF header. SPEC motor names and positions
+    (#O and #P lines) are joined into 'motor_mne' and 'motor_pos'.
+
+    :param str header: Header lines
+    :rtype: dict
+    """
+    result = {}
+    mnemonics, positions = [], []
+    for line in header.splitlines():
+        line = line.strip()
+        if line.startswith('#O'):
+            mnemonics += line.split()[1:]
+        elif line.startswith('#P'):
+            positions += line.split()[1:]
+        elif line.startswith('#D '):
+            result['date'] = line[3:]
+        elif line.startswith('#T '):
+            result['preset'] = line[3:]
+        elif '=' in line:
+            key, value = line.lstrip('#').split('=', 1)
+            result[key.strip()] = value.strip().rstrip(';')
+    if mnemonics:
+        result['motor_mne'] = ' '.join(mnemonics)
+        result['motor_pos'] = ' '.join(positions)
+    return result
+
+
+class MetadataTable(object):
+    __doc__ = """Columnar table of acquisition parameters. Columns are
+    float64 arrays that grow by doubling their capacity. Missing values are
+    NaN. Removed rows are masked out by :py:attr:`valid` instead of moving
+    the following rows. Once removed rows outnumber the others, the table is
+    compacted, i.e. the remaining rows are moved to the front.
+
+     .. py:attribute:: valid
+
+        Boolean array, False for rows of removed items
+
+     .. py:attribute:: keys
+
+        Object array containing the item key of every row"""
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self):
+        self._size = 0
+        self._capacity = self.INITIAL_CAPACITY
+        self._rows = {}
+        self.keys = numpy.empty(self._capacity, dtype=object)
+        self.valid = numpy.zeros(self._capacity, dtype=bool)
+        self._columns = OrderedDict()
+        for name in HEADER_KEYS:
+            self._addColumn(name)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    @staticmethod
+    def parseHeader(header):
+        """
+        Extracts the acquisition parameters from an item header. Motor
+        positions given as 'motor_mne' and 'motor_pos' become entries named
+        after the motor.
+
+        :param dict or str header: Header of a :py:class:`Items.ProjectItem`
+        :returns: Column names and their values
+        :rtype: dict
+        """
+        if isinstance(header, str):
+            header = _specHeaderDict(header)
+        elif not isinstance(header, dict):
+            return {}
+        values = {}
+        mnemonics = str(header.get('motor_mne', '')).split()
+        positions = str(header.get('motor_pos', '')).split()
+        for mnemonic, position in zip(mnemonics, positions):
+            values[mnemonic] = _toFloat(position)
+        for name, candidates in HEADER_KEYS.items():
+            for candidate in candidates:
+                if candidate in header:
+                    values[name] = _toFloat(header[candidate])
+                    break
+        if numpy.isnan(values.get('time', numpy.nan)):
+            for candidate in DATE_KEYS:
+                if candidate in header:
+                    values['time'] = _toTimestamp(header[candidate])
+                    break
+        return values
+
+    def _addColumn(self, name):
+        column = numpy.empty(self._capacity, dtype=numpy.float64)
+        column.fill(numpy.nan)
+        self._columns[name] = column
+        return column
+
+    def _grow(self):
+        self._capacity *= 2
+        for name, column in self._columns.items():
+            grown = numpy.empty(self._capacity, dtype=numpy.float64)
+            grown.fill(numpy.nan)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+        keys = numpy.empty(self._capacity, dtype=object)
+        keys[:self._size] = self.keys[:self._size]
+        self.keys = keys
+        valid = numpy.zeros(self._capacity, dtype=bool)
+        valid[:self._size] = self.valid[:self._size]
+        self.valid = valid
+
+    def addRow(self, key, header):
+        """
+        :param str key: Item key
+        :param dict or str header: Item header, c.f. :func:`parseHeader`
+        :raises ValueError: if the key is already present
+        """
+        if key in self._rows:
+            raise ValueError("MetadataTable.addRow -- Key '%s' already " \
+                "present" % key)
+        if self._size == self._capacity:
+            self._grow()
+        row = self._size
+        self._size += 1
+        self._setRow(row, header)
+        self.keys[row] = key
+        self.valid[row] = True
+        self._rows[key] = row
+
+    def _setRow(self, row, header):
+        values = self.parseHeader(header)
+        for name, column in self._columns.items():
+            column[row] = values.pop(name, numpy.nan)
+        for name, value in values.items():
+            self._addColumn(name)[row] = value
+
+    def removeRow(self, key):
+        """
+        :param str key: Item key, unknown keys are ignored
+        """
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        self.valid[row] = False
+        self.keys[row] = None
+        if self._size - len(self._rows) > len(self._rows):
+            self._compact()
+
+    def _compact(self):
+        """
+        Moves the valid rows to the front, keeping their order.
+        """
+        live = numpy.flatnonzero(self.valid[:self._size])
+        count = len(live)
+        for column in self._columns.values():
+            column[:count] = column[live]
+            column[count:self._size] = numpy.nan
+        self.keys[:count] = self.keys[live]
+        self.keys[count:self._size] = None
+        self.valid[:count] = True
+        self.valid[count:self._size] = False
+        self._size = count
+        self._rows = dict((key, row) for row, key in
+            enumerate(self.keys[:count]))
+
+    def updateRow(self, key, header):
+        """
+        Replaces the values of a row in place, e.g. once the header of a
+        lazily read item is available. Unknown keys are added.
+
+        :param str key: Item key
+        :param dict or str header: Item header, c.f. :func:`parseHeader`
+        """
+        row = self._rows.get(key)
+        if row is None:
+            self.addRow(key, header)
+        else:
+            self._setRow(row, header)
+
+    def columnNames(self):
+        """
+        :returns: Names of all columns
+        :rtype: list
+        """
+        return list(self._columns.keys())
+
+    def column(self, name):
+        """
+        :param str name: Column name
+        :returns: Column values of all rows including removed ones, c.f.
+            :py:attr:`valid`
+        :rtype: numpy.ndarray
+        :raises KeyError: if the column does not exist
+        """
+        if name not in self._columns:
+            raise KeyError("MetadataTable.column -- Unknown column '%s'" % name)
+        return self._columns[name][:self._size]
+
+    def row(self, key):
+        """
+        :param str key: Item key
+        :returns: Column names and values of the row, missing values are left
+            out
+        :rtype: dict
+        """
+        row = self._rows[key]
+        return dict((name, column[row]) for name, column in
+            self._columns.items() if not numpy.isnan(column[row]))
+
+    def mask(self, **criteria):
+        """
+        Every keyword names a column, its value is a criterion:
+
+        tuple (low, high)
+            low <= value <= high, None leaves a side open
+
+        list or set
+            value is one of the elements
+
+        callable
+            receives the column, returns a boolean array
+
+        number
+            value equals the number
+
+        :returns: Boolean array selecting the matching rows
+        :rtype: numpy.ndarray
+        :raises KeyError: if a column does not exist
+        """
+        result = self.valid[:self._size].copy()
+        for name, criterion in criteria.items():
+            column = self.column(name)
+            if isinstance(criterion, tuple):
+                low, high = criterion
+                if low is not None:
+                    result &= column >= low
+                if high is not None:
+                    result &= column <= high
+            elif isinstance(criterion, (list, set)):
+                result &= numpy.isin(column, list(criterion))
+            elif callable(criterion):
+                result &= numpy.asarray(criterion(column), dtype=bool)
+            else:
+                result &= column == criterion
+        return result
+
+    def select(self, **criteria):
+        """
+        :returns: Keys of the rows matching all criteria, c.f. :func:`mask`
+        :rtype: list
+        """
+        return list(self.keys[:self._size][self.mask(**criteria)])
+
+    def groupBy(self, name, decimals=None, **criteria):
+        """
+        Groups the rows by the values of a column. Rows with missing values
+        are left out.
+
+        :param str name: Column name
+        :param int decimals: Values are rounded to the given number of
+            decimals before grouping. Default: None, i.e. no rounding
+        :param criteria: Restrict the grouping to rows matching the criteria,
+            c.f. :func:`mask`
+        :returns: Column values mapped to the lists of keys, ordered by value
+        :rtype: OrderedDict
+        """
+        column = self.column(name)
+        if decimals is not None:
+            column = numpy.round(column, decimals)
+        mask = self.mask(**criteria) & ~numpy.isnan(column)
+        values, inverse = numpy.unique(column[mask], return_inverse=True)
+        keys = self.keys[:self._size][mask]
+        order = numpy.argsort(inverse, kind='mergesort')
+        bounds = numpy.searchsorted(inverse[order],
+            numpy.arange(len(values) + 1))
+        result = OrderedDict()
+        for idx, value in enumerate(values):
+            result[value] = list(keys[order[bounds[idx]:bounds[idx + 1]]])
+        return result
+
+
+def unitTest_select():
+    table = MetadataTable()
+    table.addRow('a.edf', {'preset': 300, 'energy': 931.5})
+    table.addRow('b.edf', {'preset': 600, 'energy': 931.5})
+    table.addRow('c.edf', {'preset': 900, 'energy': 932.})
+    table.removeRow('b.edf')
+    table.addRow('d.edf', {'preset': 600})
+
+    checks = [
+        (table.select(preset=[300, 600]), ['a.edf', 'd.edf']),
+        (table.select(preset=set([900])), ['c.edf']),
+        (table.select(preset=(500, None)), ['c.edf', 'd.edf']),
+        (table.select(energy=931.5), ['a.edf'])
+    ]
+    success = True
+    for result, expected in checks:
+        if sorted(result) != expected:
+            print('MetadataTable.unitTest_select -- Expected %s, got %s' %
+                (str(expected), str(result)))
+            success = False
+
+    if success:
+        print('MetadataTable.unitTest_select -- Success!')
+    else:
+        print('MetadataTable.unitTest_select -- Failure!')
+    return success
+
+
+def unitTest_updateRow():
+    table = MetadataTable()
+    for idx in range(100):
+        table.addRow('%d.edf' % idx, {'preset': idx})
+    for idx in range(1000):
+        table.updateRow('7.edf', {'preset': idx, 'energy': 931.})
+    table.updateRow('7.edf', {'preset': 7})
+
+    success = True
+    if table._size != 100:
+        print('MetadataTable.unitTest_updateRow -- Updates added %d rows' %
+            (table._size - 100))
+        success = False
+    if table.row('7.edf') != {'preset': 7.}:
+        print('MetadataTable.unitTest_updateRow -- Row not replaced: %s' %
+            str(table.row('7.edf')))
+        success = False
+    for idx in range(0, 100, 2):
+        table.removeRow('%d.edf' % idx)
+    for idx in range(1, 40, 2):
+        table.removeRow('%d.edf' % idx)
+    if len(table) != 30 or table._size > 2 * len(table):
+        print('MetadataTable.unitTest_updateRow -- %d rows stored for %d '
+            'items' % (table._size, len(table)))
+        success = False
+    expected = ['%d.edf' % idx for idx in range(81, 100, 2)]
+    if sorted(table.select(preset=(80, None))) != sorted(expected) or \
+            table.row('41.edf') != {'preset': 41.}:
+        print('MetadataTable.unitTest_updateRow -- Rows differ after '
+            'compaction')
+        success = False
+
+    if success:
+        print('MetadataTable.unitTest_updateRow -- Success!')
+    else:
+        print('MetadataTable.unitTest_updateRow -- Failure!')
+    return success
+
+if __name__ == '__main__':
+    unitTest_select()
+    unitTest_updateRow()
@@ -27,6 +27,7 @@
 __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
 
 import numpy
+from collections import OrderedDict
 
 # Numeric routines from PyMca
 from PyMca5.PyMca.Gefit import LeastSquaresFit as LSF
@@ -41,18 +42,57 @@ from .Functions import Fit
 
 DEBUG = 0
 
+#
+# Default parameters of the ID32 bandpass filter, used if neither the image
+# header nor the caller provides a value
+#
+ID32_DEFAULTS = {
+    'energy': 931.942,  # Photon energy in eV
+    'binning': 4,       # Hardware binning of the detector
+    'preset': 300,      # Exposure time in seconds
+    'dc': 0.00016       # Dark current, counts per pixel per second
+}
+
 
 class ImageOp(object):
+    __doc__ = """Base class of the image operations. Subclasses register their
+    operations by name in _ops and the parameters an operation accepts in
+    _params, i.e. parameter name and type (float, int, bool, str or list).
+    Operations without an entry in _params are not available in pipelines
+    (c.f. :py:mod:`Pipeline`)."""
+
     def __init__(self):
         object.__init__(self)
         self._ops = {}
+        self._params = {}
 
 
 class Filter(ImageOp):
     def __init__(self):
         ImageOp.__init__(self)
         self._ops = {
-            'bandpass': self.bandPassFilter
+            'bandpass': self.bandPassFilter,
+            'bandpassID32': self.bandPassFilterID32
+        }
+        self._params = {
+            'bandpass': {
+                'low': float,
+                'high': float,
+                'offset': float,
+                'replace': float,
+                'min': float,
+                'max': float
+            },
+            'bandpassID32': {
+                'energy': float,
+                'binning': int,
+                'preset': float,
+                'dc': float,
+                'baselineRows': int,
+                'baseline': float,
+                'low': float,
+                'high': float
+            }
         }
 
     @staticmethod
@@ -72,6 +112,11 @@ class Filter(ImageOp):
         replace
             value to be used as replacement (default: minimum value)
 
+        min, max
+            known minimum and maximum of the image, e.g. from
+            :func:`Items.DataItem.statistics`. Saves scanning the image if
+            one of the defaults is needed.
+
         The offset is subtracted from the image. Values above the upper
         threshold or below the lower threshold are replaced by a given
         replacement value.
@@ -82,12 +127,17 @@ class Filter(ImageOp):
         :param dict params: Contains parameters low, high and offset
         :returns ndarray: Filtered image
         """
-        imMin = image.min()
-        imMax = image.max()
+        if 'low' in params and 'replace' in params:
+            imMin = None
+        else:
+            imMin = params['min'] if 'min' in params else image.min()
         lo = params.get('low', imMin)
-        hi = params.get('high', imMax)
-        offset = params.get('offset', 0.)
         replace = params.get('replace', imMin)
+        if 'high' in params:
+            hi = params['high']
+        else:
+            hi = params['max'] if 'max' in params else image.max()
+        offset = params.get('offset', 0.)
 
         if DEBUG >= 1:
             print('Filter.bandPassFilter -- calculating..')
@@ -113,11 +163,81 @@ class Filter(ImageOp):
 
         return out
 
+    @staticmethod
+    def id32Parameters(item, params=None):
+        """
+        Binds the parameters of the ID32 bandpass filter for an image item.
+        Values given in params take precedence over values found in the item
+        header, which take precedence over ID32_DEFAULTS.
+
+        :param ImageItem item: Item providing the header
+        :param dict params: Explicitly set parameters
+        :returns: Parameters energy, binning, preset and dc
+        :rtype: dict
+        """
+        result = dict(ID32_DEFAULTS)
+        if hasattr(item, 'headerParameters'):
+            header = item.headerParameters()
+            for key in ID32_DEFAULTS:
+                if key in header:
+                    result[key] = header[key]
+        if params:
+            result.update(params)
+        return result
+
+    @staticmethod
+    def id32Thresholds(params):
+        """
+        The values for upper and lower thresholds depend on certain
+        characteristics of the detector. The detector efficiency is a function
+        of the photon energy and the number of electrons induced by a single
+        photon.
+
+        :param dict params: Contains the photon energy 'energy' and the
+            hardware binning of the detector 'binning'
+        :returns: Lower and upper threshold
+        :rtype: tuple
+        """
+        photonEnery = params.get('energy', ID32_DEFAULTS['energy'])
+        binning = params.get('binning', ID32_DEFAULTS['binning'])
+
+        # 1. / (3.6 * 1.12) = 0.248...
+        detectorEfficiency = photonEnery * 0.24801587301587297
+        lower = detectorEfficiency * 0.035  # TODO: Where does 0.035 come from?!
+        upper = detectorEfficiency * binning * 0.9
+        return lower, upper
+
+    @staticmethod
+    def id32Baseline(image, params):
+        """
+        Values beneath the baseline are cut off. The baseline is derived from
+        the image itself, by taking the mean of a dark part of the image
+        (default: the first 100 rows), and the dark current accumulated during
+        the exposure.
+
+        :param ndarray image: Two dimensional numpy.ndarray
+        :param dict params: Contains the exposure time in seconds 'preset',
+            the dark current in counts per pixel per second 'dc' and
+            optionally the number of dark rows 'baselineRows'
+        :returns: Baseline
+        :rtype: float
+        """
+        exposureTime = params.get('preset', ID32_DEFAULTS['preset'])
+        dc = params.get('dc', ID32_DEFAULTS['dc'])
+        baselineRows = int(params.get('baselineRows', 100))
+
+        offset = numpy.mean(image[:baselineRows, :]) + 1
+        return offset + exposureTime * dc
+
     @staticmethod
     def bandPassFilterID32(image, params):
         """
         The method implements a bandpass filter specific to the measurement
-        configuration of beamline ID32 at the ESRF.
+        configuration of beamline ID32 at the ESRF. Thresholds (c.f.
+        :func:`id32Thresholds`) passed as 'low' and 'high' are used instead
+        of being derived from the parameters. A 'baseline' passed is used
+        instead of :func:`id32Baseline`, e.g. when the image is processed in
+        parts (c.f. :py:mod:`Chunked`).
 
         :param ndarray image: Two dimensional numpy.ndarray
         :param dict params: Contains parameters specific to the ID32 detector
@@ -127,36 +247,23 @@ class Filter(ImageOp):
         """
         #
         # -- THRESHOLDS --
-        # The values for upper and lower thresholds depend on certain
-        # characteristics of the detector. The detector efficiency is a function
-        # of the photon energy and the number of electrons induced by a single
-        # photon.
-        #
         # binning: Hardware binning in the detector, default: 4
         # photon energy: guess what..
         #
-        photonEnery = params.get('energy', 931.942)  # From header...
-        binning = params.get('binning', 4)
-
-        # 1. / (3.6 * 1.12) = 0.248...
-        detectorEfficiency = photonEnery * 0.24801587301587297
-        lower = detectorEfficiency * 0.035  # TODO: Where does 0.035 come from?!
-        upper = detectorEfficiency * binning * 0.9
+        if 'low' in params and 'high' in params:
+            lower, upper = params['low'], params['high']
+        else:
+            lower, upper = Filter.id32Thresholds(params)
 
         #
         # -- BASELINE --
-        # Values beneath the baseline are cut off. The baseline is derived from
-        # the image itself, by taking the mean of a dark part of the image
-        # (here: the first 100 rows)
-        #
         # exposureTime: time to record an entire image in seconds
         # DC: counts per pixel per second
         #
-        exposureTime = params.get('preset', 300)
-        dc = params.get('dc', 0.00016)
-
-        offset = numpy.mean(image[:100, :]) + 1
-        baseline = offset + exposureTime * dc
+        if 'baseline' in params:
+            baseline = params['baseline']
+        else:
+            baseline = Filter.id32Baseline(image, params)
 
         # ??? Is the replace value really supposed to be 0 ???
         parameters = {
@@ -174,6 +281,57 @@ class Filter(ImageOp):
 
         return Filter.bandPassFilter(image, parameters)
 
+    @staticmethod
+    def groupID32(itemList, params=None):
+        """
+        Groups image items by their ID32 filter parameters (c.f.
+        :func:`id32Parameters`).
+
+        :param list itemList: List of ImageItems
+        :param dict params: Explicitly set parameters
+        :returns: Tuples (energy, binning, preset, dc) mapped to the lists of
+            indices of the items in itemList
+        :rtype: OrderedDict
+        """
+        groups = OrderedDict()
+        for idx, item in enumerate(itemList):
+            bound = Filter.id32Parameters(item, params)
+            key = tuple(bound[name] for name in
+                ['energy', 'binning', 'preset', 'dc'])
+            groups.setdefault(key, []).append(idx)
+        return groups
+
+    @staticmethod
+    def bandPassFilterID32Batch(itemList, params=None):
+        """
+        Applies :func:`bandPassFilterID32` to a list of image items. The
+        parameters of every image are read from its header, images with
+        identical parameters share the thresholds, which are computed once per
+        group.
+
+        :param list itemList: List of ImageItems
+        :param dict params: Parameters overriding the header values
+        :returns: Filtered images in the order of itemList
+        :rtype: list
+        """
+        result = [None] * len(itemList)
+        for key, indices in Filter.groupID32(itemList, params).items():
+            energy, binning, preset, dc = key
+            bound = {
+                'energy': energy,
+                'binning': binning,
+                'preset': preset,
+                'dc': dc
+            }
+            bound['low'], bound['high'] = Filter.id32Thresholds(bound)
+            if DEBUG >= 1:
+                print('Filter.bandPassFilterID32Batch -- %d image(s) with ' \
+                    'parameters %s' % (len(indices), str(key)))
+            for idx in indices:
+                result[idx] = Filter.bandPassFilterID32(itemList[idx].array,
+                    bound)
+        return result
+
 
 class Alignment(ImageOp):
     def __init__(self=None):
@@ -183,6 +341,27 @@ class Alignment(ImageOp):
             'fftAlignment': self.fftAlignment,
             'centerOfMassAlignment': self.centerOfMassAlignment
         }
+        self._params = {
+            'maxAlignment': {
+                'idx0': int,
+                'axis': int,
+                'scale': list
+            },
+            'fftAlignment': {
+                'idx0': int,
+                'axis': int,
+                'portion': float,
+                'minChannel': int,
+                'maxChannel': int,
+                'scale': list
+            },
+            'centerOfMassAlignment': {
+                'idx0': int,
+                'axis': int,
+                'portion': float,
+                'scale': list
+            }
+        }
 
     @staticmethod
     def maxAlignment(image, params):
@@ -590,6 +769,17 @@ class Integration(ImageOp):
             'axisSum': self.axisSum,
             'sliceAndSum': self.sliceAndSum
         }
+        self._params = {
+            'axisSum': {
+                'axis': int
+            },
+            'sliceAndSum': {
+                'binWidth': int,
+                'sumAxis': int,
+                'sliceAxis': int,
+                'mode': str
+            }
+        }
 
     @staticmethod
     def axisSum(image, params):
@@ -642,11 +832,24 @@ class Normalization(ImageOp):
         self._ops = {
             'zeroToOne': self.zeroToOne
         }
+        self._params = {
+            'zeroToOne': {
+                'min': float,
+                'max': float
+            }
+        }
 
     @staticmethod
     def zeroToOne(image, params):
-        offset = image.min()
-        maximum = image.max()
+        """
+        Scales the image to values between zero and one.
+
+        :param ndarray image: Two dimensional numpy.ndarray
+        :param dict params: May contain the known minimum 'min' and maximum
+            'max' of the image (c.f. :func:`Items.DataItem.statistics`)
+        """
+        offset = params['min'] if 'min' in params else image.min()
+        maximum = params['max'] if 'max' in params else image.max()
         normFactor = maximum - offset
 
         if DEBUG >= 1:
@@ -672,7 +875,24 @@ class Manipulation(ImageOp):
     def __init__(self):
         ImageOp.__init__(self)
         self._ops = {
-            'slice': self.slice
+            'slice': self.slice,
+            'skewAlongAxis': self.skewAlongAxis,
+            'blockMean': self.blockMean
+        }
+        self._params = {
+            'slice': {
+                'binWidth': int,
+                'axis': int,
+                'mode': str
+            },
+            'skewAlongAxis': {
+                'axis': int,
+                'shiftArray': list,
+                'oversampling': int
+            },
+            'blockMean': {
+                'factor': int
+            }
         }
 
     @staticmethod
@@ -782,6 +1002,30 @@ class Manipulation(ImageOp):
 
         return tmpList
 
+    @staticmethod
+    def blockMean(image, params):
+        """
+        Decimates an image by averaging blocks of factor x factor pixels.
+        Rows and columns that do not fill a complete block are discarded. The
+        values keep their unit, i.e. thresholds given in counts remain valid.
+        Possible parameters are
+
+        factor
+            edge length of the blocks (default: 4)
+
+        :param ndarray image: Two dimensional numpy.ndarray
+        :param dict params: Contains the parameter factor
+        :returns ndarray: Decimated image
+        """
+        factor = int(params.get('factor', 4))
+        nRows = image.shape[0] // factor
+        nCols = image.shape[1] // factor
+        if not (nRows and nCols):
+            raise ValueError('Manipulation.blockMean -- image of shape %s is '
+                'smaller than the block size %d' % (str(image.shape), factor))
+        cropped = image[:nRows * factor, :nCols * factor]
+        return cropped.reshape(nRows, factor, nCols, factor).mean(axis=(1, 3))
+
 
 class SlopeCorrection(object):
     __doc__ = """ImageOp class to determine and apply slope correction to images
@@ -911,8 +1155,7 @@ def run_test():
     return
 
     itemList = [child.item() for child in project['Images'].children]
-    filteredList = [Filter.bandPassFilterID32(item.array, {})
-        for item in itemList]
+    filteredList = Filter.bandPassFilterID32Batch(itemList)
     # polyList = [SlopeCorrection.slopeCorrection(arr, 64) for arr in filteredList]
     polyList = [SlopeCorrection.slopeCorrection(im, 128) for im in filteredList]
     correctedList = [SlopeCorrection.alignImage(im, func)
@@ -0,0 +1,532 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module implements a pipeline engine for the operations registered
+by the :py:class:`Operations.ImageOp` subclasses. A pipeline is described by
+a recipe, i.e. a list of nodes applying an operation to the output of another
+node::
+
+    {
+        "nodes": [
+            {"name": "filtered", "op": "bandpass",
+             "params": {"low": 8.0, "high": 800.0, "offset": 114.0}},
+            {"name": "shifts", "op": "maxAlignment", "params": {"axis": 0}},
+            {"name": "aligned", "op": "skewAlongAxis", "input": "filtered",
+             "params": {"axis": 0, "shiftArray": {"$ref": "shifts"}}},
+            {"name": "spectrum", "op": "axisSum", "params": {"axis": 1}}
+        ],
+        "outputs": ["spectrum"]
+    }
+
+A node processes the output of the previous node unless 'input' names
+another node, the first node processes the image ('image'). Parameters of the
+form {"$ref": name} are replaced by the output of the named node. Nodes may
+only refer to nodes defined before them, so the order of the nodes is an
+order of execution. The output of a node is released as soon as its last
+consumer has run, unless it is an output of the recipe.
+
+Recipes are saved as JSON files, reprocessing images with a saved recipe in
+a pool of worker processes is a single call to :func:`reprocess`. Results of
+the nodes can be kept in a :py:class:`Cache.ResultCache`, so unchanged images
+are not processed again. The module does not depend on Qt."""
+
+import json
+import numbers
+import numpy
+from collections import OrderedDict
+
+from RixsTool.Operations import Filter, Alignment, Interpolation, \
+    Integration, Normalization, Manipulation
+from RixsTool.Batch import BatchProcessor
+from RixsTool.Cache import ResultCache, arrayDigest
+from RixsTool.Utils import plain
+
+DEBUG = 0
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    # Python 3
+    STRING_TYPES = (str,)
+
+#
+# SOURCE: Name under which nodes refer to the image processed
+#
+SOURCE = 'image'
+
+_registry = None
+
+
+def registry():
+    """
+    :returns: Operation name -> function and accepted parameters, collected
+        from the _ops and _params of the ImageOp subclasses
+    :rtype: dict
+    """
+    global _registry
+    if _registry is None:
+        _registry = {}
+        for cls in [Filter, Alignment, Interpolation, Integration,
+                    Normalization, Manipulation]:
+            instance = cls()
+            for name, function in instance._ops.items():
+                if name not in instance._params:
+                    # Not available in pipelines, e.g. not implemented
+                    continue
+                if name in _registry:
+                    raise ValueError("registry -- Operation '%s' registered "
+                        "by more than one ImageOp" % name)
+                _registry[name] = (function, instance._params[name])
+    return _registry
+
+
+def _isReference(value):
+    return isinstance(value, dict) and list(value.keys()) == ['$ref']
+
+
+def _checkType(value, kind):
+    """
+    :returns: True if value is of parameter type kind
+    :rtype: bool
+    """
+    if isinstance(value, (bool, numpy.bool_)):
+        return kind is bool
+    if kind is float:
+        return isinstance(value, numbers.Real)
+    if kind is int:
+        return isinstance(value, numbers.Integral)
+    if kind is str:
+        return isinstance(value, STRING_TYPES)
+    if kind is list:
+        return isinstance(value, (list, tuple, numpy.ndarray))
+    return isinstance(value, kind)
+
+
+class Node(object):
+    __doc__ = """Application of an operation in a recipe.
+
+     .. py:attribute:: name
+
+        Name by which other nodes refer to the output
+
+     .. py:attribute:: op
+
+        Name of the operation, c.f. :func:`registry`
+
+     .. py:attribute:: params
+
+        Parameters passed to the operation, may contain references
+
+     .. py:attribute:: input
+
+        Name of the node providing the image, None for the previous node"""
+
+    def __init__(self, name, op, params=None, input=None):
+        self.name = name
+        self.op = op
+        self.params = dict(params) if params else {}
+        self.input = input
+
+    def __repr__(self):
+        return 'Node(%s, %s, %s, %s)' % (repr(self.name), repr(self.op),
+            str(self.params), repr(self.input))
+
+    def references(self):
+        """
+        :returns: Names of the nodes referenced by the parameters
+        :rtype: list
+        """
+        return [value['$ref'] for value in self.params.values()
+            if _isReference(value)]
+
+    def toDict(self):
+        ddict = {
+            'name': self.name,
+            'op': self.op,
+            'params': plain(self.params)
+        }
+        if self.input is not None:
+            ddict['input'] = self.input
+        return ddict
+
+
+class Recipe(object):
+    __doc__ = """Directed acyclic graph of operations, c.f. module
+    documentation. Recipes hold names and parameters only, i.e. they can be
+    pickled and sent to worker processes.
+
+     .. py:attribute:: nodes
+
+        List of :py:class:`Node` instances in order of execution
+
+     .. py:attribute:: outputs
+
+        Names of the nodes whose outputs are returned, default: the last
+        node"""
+
+    def __init__(self, nodes=None, outputs=None):
+        """
+        :param list nodes: Nodes of the recipe
+        :param list outputs: Names of the nodes whose output is returned
+        """
+        self.nodes = list(nodes) if nodes else []
+        self.outputs = list(outputs) if outputs else []
+
+    def __repr__(self):
+        return 'Recipe(%s, %s)' % (str(self.nodes), str(self.outputs))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, op, params=None, input=None, name=None):
+        """
+        Appends a node to the recipe.
+
+        :param str op: Name of the operation, c.f. :func:`registry`
+        :param dict params: Parameters of the operation
+        :param str input: Name of the node providing the image, default: the
+            previous node
+        :param str name: Name of the node, default: the name of the operation
+            followed by the position of the node
+        :returns: The recipe, i.e. calls can be chained
+        :rtype: Recipe
+        """
+        if name is None:
+            name = '%s%d' % (op, len(self.nodes))
+        self.nodes.append(Node(name, op, params, input))
+        return self
+
+    def outputNames(self):
+        """
+        :returns: Names of the nodes whose output is returned
+        :rtype: list
+        """
+        if self.outputs:
+            return list(self.outputs)
+        if self.nodes:
+            return [self.nodes[-1].name]
+        return []
+
+    def inputName(self, idx):
+        """
+        :param int idx: Position of a node
+        :returns: Name of the node providing the image of the node at idx
+        :rtype: str
+        """
+        node = self.nodes[idx]
+        if node.input is not None:
+            return node.input
+        return SOURCE if idx == 0 else self.nodes[idx - 1].name
+
+    def validate(self):
+        """
+        Checks that all operations are known, all parameters are accepted by
+        their operation and of the right type and all references refer to
+        preceding nodes.
+
+        :raises ValueError: if the recipe is invalid
+        """
+        if not self.nodes:
+            raise ValueError('Recipe.validate -- Recipe contains no nodes')
+        ops = registry()
+        defined = set([SOURCE])
+        for idx, node in enumerate(self.nodes):
+            if node.name in defined:
+                raise ValueError("Recipe.validate -- Node name '%s' is used "
+                    "more than once" % node.name)
+            if node.op not in ops:
+                raise ValueError("Recipe.validate -- Node '%s': unknown "
+                    "operation '%s'" % (node.name, node.op))
+            schema = ops[node.op][1]
+            for key, value in node.params.items():
+                if key not in schema:
+                    raise ValueError("Recipe.validate -- Node '%s': operation "
+                        "'%s' does not accept parameter '%s', possible "
+                        "parameters: %s" % (node.name, node.op, key,
+                        ', '.join(sorted(schema.keys()))))
+                if _isReference(value):
+                    continue
+                if not _checkType(value, schema[key]):
+                    raise ValueError("Recipe.validate -- Node '%s': "
+                        "parameter '%s' must be of type %s, got %s" %
+                        (node.name, key, schema[key].__name__,
+                        repr(value)))
+            for reference in [self.inputName(idx)] + node.references():
+                if reference not in defined:
+                    raise ValueError("Recipe.validate -- Node '%s' refers to "
+                        "'%s', which is not defined before it" %
+                        (node.name, reference))
+            defined.add(node.name)
+        for name in self.outputNames():
+            if name not in defined or name == SOURCE:
+                raise ValueError("Recipe.validate -- Unknown output '%s'" %
+                    name)
+
+    def lastUses(self):
+        """
+        :returns: Node name -> position of the last node consuming its
+            output
+        :rtype: dict
+        """
+        result = {}
+        for idx, node in enumerate(self.nodes):
+            for reference in [self.inputName(idx)] + node.references():
+                result[reference] = idx
+        return result
+
+    def digests(self, source):
+        """
+        :param source: Image or its digest, c.f.
+            :func:`Cache.ResultCache.key`
+        :returns: Node name -> cache key of its output. The key of a node
+            depends on the keys of the nodes it refers to, i.e. on all
+            preceding operations.
+        :rtype: dict
+        """
+        if not isinstance(source, str):
+            source = arrayDigest(source)
+        keys = {SOURCE: source}
+        for idx, node in enumerate(self.nodes):
+            params = {}
+            for key, value in node.params.items():
+                if _isReference(value):
+                    value = {'$ref': keys[value['$ref']]}
+                params[key] = value
+            keys[node.name] = ResultCache.key(node.op, params,
+                keys[self.inputName(idx)])
+        return keys
+
+    def run(self, image, cache=None, source=None):
+        """
+        Processes one image. Outputs of nodes are released once they are no
+        longer needed, i.e. memory is reused by the following nodes.
+
+        If a cache is given, the outputs of all nodes are looked up there
+        first, and nodes only needed by cached outputs are not run at all.
+        The outputs computed are added to the cache.
+
+        :param ndarray image: Two dimensional numpy.ndarray
+        :param ResultCache cache: Cache of the results, default: None
+        :param str source: Digest identifying the image in the cache (c.f.
+            :func:`Cache.ResultCache.sourceDigest`), default: hash of the
+            image content
+        :returns: Output name -> result
+        :rtype: OrderedDict
+        :raises ValueError: if the recipe is invalid
+        """
+        self.validate()
+        ops = registry()
+        outputs = self.outputNames()
+        lastUses = self.lastUses()
+        results = {SOURCE: image}
+        needed = set(node.name for node in self.nodes)
+        if cache is not None:
+            digests = self.digests(image if source is None else source)
+            needed = set(outputs)
+            for idx in reversed(range(len(self.nodes))):
+                node = self.nodes[idx]
+                if node.name not in needed:
+                    continue
+                cached = cache.get(digests[node.name])
+                if cached is not None:
+                    results[node.name] = cached
+                else:
+                    needed.update([self.inputName(idx)] + node.references())
+        for idx, node in enumerate(self.nodes):
+            if node.name in needed and node.name not in results:
+                params = {}
+                for key, value in node.params.items():
+                    if _isReference(value):
+                        value = results[value['$ref']]
+                    params[key] = value
+                function = ops[node.op][0]
+                result = function(results[self.inputName(idx)], params)
+                if isinstance(result, dict) and 'image' in result:
+                    # c.f. Normalization.zeroToOne
+                    result = result['image']
+                results[node.name] = result
+                if cache is not None:
+                    cache.put(digests[node.name], result)
+            for name, last in lastUses.items():
+                if last == idx and name not in outputs:
+                    if DEBUG >= 1:
+                        print("Recipe.run -- releasing '%s'" % name)
+                    results.pop(name, None)
+        return OrderedDict((name, results[name]) for name in outputs)
+
+    __call__ = run
+
+    def imap(self, images, workers=None, cache=None, shared=None):
+        """
+        Processes images in a pool of worker processes (c.f.
+        :py:class:`Batch.BatchProcessor`).
+
+        :param list images: Numpy arrays or items providing them
+        :param int workers: Number of processes, default: number of CPUs
+        :param ResultCache cache: Cache of the results, default: None. Items
+            read from files are identified by the file, c.f.
+            :func:`Cache.ResultCache.sourceDigest`
+        :param SharedArrayManager shared: Owner of the shared memory blocks
+            transporting images and results, default: None
+        :returns: Generator of the results of :func:`run` in the order of
+            images
+        :raises ValueError: if the recipe is invalid
+        """
+        self.validate()
+        images = list(images)
+        processor = BatchProcessor(runRecipe, workers, shared)
+        for idx, result in processor.imap(self.jobs(images, cache),
+                len(images)):
+            yield result
+        if cache is not None:
+            # Pick up the files written by the worker processes
+            cache.refresh()
+            cache.enforce()
+
+    def jobs(self, images, cache=None):
+        """
+        :returns: Generator of the jobs of :func:`runRecipe`
+        """
+        for idx, image in enumerate(images):
+            source = None
+            if cache is not None:
+                source = ResultCache.sourceDigest(image)
+            yield idx, self, getattr(image, 'array', image), cache, source
+
+    def map(self, images, workers=None, cache=None, shared=None):
+        """
+        :param list images: Numpy arrays or items providing them
+        :param int workers: Number of processes, default: number of CPUs. A
+            single worker processes the images in the calling process.
+        :param ResultCache cache: Cache of the results, default: None
+        :param SharedArrayManager shared: Owner of the shared memory blocks
+            transporting images and results, default: None
+        :returns: Results of :func:`run` in the order of images
+        :rtype: list
+        :raises ValueError: if the recipe is invalid
+        """
+        if workers == 1:
+            return [runRecipe(job)[1] for job in self.jobs(images, cache)]
+        return list(self.imap(images, workers, cache, shared))
+
+    def toDict(self):
+        """
+        :returns: JSON serializable description, c.f. module documentation
+        :rtype: dict
+        """
+        ddict = {'nodes': [node.toDict() for node in self.nodes]}
+        if self.outputs:
+            ddict['outputs'] = list(self.outputs)
+        return ddict
+
+    @staticmethod
+    def fromDict(ddict):
+        """
+        :param dict ddict: Description, c.f. module documentation
+        :rtype: Recipe
+        :raises ValueError: if the description is malformed or invalid
+        """
+        nodes = ddict.get('nodes')
+        if not isinstance(nodes, list):
+            raise ValueError("Recipe.fromDict -- 'nodes' must be a list")
+        recipe = Recipe(outputs=ddict.get('outputs'))
+        for description in nodes:
+            if not isinstance(description, dict) or 'op' not in description:
+                raise ValueError('Recipe.fromDict -- Node description must be '
+                    "a dictionary containing 'op', got %s" %
+                    repr(description))
+            params = description.get('params', {})
+            if not isinstance(params, dict):
+                raise ValueError("Recipe.fromDict -- Parameters of node '%s' "
+                    "must be a dictionary" % description.get('name'))
+            recipe.add(description['op'], params, description.get('input'),
+                description.get('name'))
+        recipe.validate()
+        return recipe
+
+    def toJSON(self):
+        """
+        :rtype: str
+        """
+        return json.dumps(self.toDict(), indent=4, sort_keys=True)
+
+    @staticmethod
+    def fromJSON(text):
+        """
+        :param str text: JSON description
+        :rtype: Recipe
+        :raises ValueError: if the text is not valid JSON or the recipe is
+            invalid
+        """
+        return Recipe.fromDict(json.loads(text))
+
+    def save(self, fileName):
+        """
+        :param str fileName: JSON file to write
+        :raises ValueError: if the recipe is invalid
+        """
+        self.validate()
+        with open(fileName, 'w') as fileHandle:
+            fileHandle.write(self.toJSON())
+
+    @staticmethod
+    def load(fileName):
+        """
+        :param str fileName: JSON file written by :func:`save`
+        :rtype: Recipe
+        :raises IOError: if the file can not be read
+        :raises ValueError: if the file is not valid JSON or the recipe is
+            invalid
+        """
+        with open(fileName, 'r') as fileHandle:
+            return Recipe.fromJSON(fileHandle.read())
+
+
+def runRecipe(job):
+    """
+    Worker function of :func:`Recipe.imap`.
+
+    :param tuple job: Index, recipe, image, cache and digest of the image
+    :returns: Index and result of :func:`Recipe.run`
+    :rtype: tuple
+    """
+    idx, recipe, image, cache, source = job
+    return idx, recipe.run(image, cache, source)
+
+
+def reprocess(fileName, images, workers=None, cache=None):
+    """
+    Processes images with a saved recipe.
+
+    :param str fileName: JSON file written by :func:`Recipe.save`
+    :param list images: Numpy arrays or items providing them
+    :param int workers: Number of processes, default: number of CPUs
+    :param ResultCache cache: Cache of the results, default: None
+    :returns: Results of :func:`Recipe.run` in the order of images
+    :rtype: list
+    """
+    return Recipe.load(fileName).map(images, workers, cache)
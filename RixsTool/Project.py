@@ -30,11 +30,20 @@ __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
 from os.path import abspath as OsAbsPath
 from os.path import splitext as OsPathSplitext
 from os.path import join as OsPathJoin
+from os.path import split as OsPathSplit
+from os.path import realpath as OsPathRealpath
 from os import walk as OsWalk
+from fnmatch import fnmatch as FnMatch
+from collections import OrderedDict
+from weakref import ref as WeakRef
 from RixsTool.ItemContainer import ItemContainer
 
-from RixsTool.IO import IODict
+from RixsTool.IO import IODict, fileFingerprint, fileDigest
 from RixsTool.Items import SpecItem, ScanItem, ImageItem, StackItem
+from RixsTool.Metadata import MetadataTable
+from RixsTool.Memory import MemoryAccountant
+from RixsTool.SharedArrays import SharedArrayManager
+from RixsTool import HDF5Backend
 
 DEBUG = 0
 
@@ -52,7 +61,21 @@ class RixsProject(object):
     the  dimensionality of their data. Two dimensional input for example is
     treated as an image.
 
-    **TODO**: Implement HDF Backend..
+    Projects can be stored in and restored from HDF5 files (c.f.
+    :func:`saveHDF5`, :func:`loadHDF5`).
+
+    The acquisition parameters found in the item headers are collected in
+    :py:attr:`metadata` when an item is added. Items can be selected by their
+    parameters using :func:`select` and :func:`groupBy`.
+
+     .. py:attribute:: metadata
+
+        :py:class:`Metadata.MetadataTable` with one row per item
+
+     .. py:attribute:: memory
+
+        :py:class:`Memory.MemoryAccountant` limiting the memory used by the
+        item arrays
     """
 
     def __init__(self):
@@ -62,9 +85,32 @@ class RixsProject(object):
         self.inputReaders = IODict.inputReaderDict()
 
         #
-        # Identifier dict
+        # Container dict, maps labels to the containers in the tree
+        #
+        self.__containerDict = {}
+
+        #
+        # Acquisition parameters of the items
+        #
+        self.metadata = MetadataTable()
+
+        #
+        # Memory used by the item arrays
         #
-        self.__idDict = {}
+        self.memory = MemoryAccountant()
+
+        #
+        # Shared memory blocks sending item arrays to worker processes
+        #
+        self.shared = SharedArrayManager()
+
+        #
+        # Content fingerprints of the files read with deduplication: maps
+        # fingerprints to lists of (file name, weak references to the items)
+        # and file names to the hash of their whole content.
+        #
+        self.__fingerprints = {}
+        self.__digests = {}
 
         #
         # Data tree
@@ -78,19 +124,17 @@ class RixsProject(object):
         if DEBUG >= 1:
             print('RixsProject.__init__ -- projectRoot.childCount: %d' %
                 self.projectRoot.childCount())
-            print('RixsProject.__init__ -- projectRoot.__idDict: %s' %
-                str(self.__idDict))
+            print('RixsProject.__init__ -- projectRoot.__containerDict: %s' %
+                str(self.__containerDict))
 
     def __getitem__(self, key):
-        result = None
-        identifier = self.__idDict[key]
-        for container in self._traverseDFS(self.projectRoot):
-            if container.getID() == identifier:
-                result = container
-                break
-        if not result:
-            raise KeyError()
-        return result
+        """
+        :param str key: Label of the container
+        :returns: Container with the given label
+        :rtype: ItemContainer
+        :raises KeyError: if the label is not present in the project
+        """
+        return self.__containerDict[key]
 
     def __contains__(self, item):
         """
@@ -106,25 +150,33 @@ class RixsProject(object):
             an ItemContainer
         """
         if isinstance(item, str):
-            llist = self.__idDict.keys()
+            return item in self.__containerDict
         elif isinstance(item, ItemContainer):
-            item = item.getID()
-            llist = self.__idDict.values()
+            container = self.__containerDict.get(item.label)
+            return container is not None and container == item
         else:
             raise ValueError("RixsProject.__contains__ -- Argument must be " \
                 "of type string or ItemContainer")
-        return item in llist
 
     def getIdDict(self):
         # TODO: Function for debugging purposes
-        return self.__idDict
+        return dict((key, container.getID()) for key, container in
+            self.__containerDict.items())
 
     @staticmethod
     def _traverseDFS(root):
-        yield root
-        for child in root.children:
-            for container in RixsProject._traverseDFS(child):
-                yield container
+        """
+        Iterates over the subtree below root in depth first pre-order. The
+        traversal uses an explicit stack, so deep trees do not hit the
+        recursion limit.
+
+        :param ItemContainer root: Container where the traversal starts
+        """
+        stack = [root]
+        while stack:
+            container = stack.pop()
+            yield container
+            stack.extend(reversed(container.children))
 
     def groupCount(self):
         return self.projectRoot.childCount()
@@ -153,14 +205,43 @@ class RixsProject(object):
         """
         raise NotImplementedError('RixsProject.spectrum -- ..to be implemented')
 
-    def addItem(self, item):
+    def _defaultNode(self, item):
+        if isinstance(item, ScanItem) or isinstance(item, SpecItem):
+            return self.projectRoot.children[0]
+        elif isinstance(item, ImageItem):
+            return self.projectRoot.children[1]
+        elif isinstance(item, StackItem):
+            return self.projectRoot.children[2]
+        raise TypeError(
+            "RixsProject.addItem -- unknown item type '%s'" % type(item))
+
+    def _insertChildren(self, node, containerList):
+        """
+        Appends containers to the children of node. Items are added to and
+        removed from the tree through this method and :func:`_removeChildren`,
+        subclasses (c.f. :py:class:`Models.ProjectModel`) override them to
+        notify views once per parent.
+
+        :param ItemContainer node: Parent of the new containers
+        :param list containerList: Containers to be appended
+        """
+        node.addChildren(containerList)
+
+    def _removeChildren(self, node, rowList):
+        """
+        :param ItemContainer node: Parent of the containers to be removed
+        :param list rowList: Rows of the containers to be removed
+        """
+        node.removeChildRows(rowList)
+
+    def addItem(self, item, node=None):
         """
         Item is wrapped in :class:`datahandling.ItemContainer` and inserted into
         the tree. The insertion node depdends on the type of item.
 
-        **TODO:** Add remove functionality here (c.f. RixsTool.Models)
-
         :param DataItem item: Item to be inserted into the project tree
+        :param ItemContainer node: Parent for the new container. Defaults to
+            None, the parent in that case depends on the type of item.
         :returns: Container of item
         :rtype: ItemContainer
         :raises TypeError: if the item type is unknown
@@ -168,25 +249,50 @@ class RixsProject(object):
         """
         if DEBUG >= 1:
             print('RixsProject.addItem -- called')
-        if item.key() in self.__idDict:
-            raise ValueError("RixsProject.addItem -- Item key '%s' already " \
-                "present" % item.key())
-        if isinstance(item, ScanItem) or isinstance(item, SpecItem):
-            node = self.projectRoot.children[0]
-        elif isinstance(item, ImageItem):
-            node = self.projectRoot.children[1]
-        elif isinstance(item, StackItem):
-            node = self.projectRoot.children[2]
-        else:
-            raise TypeError(
-                "RixsProject.addItem -- unknown item type '%s'" % type(item))
-        container = ItemContainer(
-            item=item,
-            parent=node
-        )
-        node.addChildren([container])
-        self.__idDict[item.key()] = container.getID()
-        return container
+        return self.addItems([item], node)[0]
+
+    def addItems(self, itemList, node=None, skipDuplicates=False):
+        """
+        Inserts a list of items into the tree in one pass. The containers are
+        appended to their parents group by group, i.e. every parent is
+        modified only once.
+
+        :param list itemList: Items to be inserted into the project tree
+        :param ItemContainer node: Parent for the new containers. Defaults to
+            None, the parent in that case depends on the type of each item.
+        :param bool skipDuplicates: Items whose key is already present are
+            silently skipped instead of raising a ValueError
+        :returns: Containers of the inserted items
+        :rtype: list
+        :raises TypeError: if an item type is unknown
+        :raises ValueError: if an item.key() is already present
+        """
+        groups = OrderedDict()
+        keys = set()
+        for item in itemList:
+            key = item.key()
+            if key in self.__containerDict or key in keys:
+                if skipDuplicates:
+                    continue
+                raise ValueError("RixsProject.addItem -- Item key '%s' " \
+                    "already present" % key)
+            parent = node if node is not None else self._defaultNode(item)
+            container = ItemContainer(
+                item=item,
+                parent=parent
+            )
+            groups.setdefault(parent, []).append(container)
+            keys.add(key)
+        result = []
+        for parent, containerList in groups.items():
+            self._insertChildren(parent, containerList)
+            for container in containerList:
+                self.__containerDict[container.label] = container
+                self.metadata.addRow(container.label, container.item().header)
+                self.memory.register(container.item())
+            result += containerList
+        self.memory.enforce()
+        return result
 
     def addGroup(self, label, node=None):
         """
@@ -201,7 +307,7 @@ class RixsProject(object):
         """
         if DEBUG >= 1:
             print('RixsProject.addItem -- called')
-        if label in self.__idDict:
+        if label in self.__containerDict:
             raise ValueError(
                 "RixsProject.addItem -- Item key '%s' already present" % label)
         if not node:
@@ -212,28 +318,158 @@ class RixsProject(object):
             label=label
         )
         node.addChildren([container])
-        self.__idDict[container.label] = container.getID()
+        self.__containerDict[container.label] = container
         return container
 
     def removeContainer(self, label):
-        container = self.__getitem__(label)
-        if container.childCount():
-            if DEBUG >= 1:
-                print('RixsProject.removeContainer -- Has children')
-            for child in container.children:
-                self.removeContainer(child.label)
-        parentContainer = container.parent
-        idx = container.childNumber()
-        del(parentContainer.children[idx])
-        del(self.__idDict[label])
+        """
+        Removes the container and its whole subtree from the project.
 
-    def read(self, fileName):
+        :param str label: Label of the container
+        :raises KeyError: if the label is not present in the project
+        """
+        self.removeContainers([label])
+
+    def removeContainers(self, labelList):
+        """
+        Removes a list of containers including their subtrees from the
+        project. Containers that lie in the subtree of another container of
+        the list are removed together with the latter. Every parent is
+        modified only once.
+
+        :param list labelList: Labels of the containers
+        :raises KeyError: if a label is not present in the project
+        """
+        containers = set(self.__getitem__(label) for label in labelList)
+        groups = OrderedDict()
+        for label in labelList:
+            container = self.__getitem__(label)
+            ancestor = container.parent
+            while ancestor is not None and ancestor not in containers:
+                ancestor = ancestor.parent
+            if ancestor is not None:
+                # Removed with its ancestor
+                continue
+            groups.setdefault(container.parent, set()).add(container)
+        for parent, children in groups.items():
+            for child in children:
+                if DEBUG >= 1 and child.childCount():
+                    print('RixsProject.removeContainers -- Has children')
+                for descendant in self._traverseDFS(child):
+                    if self.__containerDict.get(descendant.label) is \
+                            descendant:
+                        del(self.__containerDict[descendant.label])
+                        self.metadata.removeRow(descendant.label)
+                        self.memory.unregister(descendant.label)
+            self._removeChildren(parent,
+                sorted(child.childNumber() for child in children))
+
+    def select(self, **criteria):
+        """
+        Selects items by their acquisition parameters, e.g.
+
+        >>> project.select(energy=(930., 935.), preset=300)
+
+        Ranges are given as tuples, sets of values as lists, single values
+        are compared for equality (c.f. :func:`Metadata.MetadataTable.mask`).
+
+        :returns: Matching items
+        :rtype: list
+        :raises KeyError: if a parameter is unknown
+        """
+        return [self.__containerDict[key].item() for key in
+            self.metadata.select(**criteria)]
+
+    def groupBy(self, name, decimals=None, **criteria):
+        """
+        Groups the items by an acquisition parameter, e.g. the incident
+        energy rounded to two decimals:
+
+        >>> project.groupBy('energy', 2)
+
+        :param str name: Parameter name
+        :param int decimals: Number of decimals the values are rounded to
+        :param criteria: Restrict the grouping to matching items, c.f.
+            :func:`select`
+        :returns: Parameter values mapped to lists of items
+        :rtype: OrderedDict
+        :raises KeyError: if a parameter is unknown
+        """
+        groups = self.metadata.groupBy(name, decimals, **criteria)
+        for value, keys in groups.items():
+            groups[value] = [self.__containerDict[key].item() for key in keys]
+        return groups
+
+    def saveHDF5(self, fileName, compression='lzf'):
+        """
+        Stores the whole project tree in a HDF5 file. Every data item becomes
+        a chunked dataset.
+
+        :param str fileName: Name of the HDF5 file
+        :param str compression: Compression filter for the datasets, e.g.
+            'lzf' (default) or 'gzip'. None stores uncompressed data.
+        """
+        HDF5Backend.saveProject(self, fileName, compression)
+
+    def loadHDF5(self, fileName):
+        """
+        Adds the tree stored in a HDF5 file to the project. Datasets are only
+        read when the array of an item is accessed.
+
+        :param str fileName: Name of the HDF5 file
+        :raises ValueError: if an item key is already present
+        """
+        HDF5Backend.loadProject(self, fileName)
+
+    def close(self):
+        """
+        Removes the scratch files and the shared memory blocks of the
+        project. Spilled items that have not been paged in lose their data.
+        """
+        self.memory.close()
+        self.shared.close()
+
+    def _digest(self, fileName):
+        if fileName not in self.__digests:
+            self.__digests[fileName] = fileDigest(fileName)
+        return self.__digests[fileName]
+
+    def _findOriginal(self, fingerprint, fileName):
+        """
+        :returns: File name and items of a previously read file with the same
+            content, (None, None) if there is none
+        :rtype: tuple
+        """
+        candidates = self.__fingerprints.get(fingerprint, [])
+        for candidate in list(candidates):
+            originalName, references = candidate
+            itemList = [reference() for reference in references]
+            if None in itemList:
+                # Items of the original have been discarded
+                candidates.remove(candidate)
+                continue
+            if OsPathRealpath(originalName) == OsPathRealpath(fileName) or \
+                    self._digest(originalName) == self._digest(fileName):
+                return originalName, itemList
+        return None, None
+
+    def read(self, fileName, deduplicate=False):
         """
         RixsProject stores a number of different reader for all sorts of file
         formats. The file stored under file name is registered with a matching
         reader.
 
+        With deduplication, the content of the file is compared to the files
+        read before. The items of a file with known content are duplicates
+        (c.f. :func:`Items.DataItem.duplicate`) that share the arrays of the
+        original items, the file itself is not read. Files are compared by a
+        fingerprint of their header and sampled blocks
+        (c.f. :func:`IO.fileFingerprint`), files with equal fingerprints by a
+        hash of their whole content.
+
         :param str fileName: File name including path to file
+        :param bool deduplicate: Compare the content to previously read files.
+            Default: False
         :returns: List of raw data wrapped in
             :class:`datahandling.ItemContainer`
         :rtype: list
@@ -249,15 +485,43 @@ class RixsProject(object):
         else:
             raise TypeError(
                 "RixsProject.read -- Unknown file type '%s'" % fileType)
+        if not deduplicate:
+            return reader.itemize(fileName)
+
+        fingerprint = fileFingerprint(fileName)
+        originalName, originalItems = self._findOriginal(fingerprint, fileName)
+        if originalName is not None:
+            if DEBUG >= 1:
+                print("RixsProject.read -- '%s' is a duplicate of '%s'" %
+                    (fileName, originalName))
+            oldPrefix = OsPathSplit(originalName)[1]
+            newPrefix = OsPathSplit(fileName)[1]
+            itemList = []
+            for item in originalItems:
+                key = item.key()
+                if key.startswith(oldPrefix):
+                    key = newPrefix + key[len(oldPrefix):]
+                else:
+                    key = '%s %s' % (newPrefix, key)
+                itemList += [item.duplicate(key, fileName)]
+            return itemList
+
         itemList = reader.itemize(fileName)
+        self.__fingerprints.setdefault(fingerprint, []).append(
+            (fileName, [WeakRef(item) for item in itemList]))
         return itemList
 
-    def crawl(self, directory):
+    def crawl(self, directory, deduplicate=False, pattern=None):
         """
         Reads every file of known file type contained in directory and its
         subdirectories and adds it to the project.
 
         :param str directory: Root directory for the crawler to start
+        :param bool deduplicate: Files with identical content are read once,
+            c.f. :func:`read`. Default: False
+        :param str pattern: Only files whose name matches the shell pattern
+            are read, e.g. '*.edf'. Default: None, i.e. all files. Files
+            that can not be parsed are skipped.
         """
         walk = OsWalk(OsAbsPath(directory))
         if DEBUG >= 1:
@@ -266,14 +530,22 @@ class RixsProject(object):
             if DEBUG >= 1:
                 print('RixsProject.crawl -- current path: %s' % path)
             for ffile in files:
+                if pattern is not None and not FnMatch(ffile, pattern):
+                    continue
                 absName = OsPathJoin(path, ffile)
                 try:
-                    itemList = self.read(absName)
+                    itemList = self.read(absName, deduplicate)
                 except TypeError:
                     if DEBUG >= 1:
                         print("RixsProject.crawl -- unknown filetype '%s'" %
                             absName)
                     continue
+                except ValueError as error:
+                    # Malformed file, the others are read nevertheless
+                    if DEBUG >= 1:
+                        print("RixsProject.crawl -- skipping '%s': %s" %
+                            (absName, error))
+                    continue
                 for item in itemList:
                     if DEBUG >= 1:
                         print("RixsProject.crawl -- adding Item '%s'" %
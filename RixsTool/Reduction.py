@@ -0,0 +1,394 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module implements the batch reduction of the command line tool
+rixstool-batch. All images found in a directory are processed by a pipeline
+in a pool of worker processes and the resulting spectra are written to
+files. The module does not import Qt, i.e. it runs without a display.
+
+The processing is described in a JSON file, either as a list of steps::
+
+    {
+        "steps": [
+            {"name": "bandpassID32", "params": {"dc": 0.00016}},
+            {"name": "alignment", "params": {"a": -5.25, "b": 0.18877,
+                                             "c": 0.0, "oversamp": 2}},
+            {"name": "sum", "params": {"axis": "columns"}}
+        ],
+        "energyScale": {"calibration": 0.01, "zero": 0.0}
+    }
+
+Step names refer to :py:attr:`Steps.STEPS`, missing parameters take their
+default values. Parameters of the 'bandpassID32' step that are not given are
+read from the header of every image (c.f.
+:func:`Operations.Filter.id32Parameters`). A 'sum' step is appended if the
+pipeline does not end with one.
+
+or as a recipe of image operations (c.f. :py:mod:`Pipeline`) whose single
+output is the spectrum::
+
+    {
+        "nodes": [
+            {"name": "filtered", "op": "bandpass",
+             "params": {"low": 8.0, "high": 800.0, "offset": 114.0}},
+            {"name": "spectrum", "op": "axisSum", "params": {"axis": 1}}
+        ],
+        "energyScale": {"calibration": 0.01, "zero": 0.0}
+    }
+
+Files saved by :func:`Pipeline.Recipe.save` can be used as they are. The
+optional energy scale maps the pixel scale x of the spectra to
+calibration * x + zero."""
+
+import argparse
+import json
+import numpy
+import sys
+import time
+
+from RixsTool.Project import RixsProject
+from RixsTool.Items import ImageItem, StackItem, ScanItem
+from RixsTool.Operations import Filter
+from RixsTool.Steps import createStep, SumStep, BandPassID32Step
+from RixsTool.Batch import BatchProcessor, exportSpectrum
+from RixsTool.Export import SpectraExporter
+from RixsTool.Pipeline import Recipe
+
+DEBUG = 0
+
+
+def _energyScale(ddict):
+    """
+    :param dict ddict: Description of the processing, c.f. module
+        documentation
+    :returns: Dictionary containing 'calibration' and 'zero' or None
+    :rtype: dict
+    """
+    energyScale = ddict.get('energyScale')
+    if energyScale is None:
+        return None
+    return {
+        'calibration': float(energyScale.get('calibration', 1.)),
+        'zero': float(energyScale.get('zero', 0.))
+    }
+
+
+def _applyEnergyScale(energyScale, pixelScale):
+    if energyScale is None:
+        return pixelScale
+    return energyScale['calibration'] * pixelScale + energyScale['zero']
+
+
+class ReductionPlan(object):
+    __doc__ = """Processing steps and energy scale read from a description
+    given as list of steps."""
+
+    def __init__(self, steps, energyScale=None, explicit=None):
+        """
+        :param list steps: Processing steps, c.f. :py:mod:`Steps`
+        :param dict energyScale: Contains 'calibration' and 'zero' or is None
+        :param list explicit: Explicitly given parameters of every step.
+            Parameters of ID32 filter steps missing here are read from the
+            image headers. Default: None, i.e. the headers are not used
+        """
+        steps = list(steps)
+        if explicit is None:
+            explicit = [step.parameters() for step in steps]
+        if not steps or not isinstance(steps[-1], SumStep):
+            steps.append(SumStep())
+            explicit.append(steps[-1].parameters())
+        self.steps = steps
+        self.explicit = explicit
+        self.energyScale = energyScale
+
+    @staticmethod
+    def fromDict(ddict):
+        """
+        :param dict ddict: Description, c.f. module documentation
+        :rtype: ReductionPlan
+        :raises ValueError: if the description is malformed
+        :raises KeyError: if a step name is unknown
+        """
+        steps, explicit = [], []
+        for description in ddict.get('steps', []):
+            if isinstance(description, dict):
+                name = description.get('name')
+                params = description.get('params', {})
+            else:
+                name, params = description
+            if not isinstance(params, dict):
+                raise ValueError("ReductionPlan.fromDict -- Parameters of " \
+                    "step '%s' must be a dictionary" % name)
+            steps.append(createStep(name, params))
+            explicit.append(dict(params))
+        return ReductionPlan(steps, _energyScale(ddict), explicit)
+
+    def oversampling(self):
+        """
+        :returns: Oversampling of the last alignment step, 1 if there is none
+        :rtype: int
+        """
+        oversamp = 1
+        for step in self.steps:
+            if step.NAME == 'alignment':
+                oversamp = step.params['oversamp']
+        return oversamp
+
+    def chain(self, item):
+        """
+        :param ImageItem item: Image to be processed
+        :returns: Steps with the ID32 filter parameters bound to the header of
+            the item
+        :rtype: list
+        """
+        chain = []
+        for step, explicit in zip(self.steps, self.explicit):
+            if isinstance(step, BandPassID32Step):
+                step = BandPassID32Step(Filter.id32Parameters(item, explicit))
+            chain.append(step)
+        return chain
+
+    def scale(self, pixelScale):
+        """
+        :param ndarray pixelScale: Pixel scale of a spectrum
+        :returns: Energy scale if set, otherwise the pixel scale
+        :rtype: ndarray
+        """
+        return _applyEnergyScale(self.energyScale, pixelScale)
+
+    def imap(self, itemList, workers=None, shared=None):
+        """
+        :param list itemList: ImageItems to process
+        :param int workers: Number of worker processes, default: number of
+            CPUs
+        :param SharedArrayManager shared: Owner of the shared memory blocks
+            transporting the images, default: None
+        :returns: Generator of index, spectrum and pixel scale in the order
+            of itemList
+        """
+        oversamp = self.oversampling()
+        jobs = ((idx, item.array, self.chain(item), oversamp, None, None)
+            for idx, item in enumerate(itemList))
+        processor = BatchProcessor(exportSpectrum, workers, shared)
+        return processor.imap(jobs, len(itemList))
+
+
+class RecipePlan(object):
+    __doc__ = """Recipe (c.f. :py:class:`Pipeline.Recipe`) and energy scale
+    read from a description given as list of nodes. The recipe must have a
+    single output, the spectrum."""
+
+    def __init__(self, recipe, energyScale=None):
+        """
+        :param Recipe recipe: Recipe reducing an image to a spectrum
+        :param dict energyScale: Contains 'calibration' and 'zero' or is None
+        :raises ValueError: if the recipe has more than one output
+        """
+        outputs = recipe.outputNames()
+        if len(outputs) != 1:
+            raise ValueError("RecipePlan.__init__ -- Recipe must have a " \
+                "single output, got %s" % ', '.join(outputs))
+        self.recipe = recipe
+        self.energyScale = energyScale
+
+    @staticmethod
+    def fromDict(ddict):
+        """
+        :param dict ddict: Description, c.f. module documentation
+        :rtype: RecipePlan
+        :raises ValueError: if the description is malformed or the recipe
+            invalid
+        """
+        return RecipePlan(Recipe.fromDict(ddict), _energyScale(ddict))
+
+    def scale(self, pixelScale):
+        """
+        :param ndarray pixelScale: Pixel scale of a spectrum
+        :returns: Energy scale if set, otherwise the pixel scale
+        :rtype: ndarray
+        """
+        return _applyEnergyScale(self.energyScale, pixelScale)
+
+    def imap(self, itemList, workers=None, shared=None):
+        """
+        :param list itemList: ImageItems to process
+        :param int workers: Number of worker processes, default: number of
+            CPUs
+        :param SharedArrayManager shared: Owner of the shared memory blocks
+            transporting images and results, default: None
+        :returns: Generator of index, spectrum and pixel scale in the order
+            of itemList
+        :raises ValueError: if the output of the recipe is not
+            one-dimensional
+        """
+        name = self.recipe.outputNames()[0]
+        results = self.recipe.imap(itemList, workers, shared=shared)
+        try:
+            for idx, result in enumerate(results):
+                spectrum = numpy.asarray(result[name])
+                if spectrum.ndim != 1:
+                    raise ValueError("RecipePlan.imap -- Output '%s' of " \
+                        "image '%s' is not a spectrum, shape %s" %
+                        (name, itemList[idx].key(), str(spectrum.shape)))
+                yield idx, spectrum, numpy.arange(len(spectrum), dtype=float)
+        finally:
+            # Stops the worker processes if the caller gives up
+            results.close()
+
+
+def loadPlan(fileName):
+    """
+    :param str fileName: JSON file describing the processing as list of
+        steps or as recipe, c.f. module documentation
+    :rtype: ReductionPlan or RecipePlan
+    :raises IOError: if the file can not be read
+    :raises ValueError: if the file is not valid JSON or malformed
+    :raises KeyError: if a step name is unknown
+    """
+    with open(fileName, 'r') as fileHandle:
+        ddict = json.load(fileHandle)
+    if not isinstance(ddict, dict):
+        raise ValueError("loadPlan -- '%s' does not contain a dictionary" %
+            fileName)
+    if 'nodes' in ddict:
+        return RecipePlan.fromDict(ddict)
+    return ReductionPlan.fromDict(ddict)
+
+
+def imageItems(project):
+    """
+    :param RixsProject project: Project containing the data read
+    :returns: ImageItems of the project sorted by key, stacks are split
+        into their frames
+    :rtype: list
+    """
+    result = []
+    for item in sorted(project.select(), key=lambda item: item.key()):
+        if isinstance(item, ImageItem):
+            result.append(item)
+        elif isinstance(item, StackItem):
+            result += [item.frameItem(idx) for idx in
+                range(item.frameCount())]
+    return result
+
+
+def reduceImages(itemList, plan, workers=None, verbose=False, shared=None):
+    """
+    :param list itemList: ImageItems to process
+    :param plan: Processing to apply, c.f. :func:`loadPlan`
+    :type plan: ReductionPlan or RecipePlan
+    :param int workers: Number of worker processes, default: number of CPUs
+    :param bool verbose: Print a line per spectrum
+    :param SharedArrayManager shared: Owner of the shared memory blocks
+        transporting the images, default: None, i.e. images are pickled
+    :returns: Spectra in the order of itemList
+    :rtype: list
+    """
+    spectra = []
+    for idx, spectrum, scale in plan.imap(itemList, workers, shared):
+        item = itemList[idx]
+        newItem = ScanItem(
+            key=item.key().replace('.edf', '.dat'),
+            header=item.header,
+            array=spectrum,
+            fileLocation=''
+        )
+        newItem.setScale(plan.scale(scale))
+        spectra.append(newItem)
+        if verbose:
+            print('[%d/%d] %s' % (idx + 1, len(itemList), item.key()))
+    return spectra
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='rixstool-batch',
+        description='Reduces all RIXS images found in a directory to spectra '
+            'without starting the graphical user interface.')
+    parser.add_argument('directory',
+        help='directory containing the images, searched recursively')
+    parser.add_argument('pipeline',
+        help='JSON file describing the processing steps or a recipe')
+    parser.add_argument('output',
+        help='output file, the extension selects the format '
+            '(.dat: SPEC, .npz: NumPy, .h5: HDF5)')
+    parser.add_argument('-p', '--pattern', default='*.edf',
+        help="shell pattern of the image files (default: '*.edf')")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-i', '--individual', action='store_true',
+        help='write every spectrum into its own file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='print progress information')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of rixstool-batch.
+
+    :param list argv: Command line arguments, default: sys.argv[1:]
+    :returns: Exit status
+    :rtype: int
+    """
+    args = parseArguments(sys.argv[1:] if argv is None else argv)
+    start = time.time()
+    try:
+        plan = loadPlan(args.pipeline)
+    except (IOError, ValueError, KeyError) as error:
+        sys.stderr.write('rixstool-batch: invalid pipeline: %s\n' % error)
+        return 1
+
+    project = RixsProject()
+    project.crawl(args.directory, deduplicate=True, pattern=args.pattern)
+    itemList = imageItems(project)
+    if not itemList:
+        sys.stderr.write("rixstool-batch: no images matching '%s' found in "
+            "'%s'\n" % (args.pattern, args.directory))
+        return 1
+    if args.verbose:
+        print('Processing %d image(s)' % len(itemList))
+
+    try:
+        spectra = reduceImages(itemList, plan, args.workers, args.verbose,
+            project.shared)
+        written = SpectraExporter(spectra).write(args.output,
+            singleFile=not args.individual)
+    except (IOError, ImportError, ValueError) as error:
+        sys.stderr.write('rixstool-batch: %s\n' % error)
+        return 1
+    finally:
+        project.close()
+
+    if args.verbose:
+        print('Wrote %d spectra to %d file(s) in %.1f s' %
+            (len(spectra), len(written), time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,585 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module transports arrays between processes through shared
+memory instead of pickling them. An array is placed in a shared block and
+described by a small, picklable :py:class:`SharedArray`. Worker processes
+attach to the block by the descriptor and see the array without copying it.
+
+Blocks are created with :py:mod:`multiprocessing.shared_memory` (Python 3.8
+and later). Otherwise they are memory mapped files in a temporary directory,
+on /dev/shm if available. The blocks created by the main process belong to a
+:py:class:`SharedArrayManager`, usually the one of the project
+(c.f. :py:attr:`Project.RixsProject.shared`), which removes them when they
+are released or the project is closed. The module does not depend on Qt."""
+
+import numpy
+import threading
+from collections import deque
+from os import getpid as OsGetpid
+from os import listdir as OsListdir
+from os import remove as OsRemove
+from os.path import isdir as OsPathIsdir
+from os.path import join as OsPathJoin
+from shutil import rmtree as ShutilRmTree
+from tempfile import mkdtemp as TempfileMkdtemp
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+try:
+    from weakref import finalize as WeakrefFinalize
+except ImportError:
+    # Python 2: blocks are only removed by close()
+    WeakrefFinalize = None
+
+DEBUG = 0
+
+#
+# SHARE_THRESHOLD: Arrays smaller than this number of bytes are pickled
+#
+SHARE_THRESHOLD = 1024 ** 2
+
+#
+# Blocks attached by this process: name -> (handle, array)
+#
+_attached = {}
+_counter = [0]
+
+
+class SharedArray(object):
+    __doc__ = """Descriptor of an array in a shared block. Descriptors are
+    sent to worker processes instead of the array.
+
+     .. py:attribute:: name
+
+        Name of the shared memory block or the memory mapped file
+
+     .. py:attribute:: shape
+
+        Shape of the array
+
+     .. py:attribute:: dtype
+
+        Type of the array as string, c.f. numpy.dtype.str
+
+     .. py:attribute:: backend
+
+        'shm' for shared memory, 'file' for memory mapped files"""
+
+    __slots__ = ('name', 'shape', 'dtype', 'backend')
+
+    def __init__(self, name, shape, dtype, backend):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype).str
+        self.backend = backend
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype, self.backend
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype, self.backend = state
+
+    def __repr__(self):
+        return 'SharedArray(%s, %s, %s)' % (repr(self.name), str(self.shape),
+            self.dtype)
+
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * numpy.dtype(self.dtype).itemsize
+
+
+def _openShm(name, create=False, size=0):
+    """
+    Opens a shared memory block. Blocks are not registered with the resource
+    tracker where possible (Python 3.13), their lifetime is managed by the
+    SharedArrayManager.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=create,
+            size=size, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+
+def _unlink(descriptor):
+    if descriptor.backend == 'shm':
+        try:
+            handle = _openShm(descriptor.name)
+        except (OSError, ValueError):
+            # Already removed
+            return
+        handle.close()
+        handle.unlink()
+    else:
+        try:
+            OsRemove(descriptor.name)
+        except OSError:
+            pass
+
+
+def _sweep(backend, directory, prefix):
+    """
+    Removes the blocks whose names start with prefix. Shared memory blocks
+    are only found on systems providing /dev/shm.
+    """
+    if backend == 'shm':
+        directory = '/dev/shm'
+    if directory is None or not OsPathIsdir(directory):
+        return
+    for name in OsListdir(directory):
+        if not name.startswith(prefix):
+            continue
+        if backend == 'shm':
+            # Unlinked by name, which also unregisters the block from the
+            # resource tracker
+            _unlink(SharedArray(name, (0,), 'u1', 'shm'))
+        else:
+            _unlink(SharedArray(OsPathJoin(directory, name), (0,), 'u1',
+                'file'))
+
+
+def _removeBlocks(blocks, backend, directory, prefix):
+    """
+    Removes the blocks of a manager, the blocks its tasks left behind and its
+    directory. Must not refer to the manager, c.f.
+    :func:`SharedArrayManager._start`.
+    """
+    for descriptor in list(blocks.values()):
+        detach(descriptor)
+        _unlink(descriptor)
+    blocks.clear()
+    _sweep(backend, directory, prefix + 'b')
+    if directory is not None:
+        ShutilRmTree(directory, ignore_errors=True)
+
+
+def create(shape, dtype, name, directory=None):
+    """
+    Creates a shared block and attaches it to the calling process.
+
+    :param tuple shape: Shape of the array
+    :param dtype: Type of the array
+    :param str name: Name of the block, unique among the blocks in use
+    :param str directory: Directory of the memory mapped files, None to use
+        shared memory
+    :returns: Descriptor and the writable array
+    :rtype: tuple
+    :raises ValueError: if the array is empty
+    """
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    if not nbytes:
+        raise ValueError('SharedArrays.create -- Can not share empty arrays')
+    if directory is None:
+        handle = _openShm(name, create=True, size=nbytes)
+        array = numpy.ndarray(shape, dtype=dtype, buffer=handle.buf)
+        descriptor = SharedArray(handle.name, shape, dtype, 'shm')
+    else:
+        handle = None
+        fileName = OsPathJoin(directory, name)
+        array = numpy.memmap(fileName, dtype=dtype, mode='w+', shape=shape)
+        descriptor = SharedArray(fileName, shape, dtype, 'file')
+    _attached[descriptor.name] = (handle, array)
+    return descriptor, array
+
+
+def attach(descriptor):
+    """
+    :param SharedArray descriptor: Descriptor of a block
+    :returns: The array of the block, writable and shared with all processes
+        attached to it
+    :rtype: ndarray
+    """
+    if descriptor.name in _attached:
+        return _attached[descriptor.name][1]
+    if descriptor.backend == 'shm':
+        handle = _openShm(descriptor.name)
+        array = numpy.ndarray(descriptor.shape, dtype=descriptor.dtype,
+            buffer=handle.buf)
+    else:
+        handle = None
+        array = numpy.memmap(descriptor.name, dtype=descriptor.dtype,
+            mode='r+', shape=descriptor.shape)
+    _attached[descriptor.name] = (handle, array)
+    return array
+
+
+def detach(descriptor):
+    """
+    Detaches the calling process from a block. Arrays obtained by
+    :func:`attach` must not be used afterwards.
+
+    :param SharedArray descriptor: Descriptor of an attached block
+    """
+    entry = _attached.pop(descriptor.name, None)
+    if entry is None:
+        return
+    handle, array = entry
+    del(array, entry)
+    if handle is not None:
+        try:
+            handle.close()
+        except BufferError:
+            # Views of the array are still alive, the block is unmapped once
+            # they are garbage collected
+            pass
+
+
+def asArray(obj):
+    """
+    :param obj: Array or descriptor
+    :returns: obj, or the array of the block if obj is a descriptor
+    """
+    if isinstance(obj, SharedArray):
+        return attach(obj)
+    return obj
+
+
+def _transform(obj, function):
+    """
+    Applies function to obj and the elements of tuples, lists and
+    dictionaries in obj.
+    """
+    if isinstance(obj, tuple):
+        return tuple(_transform(element, function) for element in obj)
+    if isinstance(obj, list):
+        return [_transform(element, function) for element in obj]
+    if isinstance(obj, dict):
+        return type(obj)((key, _transform(value, function))
+            for key, value in obj.items())
+    return function(obj)
+
+
+class SharedTask(object):
+    __doc__ = """Worker side of the transport. Wraps a module level function
+    taking one job: descriptors in the job are replaced by the arrays of their
+    blocks, large arrays in the result are placed in new blocks, which the
+    :py:class:`SharedArrayManager` takes over (c.f.
+    :func:`SharedArrayManager.collect`). Smaller arrays in the result are
+    copied, so the result does not refer to the input blocks."""
+
+    def __init__(self, function, prefix, directory=None,
+                 threshold=SHARE_THRESHOLD):
+        self.function = function
+        self.prefix = prefix
+        self.directory = directory
+        self.threshold = threshold
+
+    def _export(self, obj):
+        if not isinstance(obj, numpy.ndarray) or obj.dtype == object:
+            return obj
+        if obj.nbytes < self.threshold:
+            return obj if obj.flags.owndata else numpy.array(obj)
+        _counter[0] += 1
+        name = '%sw%x_%d' % (self.prefix, OsGetpid(), _counter[0])
+        descriptor, array = create(obj.shape, obj.dtype, name, self.directory)
+        array[...] = obj
+        del(array)
+        detach(descriptor)
+        return descriptor
+
+    def __call__(self, job):
+        descriptors = []
+
+        def resolve(obj):
+            if isinstance(obj, SharedArray):
+                descriptors.append(obj)
+                return attach(obj)
+            return obj
+
+        try:
+            result = self.function(_transform(job, resolve))
+            return _transform(result, self._export)
+        finally:
+            job = result = None
+            for descriptor in descriptors:
+                detach(descriptor)
+
+
+class SharedArrayManager(object):
+    __doc__ = """Owner of the shared blocks of a process. Blocks are removed
+    when they are released, the worker processes attached to them keep them
+    mapped until they detach. :func:`close` removes all blocks, including
+    blocks that worker processes created but nobody collected, e.g. because
+    a batch was cancelled. The resource tracker and the directory of the
+    blocks are set up when the first block or task is created, a manager
+    that is never used costs nothing. Blocks left when the manager is
+    garbage collected are removed as well.
+
+     .. py:attribute:: threshold
+
+        Arrays smaller than this number of bytes are not shared"""
+
+    def __init__(self, threshold=SHARE_THRESHOLD, backend=None):
+        """
+        :param int threshold: Minimum size of shared arrays in bytes
+        :param str backend: 'shm' or 'file', default: 'shm' if
+            multiprocessing.shared_memory is available
+        """
+        if backend is None:
+            backend = 'file' if shared_memory is None else 'shm'
+        self.threshold = threshold
+        self.backend = backend
+        self.prefix = 'rx%x_' % OsGetpid()
+        self.directory = None
+        self._blocks = {}  # name -> descriptor
+        self._counter = 0
+        self._batches = 0
+        self._started = False
+        self._finalizer = None
+
+    def _start(self):
+        if self._started:
+            return
+        if self.backend == 'shm':
+            # Worker processes have to share the resource tracker of this
+            # process. Otherwise the tracker of a worker removes the blocks
+            # it attached to when the worker exits.
+            resource_tracker.ensure_running()
+        else:
+            self.directory = TempfileMkdtemp(prefix='rixstool-shared-',
+                dir='/dev/shm' if OsPathIsdir('/dev/shm') else None)
+        if WeakrefFinalize is not None:
+            # The finalizer must not refer to the manager itself
+            self._finalizer = WeakrefFinalize(self, _removeBlocks,
+                self._blocks, self.backend, self.directory, self.prefix)
+        self._started = True
+
+    def _directory(self):
+        self._start()
+        return self.directory
+
+    def allocate(self, shape, dtype):
+        """
+        Creates a block, e.g. for the output of a worker process.
+
+        :param tuple shape: Shape of the array
+        :param dtype: Type of the array
+        :returns: Descriptor of the block, c.f. :func:`array`
+        :rtype: SharedArray
+        """
+        self._counter += 1
+        descriptor, array = create(shape, dtype,
+            '%sp%d' % (self.prefix, self._counter), self._directory())
+        self._blocks[descriptor.name] = descriptor
+        return descriptor
+
+    def share(self, array):
+        """
+        :param ndarray array: Array to be shared
+        :returns: Descriptor of a block holding a copy of the array
+        :rtype: SharedArray
+        """
+        descriptor = self.allocate(array.shape, array.dtype)
+        attach(descriptor)[...] = array
+        return descriptor
+
+    def array(self, descriptor):
+        """
+        :param SharedArray descriptor: Descriptor of a block of the manager
+        :returns: Array of the block, valid until the block is released
+        :rtype: ndarray
+        """
+        return attach(descriptor)
+
+    def release(self, descriptor):
+        """
+        :param SharedArray descriptor: Descriptor of a block of the manager
+        """
+        self._blocks.pop(descriptor.name, None)
+        detach(descriptor)
+        _unlink(descriptor)
+
+    def collect(self, result):
+        """
+        Replaces the descriptors of blocks created by :py:class:`SharedTask`
+        in a result by copies of their arrays and removes the blocks.
+
+        :param result: Result of a SharedTask
+        :returns: Result without descriptors
+        """
+        def adopt(obj):
+            if not isinstance(obj, SharedArray):
+                return obj
+            array = numpy.array(attach(obj))
+            detach(obj)
+            _unlink(obj)
+            return array
+        return _transform(result, adopt)
+
+    def shareJob(self, job):
+        """
+        :param job: Job of a worker function
+        :returns: The job with arrays of at least threshold bytes replaced by
+            descriptors and the list of these descriptors
+        :rtype: tuple
+        """
+        descriptors = []
+
+        def share(obj):
+            if isinstance(obj, numpy.ndarray) and obj.dtype != object and \
+                    obj.nbytes >= self.threshold:
+                descriptor = self.share(obj)
+                descriptors.append(descriptor)
+                return descriptor
+            return obj
+        return _transform(job, share), descriptors
+
+    def task(self, function):
+        """
+        :param function: Module level function taking one job
+        :returns: Picklable callable running function in a worker process.
+            The blocks created by the task are named by a prefix unique to
+            the task, c.f. :func:`sweep`.
+        :rtype: SharedTask
+        """
+        self._batches += 1
+        return SharedTask(function, '%sb%d_' % (self.prefix, self._batches),
+            self._directory(), self.threshold)
+
+    def usage(self):
+        """
+        :returns: Number of bytes in the blocks of the manager
+        :rtype: int
+        """
+        return sum(descriptor.nbytes() for descriptor in self._blocks.values())
+
+    def sweep(self, prefix=None):
+        """
+        Removes blocks created by worker processes that were not collected.
+        Shared memory blocks are only found on systems providing /dev/shm.
+
+        :param str prefix: Prefix of the blocks of a task, c.f.
+            :func:`task`. Default: blocks of all tasks
+        """
+        if prefix is None:
+            prefix = self.prefix + 'b'
+        _sweep(self.backend, self.directory, prefix)
+
+    def close(self):
+        """
+        Removes all blocks of the manager. The manager can be used again
+        afterwards.
+        """
+        if not self._started:
+            return
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        _removeBlocks(self._blocks, self.backend, self.directory, self.prefix)
+        self.directory = None
+        self._started = False
+
+
+class JobWindow(object):
+    __doc__ = """Shares the arrays of jobs while they are consumed by a
+    process pool and limits the number of jobs in flight, so the shared
+    blocks do not hold all images at once. Results have to be passed to
+    :func:`done` in the order of the jobs."""
+
+    def __init__(self, manager, size, poll=.2):
+        """
+        :param SharedArrayManager manager: Owner of the blocks
+        :param int size: Maximum number of jobs in flight
+        :param float poll: Seconds between checks for :func:`stop`
+        """
+        self.manager = manager
+        self.size = max(int(size), 1)
+        self.poll = poll
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._stopped = False
+        self._task = None
+        self._submitted = 0
+        self._collected = 0
+
+    def task(self, function):
+        """
+        :param function: Module level function taking one job
+        :returns: Function to be mapped over :func:`jobs`
+        :rtype: SharedTask
+        """
+        self._task = self.manager.task(function)
+        return self._task
+
+    def jobs(self, jobs):
+        """
+        :param iterable jobs: Jobs to share
+        :returns: Generator of shared jobs, blocks while the window is full
+        """
+        for job in jobs:
+            with self._condition:
+                while len(self._pending) >= self.size and not self._stopped:
+                    self._condition.wait(self.poll)
+                if self._stopped:
+                    return
+                job, descriptors = self.manager.shareJob(job)
+                self._pending.append(descriptors)
+                self._submitted += 1
+            yield job
+
+    def done(self, result):
+        """
+        :param result: Result of the oldest job in flight
+        :returns: Result with the arrays collected, c.f.
+            :func:`SharedArrayManager.collect`
+        """
+        with self._condition:
+            descriptors = self._pending.popleft()
+            self._collected += 1
+            self._condition.notify()
+        for descriptor in descriptors:
+            self.manager.release(descriptor)
+        return self.manager.collect(result)
+
+    def stop(self):
+        """
+        Stops sharing jobs and releases the blocks of the jobs in flight.
+        Unblocks the pool feeding the jobs, i.e. must be called before the
+        pool is terminated.
+        """
+        with self._condition:
+            self._stopped = True
+            pending, self._pending = self._pending, deque()
+            self._condition.notify_all()
+        for descriptors in pending:
+            for descriptor in descriptors:
+                self.manager.release(descriptor)
+
+    def close(self):
+        """
+        Removes the blocks created by tasks whose results were not collected.
+        To be called once the pool is closed or terminated.
+        """
+        self.stop()
+        if self._task is not None and self._submitted != self._collected:
+            self.manager.sweep(self._task.prefix)
@@ -0,0 +1,256 @@
+#/*##########################################################################
+# Copyright (C) 2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# This toolkit is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# PyMca is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyMca; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# PyMca follows the dual licensing model of Riverbank's PyQt and cannot be
+# used as a free plugin for a non-free program.
+#
+# Please contact the ESRF industrial unit (industry@esrf.fr) if this license
+# is a problem for you.
+#############################################################################*/
+__author__ = "Tonn Rueter - ESRF Data Analysis Unit"
+__doc__ = """Module contains the processing steps of the image tools. A step
+holds its parameters explicitly and does not depend on Qt, so steps can be
+pickled, sent to worker processes and run without a display. The tool windows
+in :py:mod:`RixsTool.widgets.ToolWindows` only edit the parameters of a
+step."""
+
+import numpy
+
+from RixsTool.Operations import Filter, SlopeCorrection, Integration, \
+    ID32_DEFAULTS
+from RixsTool.Items import FunctionItem
+
+DEBUG = 0
+
+
+class ProcessingStep(object):
+    __doc__ = """Base class of all steps. Subclasses set :py:attr:`NAME` and
+    :py:attr:`DEFAULTS` and implement :py:func:`process` as a static method,
+    i.e. the processing only depends on the image and the parameters passed.
+
+     .. py:attribute:: NAME
+
+        Name of the step, c.f. :py:attr:`STEPS`
+
+     .. py:attribute:: DEFAULTS
+
+        Default parameters
+
+     .. py:attribute:: params
+
+        Current parameters"""
+
+    NAME = None
+    DEFAULTS = {}
+
+    def __init__(self, params=None):
+        """
+        :param dict params: Parameters overriding the DEFAULTS
+        """
+        self.params = dict(self.DEFAULTS)
+        if params:
+            self.params.update(params)
+
+    def __call__(self, image):
+        return self.process(image, self.params)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, str(self.params))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.params == other.params
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def parameters(self):
+        """
+        :returns: Copy of the current parameters
+        :rtype: dict
+        """
+        return dict(self.params)
+
+    def setParameters(self, params):
+        """
+        :param dict params: Parameters to update
+        """
+        self.params.update(params)
+
+    def copy(self):
+        """
+        :returns: Step of the same type with a copy of the parameters
+        :rtype: ProcessingStep
+        """
+        return type(self)(self.params)
+
+    def description(self):
+        """
+        :returns: Name and parameters, c.f. :func:`createStep`
+        :rtype: tuple
+        """
+        return self.NAME, self.parameters()
+
+    @staticmethod
+    def process(image, params):
+        """
+        :param ndarray image: Two dimensional numpy.ndarray
+        :param dict params: Parameters of the step
+        :returns ndarray: Processed image
+        """
+        raise NotImplementedError('ProcessingStep.process -- Must be ' \
+            'implemented in subclass')
+
+    @staticmethod
+    def previewParameters(params, factor):
+        """
+        :param dict params: Parameters of the step
+        :param int factor: Decimation of the preview image, c.f.
+            :func:`Operations.Manipulation.blockMean`
+        :returns: Parameters to process the decimated image with. Steps with
+            parameters given in pixels rescale them.
+        :rtype: dict
+        """
+        return params
+
+
+class FlipStep(ProcessingStep):
+    __doc__ = """Flips the image upside down if 'flipped' is set."""
+
+    NAME = 'flip'
+    DEFAULTS = {
+        'flipped': False
+    }
+
+    @staticmethod
+    def process(image, params):
+        if params.get('flipped', False):
+            return numpy.flipud(image)
+        return image
+
+
+class BandPassStep(ProcessingStep):
+    __doc__ = """C.f. :func:`Operations.Filter.bandPassFilter`"""
+
+    NAME = 'bandpass'
+    DEFAULTS = {
+        'high': 800.,
+        'low': 8.,
+        'offset': 114.,
+        'replace': 0.
+    }
+
+    @staticmethod
+    def process(image, params):
+        return Filter.bandPassFilter(image, params)
+
+
+class BandPassID32Step(ProcessingStep):
+    __doc__ = """C.f. :func:`Operations.Filter.bandPassFilterID32`"""
+
+    NAME = 'bandpassID32'
+    DEFAULTS = dict(ID32_DEFAULTS)
+
+    @staticmethod
+    def process(image, params):
+        return Filter.bandPassFilterID32(image, params)
+
+    @staticmethod
+    def previewParameters(params, factor):
+        """
+        The baseline is taken from the same dark rows as in the full image.
+        """
+        params = dict(params)
+        params['baselineRows'] = max(100 // factor, 1)
+        return params
+
+
+class AlignmentStep(ProcessingStep):
+    __doc__ = """Shifts the image by a smile function a * x**2 + b * x + c
+    (c.f. :func:`Operations.SlopeCorrection.alignImage`). The coefficient 'a'
+    is given in units of 1e-5, 'oversamp' is the number of points per pixel
+    of the result."""
+
+    NAME = 'alignment'
+    DEFAULTS = {
+        'a': -5.25,
+        'b': 0.18877,
+        'c': 0.,
+        'oversamp': 2
+    }
+
+    @staticmethod
+    def process(image, params):
+        func = FunctionItem('Slope Function', '')
+        func.setExpression(lambda x, a, b, c: a * x ** 2 + b * x + c)
+        func.setParameters({
+            'a': params['a'] * 10. ** -5,  # "E-5" suffix of the "Smile" param.
+            'b': params['b'],
+            'c': params['c']
+        })
+        return SlopeCorrection.alignImage(image, func, params['oversamp'])
+
+    @staticmethod
+    def previewParameters(params, factor):
+        """
+        Rescales the smile function: with x = factor * x' and shifts reduced
+        by factor, a * x**2 + b * x + c becomes
+        factor * a * x'**2 + b * x' + c / factor.
+        """
+        params = dict(params)
+        params['a'] *= factor
+        params['c'] /= float(factor)
+        return params
+
+
+class SumStep(ProcessingStep):
+    __doc__ = """Turns the image into a spectrum by summation along its
+    'columns' or 'rows'."""
+
+    NAME = 'sum'
+    DEFAULTS = {
+        'axis': 'columns'
+    }
+
+    @staticmethod
+    def process(image, params):
+        axis = 1 if str(params.get('axis', 'columns')) == 'columns' else 0
+        return Integration.axisSum(image, {'axis': axis})
+
+
+#
+# STEPS: Step classes by name
+#
+STEPS = dict((cls.NAME, cls) for cls in
+    [FlipStep, BandPassStep, BandPassID32Step, AlignmentStep, SumStep])
+
+
+def createStep(name, params=None):
+    """
+    :param str name: Name of the step, c.f. :py:attr:`STEPS`
+    :param dict params: Parameters overriding the defaults
+    :returns: New step
+    :rtype: ProcessingStep
+    :raises KeyError: if the name is unknown
+    """
+    if name not in STEPS:
+        raise KeyError("createStep -- Unknown step '%s'" % name)
+    return STEPS[name](params)
@@ -26,6 +26,13 @@
 #############################################################################*/
 __author__ = "Tonn Rueter - ESRF Data Analysis Unit"
 
+import numpy
+
+#
+# Number of elements per block used by statistics
+#
+STATISTICS_BLOCK_SIZE = 1 << 20
+
 
 def reduce(llist):
     """
@@ -82,6 +89,97 @@ def unique(seq, ident=''):
     del seq[insertPos:]
 
 
+def plain(value):
+    """
+    Converts numpy arrays and scalars, also inside of dictionaries, lists and
+    tuples, to their JSON serializable equivalents.
+
+    :param value: Value to convert
+    :returns: Value made of python types
+    """
+    if isinstance(value, (numpy.ndarray, numpy.generic)):
+        return value.tolist()
+    if isinstance(value, dict):
+        return dict((key, plain(val)) for key, val in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(val) for val in value]
+    return value
+
+
+def _blocks(array, blockSize):
+    """
+    Iterates over an array in blocks along the first axis, each block holding
+    about blockSize elements. Works for array like objects supporting slicing
+    along the first axis (c.f. :py:class:`IO.EdfFrameStack`).
+    """
+    if array.ndim == 0 or array.shape[0] == 0:
+        yield numpy.asarray(array).ravel()
+        return
+    rowSize = max(array.size // array.shape[0], 1)
+    step = max(blockSize // rowSize, 1)
+    for start in range(0, array.shape[0], step):
+        yield numpy.asarray(array[start:start + step]).ravel()
+
+
+def statistics(array, bins=64, blockSize=STATISTICS_BLOCK_SIZE):
+    """
+    Summary statistics of an array: minimum, maximum, mean, sum and a coarse
+    histogram. Arrays of unsigned 8 or 16 bit integers are reduced in a single
+    pass using numpy.bincount. All other arrays are reduced block by block,
+    the histogram requires a second pass once the value range is known.
+
+    :param ndarray array: Array or array like object
+    :param int bins: Number of histogram bins
+    :param int blockSize: Number of elements reduced at once
+    :returns: Dictionary with keys 'min', 'max', 'mean', 'sum' and
+        'histogram', the latter being the tuple (counts, edges)
+    :rtype: dict
+    """
+    dtype = numpy.dtype(array.dtype)
+    if not array.size:
+        return {
+            'min': numpy.nan,
+            'max': numpy.nan,
+            'mean': numpy.nan,
+            'sum': 0,
+            'histogram': (numpy.zeros(bins, dtype=numpy.int64),
+                          numpy.zeros(bins + 1))
+        }
+    if dtype.kind == 'u' and dtype.itemsize <= 2:
+        counts = numpy.zeros(1 << (8 * dtype.itemsize), dtype=numpy.int64)
+        for block in _blocks(array, blockSize):
+            counts[:] += numpy.bincount(block, minlength=len(counts))
+        nonzero = numpy.flatnonzero(counts)
+        lo, hi = int(nonzero[0]), int(nonzero[-1])
+        total = int(numpy.dot(counts, numpy.arange(len(counts))))
+        edges = numpy.linspace(lo, hi + 1, bins + 1)
+        binIdx = numpy.minimum(
+            ((numpy.arange(lo, hi + 1) - lo) * bins) // (hi + 1 - lo),
+            bins - 1)
+        histogram = numpy.bincount(binIdx, weights=counts[lo:hi + 1],
+            minlength=bins).astype(numpy.int64)
+    else:
+        lo, hi, total = None, None, 0
+        accumulator = numpy.float64 if dtype.kind in 'fc' else numpy.int64
+        for block in _blocks(array, blockSize):
+            blockMin, blockMax = block.min(), block.max()
+            lo = blockMin if lo is None else min(lo, blockMin)
+            hi = blockMax if hi is None else max(hi, blockMax)
+            total += block.sum(dtype=accumulator)
+        histogram = numpy.zeros(bins, dtype=numpy.int64)
+        edges = numpy.linspace(float(lo), float(hi), bins + 1)
+        if numpy.isfinite(edges).all():
+            for block in _blocks(array, blockSize):
+                histogram += numpy.histogram(block, bins=edges)[0]
+    return {
+        'min': lo,
+        'max': hi,
+        'mean': total / float(array.size),
+        'sum': total,
+        'histogram': (histogram, edges)
+    }
+
+
 def unitTest_unique():
     from copy import deepcopy
     #
@@ -44,14 +44,15 @@ from PyMca5.PyMcaGui import PyMcaQt as qt
 # IMPORTS FROM RixsTool
 #
 from .widgets.Models import ProjectModel
-from .Items import SpecItem, ScanItem, ImageItem
+from .Items import SpecItem, ScanItem, ImageItem, StackItem
 from .ItemContainer import ItemContainer
+from .Export import SpectraExporter
+from .Batch import BatchProcessor, exportSpectrum, exportKey, spectrumScale
+from .Cache import ResultCache
 from .UiPaths import UiPaths
 
 import numpy
 import platform
-from cStringIO import StringIO
-# from os import linesep as OsLineSep
 from os.path import splitext as OsPathSplitExt
 
 import logging
@@ -59,7 +60,6 @@ logger = logging.getLogger("mainwindow")
 
 DEBUG = 0
 PLATFORM = platform.system()
-NEWLINE = '\n'  # instead of OsLineSep
 
 
 class RIXSMainWindow(qt.QMainWindow):
@@ -117,6 +117,14 @@ class RIXSMainWindow(qt.QMainWindow):
             self.exportCurrentImage)
         self.imageView.sumImageTool.exportSelectedSignal.connect(
             self.exportSelectedImage)
+        self.exportThread = None
+        self.exportProgress = None
+        try:
+            self.resultCache = ResultCache()
+        except OSError as error:
+            logger.warning('RIXSMainWindow.__init__ -- result cache '
+                'disabled: %s' % error)
+            self.resultCache = None
 
         #
         # ENERGY SCALE
@@ -124,6 +132,47 @@ class RIXSMainWindow(qt.QMainWindow):
         self.imageView.energyScaleTool.energyScaleSignal.connect(
             self.setEnergyScale)
 
+        #
+        # MEMORY
+        # The status bar shows the memory used by the arrays of the project
+        # and the limit above which arrays are spilled to scratch files.
+        #
+        self.memoryLabel = qt.QLabel(self)
+        self.memoryLimitSpinBox = qt.QSpinBox(self)
+        self.memoryLimitSpinBox.setPrefix('Limit: ')
+        self.memoryLimitSpinBox.setSuffix(' MB')
+        self.memoryLimitSpinBox.setRange(64, 1024 ** 2)
+        self.memoryLimitSpinBox.setSingleStep(256)
+        self.memoryLimitSpinBox.setValue(
+            self.currentProject.memory.limit // 1024 ** 2)
+        self.memoryLimitSpinBox.valueChanged.connect(self.setMemoryLimit)
+        self.statusBar().addPermanentWidget(self.memoryLabel)
+        self.statusBar().addPermanentWidget(self.memoryLimitSpinBox)
+        self.memoryTimer = qt.QTimer(self)
+        self.memoryTimer.timeout.connect(self.updateMemoryStatus)
+        self.memoryTimer.start(2000)
+        self.updateMemoryStatus()
+
+    def closeEvent(self, event):
+        self.memoryTimer.stop()
+        self.currentProject.close()
+        qt.QMainWindow.closeEvent(self, event)
+
+    def setMemoryLimit(self, megabytes):
+        """
+        :param int megabytes: Memory limit for the arrays of the project
+        """
+        self.currentProject.memory.setLimit(megabytes * 1024 ** 2)
+        self.updateMemoryStatus()
+
+    def updateMemoryStatus(self):
+        memory = self.currentProject.memory
+        if memory.refresh() > memory.limit:
+            # Arrays read since the last items were added
+            memory.enforce()
+        self.memoryLabel.setText('Memory: %.1f MB (%d spilled)' %
+            (memory.usage() / 1024. ** 2, memory.spilledCount()))
+
     def setEnergyScale(self):
         scale = self.imageView.energyScaleTool.energyScale()
         logger.debug('RIXSMainWindow.setEnergyScale -- scale: %s' % str(scale))
@@ -148,66 +197,85 @@ class RIXSMainWindow(qt.QMainWindow):
         self.exportingImages([container])
 
     def exportingImages(self, itemContainerList):
-        # def imageToSpectrum(self, imageItemList):
-        logger.debug('ProjectView.exportingImages -- Received %d item' % 
+        """
+        :param list itemContainerList: Containers of the images to export
+
+        Processes the images by the active tools of the image view and adds
+        the resulting spectra to the project. The tool parameters are taken
+        once, the images are processed in a pool of processes by a
+        :py:class:`BatchExportThread`. Spectra are added to the project as
+        soon as they are available, the progress dialog allows to cancel the
+        export.
+        """
+        logger.debug('ProjectView.exportingImages -- Received %d item' %
             len(itemContainerList))
-        toolList = self.imageView.toolList
         sumImageTool = self.imageView.sumImageTool
+        if not sumImageTool.active():
+            return
+        if self.exportThread is not None:
+            qt.QMessageBox.information(self, 'Export spectra',
+                'An export is still running.')
+            return
+
+        #
+        # Snapshot of the tool chain: apply filter and alignment to all images
+        #
+        chain = []
         oversamp = 1
-        # specContainer = self.currentProject['Spectra']
-
-        for container in filter(ItemContainer.hasItem, itemContainerList):
-            if container in self.currentProject:
-                item = container.item()
-                data = item.array
-
-                logger.debug('ProjectView.exportingImages -- Found it! %s' % 
-                    container.label)
-                for step in toolList:
-                    #
-                    # Do processing.
-                    # Apply filter and alignment to all images.
-                    #
-                    if not step.active():
-                        continue
-                    parameters = step.getValues()
-                    data = step.process(data, parameters)
-                    if step == self.imageView.imageAlignmentWindow:
-                        oversamp = parameters['oversamp']
+        for tool in self.imageView.toolList:
+            if not tool.active():
+                continue
+            step = tool.batchStep()
+            chain.append(step)
+            if tool == self.imageView.imageAlignmentWindow:
+                oversamp = step.params['oversamp']
+        chain.append(sumImageTool.batchStep())
+
+        itemList = [container.item() for container in
+            filter(ItemContainer.hasItem, itemContainerList)
+            if container in self.currentProject]
+        if not itemList:
+            return
 
-                #
-                # Build new tree item
-                #
-                if sumImageTool.active():
-                    result = sumImageTool.process(data, {})
-                    key = item.key()
-                    newKey = key.replace('.edf', '.dat')
-
-                    newItem = ScanItem(
-                        key=newKey,
-                        header=item.header,
-                        array=result,
-                        fileLocation=''
-                    )
-                    numpnt = len(result)
-                    stop = (numpnt - 1) / oversamp + 1
-                    scale = numpy.linspace(1., stop, num=numpnt)
-                    newItem.setScale(scale)
-
-                    #newItem = SpecItem(
-                    #    key=newKey,
-                    #    header=item.header,
-                    #    array=result,
-                    #    fileLocation=''
-                    #)
-
-                    # newContainer = ItemContainer(
-                    #    item=newItem,
-                    #    parent=specContainer,
-                    #    label=None  # is set automatically
-                    # )
-
-                    self.currentProject.addItem(newItem)
+        self.exportProgress = qt.QProgressDialog('Exporting spectra..',
+            'Cancel', 0, len(itemList), self)
+        self.exportProgress.setWindowModality(qt.Qt.WindowModal)
+        self.exportProgress.setMinimumDuration(0)
+        self.exportProgress.setValue(0)
+
+        self.exportThread = BatchExportThread(itemList, chain, oversamp, self,
+            self.resultCache, self.currentProject.shared)
+        self.exportThread.resultSignal.connect(self._handleExportResult)
+        self.exportThread.errorSignal.connect(self._handleExportError)
+        self.exportThread.finished.connect(self._handleExportFinished)
+        self.exportProgress.canceled.connect(self.exportThread.cancel)
+        self.exportThread.start()
+
+    def _handleExportResult(self, idx, spectrum, scale):
+        """
+        Builds a new tree item from a spectrum computed by the
+        :py:class:`BatchExportThread`.
+        """
+        item = self.exportThread.itemList[idx]
+        newKey = item.key().replace('.edf', '.dat')
+        newItem = ScanItem(
+            key=newKey,
+            header=item.header,
+            array=spectrum,
+            fileLocation=''
+        )
+        newItem.setScale(scale)
+        self.currentProject.addItem(newItem)
+        self.exportProgress.setValue(self.exportProgress.value() + 1)
+
+    def _handleExportError(self, message):
+        qt.QMessageBox.critical(self, 'Export spectra', message)
+
+    def _handleExportFinished(self):
+        self.exportProgress.close()
+        self.exportProgress = None
+        self.exportThread = None
+        logger.debug('RIXSMainWindow.exportingImages -- Done!')
 
     def handleMaskImageSignal(self, ddict):
         logger.debug("RIXSMainWindow.handleMaskImageSignal -- ddict: %s" %
@@ -250,6 +318,7 @@ class RIXSMainWindow(qt.QMainWindow):
         Depending on the item type, the item data are visualized.
         """
         for item in itemList:
+            self.currentProject.memory.touch(item)
             if isinstance(item, ImageItem):
                 #
                 # Received 2-D data, use imageView
@@ -257,6 +326,13 @@ class RIXSMainWindow(qt.QMainWindow):
                 self.imageView.setImageItem(item)
                 logger.debug(
                     'RIXSMainWindow._handleShowSignal -- Received ImageItem')
+            elif isinstance(item, StackItem):
+                #
+                # Received 3-D data, only the first frame is read and shown
+                #
+                self.imageView.setImageItem(item.frameItem(0))
+                logger.debug(
+                    'RIXSMainWindow._handleShowSignal -- Received StackItem')
             elif isinstance(item, ScanItem) or isinstance(item, SpecItem):
                 #
                 # Received 1-D data, use specView
@@ -315,7 +391,9 @@ class RIXSMainWindow(qt.QMainWindow):
         Routine that connects the actions that can be triggered in the menu bar
         to the proper functions. This should only be done during instantiation.
         """
-        actionList = [(self.saveSpectraAction, self.saveSpectra),
+        actionList = [(self.openProjectAction, self.openProject),
+                      (self.saveProjectAction, self.saveProject),
+                      (self.saveSpectraAction, self.saveSpectra),
                       (self.exitAction, sys.exit),
                       (self.colormapAction, self.imageView.selectColormap),
                       (self.flipAction, self.imageView.flipWidget.show),
@@ -336,6 +414,40 @@ class RIXSMainWindow(qt.QMainWindow):
             action.triggered[()].connect(function)
         logger.debug('All Actions connected..')
 
+    def openProject(self):
+        """
+        Adds the tree stored in a HDF5 project file to the current project.
+        """
+        fileName = qt.safe_str(qt.QFileDialog.getOpenFileName(
+            self,
+            'Open project',
+            str(qt.QDir.current().absolutePath()),
+            'HDF5 project (*.h5 *.hdf5)'))
+        if not len(fileName):
+            return
+        try:
+            self.currentProject.loadHDF5(fileName)
+        except (IOError, ImportError, ValueError) as error:
+            qt.QMessageBox.critical(self, 'Open project', str(error))
+        logger.debug('RIXSMainWindow.openProject -- Done!')
+
+    def saveProject(self):
+        """
+        Stores the current project in a HDF5 file.
+        """
+        fileName = qt.safe_str(qt.QFileDialog.getSaveFileName(
+            self,
+            'Save project',
+            str(qt.QDir.current().absolutePath()),
+            'HDF5 project (*.h5 *.hdf5)'))
+        if not len(fileName):
+            return
+        try:
+            self.currentProject.saveHDF5(fileName)
+        except (IOError, ImportError) as error:
+            qt.QMessageBox.critical(self, 'Save project', str(error))
+        logger.debug('RIXSMainWindow.saveProject -- Done!')
+
     def saveSpectra(self):
         """
         Save routine that writes all spectra of the 'Spectra' node to a text
@@ -360,111 +472,15 @@ class RIXSMainWindow(qt.QMainWindow):
             str(fileNameList))
 
         #
-        # Loop through all spectra in the top level of 'Spectra' group
+        # Write all spectra in the top level of 'Spectra' group
         #
         specNode = self.currentProject['Spectra']
-        specString = StringIO()
-
-        itemList = [node.item() for node in specNode.children if node.hasItem]
-        for idx, item in enumerate(itemList):
-            #
-            # Determine the data type to be written
-            #
-            if isinstance(item, ScanItem):
-                scale = item.scale()
-            elif isinstance(item, SpecItem):
-                #
-                # SpecItem does not have a scale, generate one by using the
-                # length of the array.
-                #
-                scale = numpy.arange(
-                    start=0,
-                    stop=len(item.array),
-                    dtype=item.array.dtype)
-            else:
-                raise NotImplementedError("RIXSMainWindow.saveSpectra -- " \
-                    "Unknown item type: %s" % type(item))
-
-            # Stack and transpose
-            data = numpy.vstack((scale, item.array)).T
-            if data.ndim == 1:
-                nRows, nCols = data.shape[0], 1
-            elif data.ndim == 2:
-                nRows, nCols = data.shape
-            else:
-                raise NotImplementedError("RIXSMainWindow.saveSpectra -- " \
-                    "Cannot write item with dimensionality > 2")
-
-            if isinstance(item, SpecItem):
-                #
-                # Start to write spec file header...
-                #
-                scanNo = 1
-                specString.write(NEWLINE)
-                specString.write('#S %d %s' % (scanNo, item.key()) + NEWLINE)
-                specString.write('#N %d' % nCols + NEWLINE) # Number of columns
-                specString.write('#L PixelNo  Counts' + NEWLINE) # Column labels
-
-                #
-                # Write EDF header in #U comments
-                #
-                # headerLines = item.header.split('\n')
-                # # Determine order of magnitude
-                # if len(headerLines) > 0 and len(item.header) > 0:
-                #    magnitude = len(str(len(headerLines)))
-                #    for jdx, line in enumerate(headerLines):
-                #    - Format string explanation:
-                #    - #U              -> prefix, indicates header in spec file
-                #    - {idx:0>{width}} -> write value 'idx' in a string with
-                #                         'width' letters, align value of 'idx'
-                #                         on the right and fill the remaining
-                #                         space with zeros (i.e. leading zeros)
-                #    - {line}          -> place value 'line' here
-                #
-                #    specString.write('#U{idx:0>{width}} {line}'.format(idx=jdx,
-                #            width=magnitude, line=line) + NEWLINE)
-                #
-                # ...finish to write spec file header
-                #
-                logger.debug("RIXSMainWindow.saveSpectra -- header: " \
-                    "type(header): %s\n'%s'" % (type(item.header), item.header))
-
-            #
-            # Write data using numpy.savetxt, parameter fname can be file handle
-            #
-            numpy.savetxt(
-                fname=specString,
-                X=data,
-                fmt='%.6f',
-                delimiter=' ',
-                newline=NEWLINE
-            )
-
-            if isinstance(item, SpecItem):
-                specString.write(NEWLINE)
-
-            if not singleFile:
-                #
-                # File names feature indexation
-                #
-                path, ext = OsPathSplitExt(fileName)
-                numberedPath = '{path}_{idx:0>{width}}{ext}'.format(
-                    path=path,
-                    idx=idx,
-                    width=len(itemList),
-                    ext=ext
-                )
-                with open(numberedPath, 'wb') as fileHandle:
-                    fileHandle.write(specString.getvalue())
-
-                #
-                # Reset StringIO
-                #
-                specString = StringIO()
-
-        if singleFile:
-            with open(fileName, 'wb') as fileHandle:
-                fileHandle.write(specString.getvalue())
+        itemList = [node.item() for node in specNode.children if node.hasItem()]
+        try:
+            SpectraExporter(itemList).write(fileName, singleFile)
+        except (IOError, ImportError, NotImplementedError) as error:
+            qt.QMessageBox.critical(self, 'Save spectra', str(error))
+            return
 
         logger.debug('RIXSMainWindow.saveSpectra -- Done!')
 
@@ -490,9 +506,101 @@ class RIXSMainWindow(qt.QMainWindow):
         qt.QMessageBox.about(self, "RixsTool", txt)
 
 
+class BatchExportThread(qt.QThread):
+
+    __doc__ = """Thread turning images into spectra using a
+    :py:class:`RixsTool.Batch.BatchProcessor`. Images are read and sent to
+    the worker processes while the pool is working. Spectra found in the
+    result cache are emitted first, without reading the images, the others
+    in the order of the item list.
+
+     .. py:attribute:: resultSignal
+
+        Emits the index of the item, the spectrum and its scale
+
+     .. py:attribute:: errorSignal
+
+        Emits the error message if the processing failed"""
+
+    resultSignal = qt.pyqtSignal(object, object, object)
+    errorSignal = qt.pyqtSignal(object)
+
+    def __init__(self, itemList, chain, oversamp=1, parent=None, cache=None,
+                 shared=None):
+        """
+        :param list itemList: ImageItems to process
+        :param list chain: Processing steps, c.f.
+            :py:func:`RixsTool.Batch.processChain`
+        :param int oversamp: Oversampling of the alignment
+        :param ResultCache cache: Cache of the spectra, default: None
+        :param SharedArrayManager shared: Owner of the shared memory blocks
+            transporting the images, default: None
+        """
+        super(BatchExportThread, self).__init__(parent)
+        self.itemList = itemList
+        self.chain = chain
+        self.oversamp = oversamp
+        self.cache = cache
+        self.processor = BatchProcessor(exportSpectrum, shared=shared)
+
+    def key(self, item):
+        """
+        :returns: Cache key of the spectrum of an item, None without cache
+        """
+        if self.cache is None:
+            return None
+        source = ResultCache.sourceDigest(item)
+        if source is None:
+            source = item.array
+        return exportKey(self.chain, self.oversamp, source)
+
+    def jobs(self, pending):
+        for idx, key in pending:
+            yield idx, self.itemList[idx].array, self.chain, self.oversamp, \
+                self.cache, key
+
+    def cancel(self):
+        self.processor.cancel()
+
+    def run(self):
+        try:
+            pending = []
+            for idx, item in enumerate(self.itemList):
+                if self.processor.cancelled():
+                    return
+                key = self.key(item)
+                spectrum = None if key is None else self.cache.get(key)
+                if spectrum is None:
+                    pending.append((idx, key))
+                else:
+                    self.resultSignal.emit(idx, spectrum,
+                        spectrumScale(len(spectrum), self.oversamp))
+            if pending:
+                for result in self.processor.imap(self.jobs(pending),
+                        len(pending)):
+                    self.resultSignal.emit(*result)
+            if self.cache is not None:
+                # Account the files written by the worker processes
+                self.cache.refresh()
+                self.cache.enforce()
+        except Exception as error:
+            self.errorSignal.emit('BatchExportThread.run -- %s' % error)
+
+
 class RixsSaveSpectraDialog(qt.QFileDialog):
+    #
+    # Name filters and the extension appended to file names without one
+    #
+    NAME_FILTERS = [
+        ('SPEC file (*.dat *.spec)', '.dat'),
+        ('NumPy archive (*.npz)', '.npz'),
+        ('HDF5 file (*.h5 *.hdf5)', '.h5')
+    ]
+
     def __init__(self, parent, caption, directory):
         qt.QFileDialog.__init__(self, parent, caption, directory, '')
+        self.setNameFilters([nameFilter for nameFilter, ext in
+            self.NAME_FILTERS])
 
         saveOptsGB = qt.QGroupBox('Save options', self)
         saveOptsBG = qt.QButtonGroup()
@@ -523,7 +631,13 @@ class RixsSaveSpectraDialog(qt.QFileDialog):
         fileNameList = []
         if dial.exec_():
             singleFile = dial.singleFile.isChecked()
-            fileNameList = [qt.safe_str(fn) for fn in dial.selectedFiles()]
+            defaultExt = dict(dial.NAME_FILTERS).get(
+                qt.safe_str(dial.selectedNameFilter()), '')
+            for fn in dial.selectedFiles():
+                fn = qt.safe_str(fn)
+                if not OsPathSplitExt(fn)[1]:
+                    fn += defaultExt
+                fileNameList.append(fn)
         return fileNameList, singleFile, comment
 
 
@@ -41,40 +41,137 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
     __doc__ = """
     Tree model with :class:`datahandling.RixsProject` as underlying data
     structure. Implementation of the interface of :class:`QAbstractItemModel`.
+
+    Children of a container are exposed to views in pages of
+    :py:attr:`FETCH_SIZE` rows (c.f. :func:`canFetchMore`, :func:`fetchMore`),
+    views request further pages while scrolling.
+
+     .. py:attribute:: FETCH_SIZE
+
+        Number of rows exposed per page
     """
 
+    FETCH_SIZE = 256
+
     def __init__(self, parent=None):
         """
         :param parent: Parent widget
         :type parent: QAbstractItemView
         """
+        #
+        # Number of rows exposed to views per container
+        #
+        self._fetched = {}
         RixsProject.__init__(self)
         qt.QAbstractItemModel.__init__(self, parent)
 
+    def _fetchedRows(self, container):
+        """
+        :param ItemContainer container: Container in the project tree
+        :returns: Number of children exposed to views. On the first call the
+            first page is exposed.
+        :rtype: int
+        """
+        if container not in self._fetched:
+            self._fetched[container] = min(container.childCount(),
+                self.FETCH_SIZE)
+        return self._fetched[container]
+
+    def canFetchMore(self, parentIndex):
+        """
+        :param parentIndex: Model index of a container in the model
+        :type parentIndex: QModelIndex
+        :returns: True if the container has children not yet exposed
+        :rtype: bool
+        """
+        container = self.containerAt(parentIndex)
+        return self._fetchedRows(container) < container.childCount()
+
+    def fetchMore(self, parentIndex):
+        """
+        Exposes the next page of children of the container at parentIndex.
+
+        :param parentIndex: Model index of a container in the model
+        :type parentIndex: QModelIndex
+        """
+        container = self.containerAt(parentIndex)
+        first = self._fetchedRows(container)
+        count = min(container.childCount() - first, self.FETCH_SIZE)
+        if count <= 0:
+            return
+        self.beginInsertRows(parentIndex, first, first + count - 1)
+        self._fetched[container] = first + count
+        self.endInsertRows()
+
+    def _containerIndex(self, container):
+        """
+        :param ItemContainer container: Container in the project tree
+        :returns: Model index of the container, invalid for the root
+        :rtype: QModelIndex
+        """
+        if container is self.projectRoot:
+            return qt.QModelIndex()
+        return self.createIndex(container.childNumber(), 0, container)
+
+    def _insertChildren(self, node, containerList):
+        if node not in self._fetched or \
+                self._fetched[node] < node.childCount():
+            # New rows are behind the exposed rows, no view is notified
+            RixsProject._insertChildren(self, node, containerList)
+            return
+        first = node.childCount()
+        count = min(len(containerList), self.FETCH_SIZE)
+        self.beginInsertRows(self._containerIndex(node), first,
+            first + count - 1)
+        RixsProject._insertChildren(self, node, containerList)
+        self._fetched[node] = first + count
+        self.endInsertRows()
+
+    def _removeChildren(self, node, rowList):
+        for row in rowList:
+            for container in self._traverseDFS(node.children[row]):
+                self._fetched.pop(container, None)
+        fetched = self._fetched.get(node, 0)
+        first, last = min(rowList), max(rowList)
+        if first >= fetched:
+            # Only rows that have not been exposed yet are removed
+            RixsProject._removeChildren(self, node, rowList)
+        elif last - first + 1 == len(rowList):
+            # Contiguous block of rows
+            last = min(last, fetched - 1)
+            self.beginRemoveRows(self._containerIndex(node), first, last)
+            RixsProject._removeChildren(self, node, rowList)
+            self._fetched[node] = fetched - (last - first + 1)
+            self.endRemoveRows()
+        else:
+            self.beginResetModel()
+            RixsProject._removeChildren(self, node, rowList)
+            self._fetched.clear()
+            self.endResetModel()
+
     def removeContainer(self, modelIndex):
         if not modelIndex.isValid():
             print('Index is invalid')
             return
-        container = self.containerAt(modelIndex)
-        parentIndex = self.parent(modelIndex)
-
-        self.beginRemoveRows(parentIndex, container.childNumber(),
-                container.childNumber())
-
-        # if container.childCount():
-        #    print('Has children')
-        #    # Child count is nonzero
-        #    for child in container.children:
-        #        del(child)
+        self.removeContainerList([modelIndex])
 
-        # parentContainer = self.containerAt(parentIndex)
-        # idx = container.childNumber()
-        # del(parentContainer.children[idx])
+    def removeContainerList(self, modelIndexList):
+        """
+        Removes the containers at the given model indexes. The view is
+        notified once per parent container.
 
-        RixsProject.removeContainer(self, container.label)
-        self.endRemoveRows()
+        :param list modelIndexList: List of QModelIndex
+        """
+        labelList = []
+        for modelIndex in modelIndexList:
+            if not modelIndex.isValid():
+                continue
+            label = self.containerAt(modelIndex).label
+            if label not in labelList:
+                labelList.append(label)
+        RixsProject.removeContainers(self, labelList)
 
-    def addItem(self, item):
+    def addItem(self, item, node=None):
         """
         :param item:
         :type item:
@@ -82,19 +179,13 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
         if DEBUG >= 1:
             print('### ProjectModel.addItem -- called ###')
         try:
-            container = RixsProject.addItem(self, item)
+            RixsProject.addItem(self, item, node)
         except ValueError as error:
             # Catch ValueError from base class method RixsProject.addItem
             # caused by unknown item type (must be ScanItem, ImageItem, ...)
             if DEBUG >= 1:
                 print(error)
             return False
-
-        modelIndex = self.createIndex(container.childNumber(), 0, container)
-        parentIndex = self.parent(modelIndex)
-        self.beginInsertRows(parentIndex, container.childNumber(),
-            container.childNumber())
-        self.endInsertRows()
         return True
 
     def addGroup(self, label, node=None):
@@ -122,6 +213,22 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
         # self.endInsertRows()
         return True
 
+    def loadHDF5(self, fileName):
+        """
+        Restores a project stored in a HDF5 file. The view is reset once the
+        whole tree has been read.
+
+        :param str fileName: Name of the HDF5 file
+        """
+        self.beginResetModel()
+        # Nothing is exposed during the reset, rows are inserted without
+        # notifying the views (c.f. _insertChildren)
+        self._fetched.clear()
+        try:
+            RixsProject.loadHDF5(self, fileName)
+        finally:
+            self.endResetModel()
+
     def containerAt(self, modelIndex):
         """
         :param modelIndex: Model index of a container in the model
@@ -197,7 +304,8 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
 
     def rowCount(self, parentIndex=qt.QModelIndex(), *args, **kwargs):
         """
-        Number of children under the given model index
+        Number of children under the given model index that are exposed to
+        views (c.f. :func:`fetchMore`)
 
         :param modelIndex: Model index of a container in the model
         :type modelIndex: QModelIndex
@@ -206,7 +314,7 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
         :rtype: int
         """
         parent = self.containerAt(parentIndex)
-        return parent.childCount()
+        return self._fetchedRows(parent)
 
     def columnCount(self, parentIndex=qt.QModelIndex(), *args, **kwargs):
         """
@@ -277,7 +385,7 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
         # print('ProjectView.parent -- type(child):', type(child), hasattr(child, 'parent'))
         parentContainer = child.parent
 
-        if parentContainer == self.projectRoot:
+        if parentContainer is self.projectRoot:
             return qt.QModelIndex()
 
         return self.createIndex(parentContainer.childNumber(), 0,
@@ -291,9 +399,8 @@ class ProjectModel(RixsProject, qt.QAbstractItemModel):
         for info in fileInfoList:
             absFilePath = OsPathNormpath(str(info.canonicalFilePath()))
             # self.read(absFilePath)
-            itemList += RixsProject.read(self, absFilePath)
-        for item in itemList:
-            self.addItem(item)
+            itemList += RixsProject.read(self, absFilePath, deduplicate=True)
+        self.addItems(itemList, skipDuplicates=True)
 
 
 class QDirListModel(qt.QAbstractListModel):
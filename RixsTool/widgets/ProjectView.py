@@ -143,9 +143,8 @@ class ProjectView(qt.QTreeView):
         if isinstance(action, RemoveAction):
             if DEBUG >= 1:
                 print("\tRemoving item(s)")
-            for idx in modelIndexList:
-                model.removeContainer(idx)
-                self._emitRemoveSignal(containerList)
+            model.removeContainerList(modelIndexList)
+            self._emitRemoveSignal(containerList)
         elif isinstance(action, ShowAction):
             self._emitShowSignal(containerList)
         elif isinstance(action, RenameAction):
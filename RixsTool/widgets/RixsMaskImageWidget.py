@@ -44,10 +44,185 @@ from PyMca5.PyMca import MaskImageWidget
 # TODO: platform is import for dev purposes, remove me
 #
 import platform
+import threading
+
+from RixsTool.Operations import Manipulation
 
 DEBUG = 0
 PLATFORM = platform.system()
 
+
+class ToolChainWorker(qt.QThread):
+
+    __doc__ = """Thread processing the image of an item by a chain of tool
+    windows. Only the latest job is kept: submitting a job replaces a pending
+    one and marks a running one as stale. Stale jobs are aborted before their
+    next stage and their results are not emitted.
+
+    The output of every stage is cached. A stage is only recalculated if its
+    input, its tool, the tools state or the tools parameters changed, c.f.
+    :py:func:`processStage`.
+
+    Jobs with a decimation factor larger than one process a preview, i.e. a
+    block averaged copy of the image (c.f.
+    :py:func:`RixsTool.Operations.Manipulation.blockMean`). The copy is
+    computed once per item and factor. Previews and full resolution images
+    use separate stage caches.
+
+     .. py:attribute:: resultSignal
+
+        Emits the generation of the job, the processed image and the
+        decimation factor
+
+     .. py:attribute:: errorSignal
+
+        Emits the generation of the job, the error message and the
+        decimation factor if the processing failed"""
+
+    resultSignal = qt.pyqtSignal(object, object, object)
+    errorSignal = qt.pyqtSignal(object, object, object)
+
+    def __init__(self, parent=None):
+        super(ToolChainWorker, self).__init__(parent)
+        self._condition = threading.Condition()
+        self._job = None
+        self._generation = 0
+        self._stopped = False
+        self._item = None
+        self._previews = {}
+        self.stageCache = {}
+
+    def submit(self, item, stages, factor=1):
+        """
+        :param DataItem item: Item whose array is processed
+        :param list stages: Tuples of tool, active state and parameters
+        :param int factor: Decimation factor, 1 processes the full image
+        :returns: Generation of the job
+        :rtype: int
+        """
+        with self._condition:
+            self._generation += 1
+            self._job = (self._generation, item, stages, factor)
+            self._condition.notify()
+            return self._generation
+
+    def cancel(self):
+        """
+        Discards the pending job and marks the running one as stale.
+        """
+        with self._condition:
+            self._generation += 1
+            self._job = None
+
+    def isStale(self, generation):
+        """
+        :param int generation: Generation of a job
+        :returns: True if a newer job was submitted or the job was cancelled
+        :rtype: bool
+        """
+        with self._condition:
+            return generation != self._generation
+
+    def stop(self):
+        """
+        Cancels all jobs and waits for the thread to finish.
+        """
+        with self._condition:
+            self._stopped = True
+            self._generation += 1
+            self._job = None
+            self._condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._job is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                generation, item, stages, factor = self._job
+                self._job = None
+            if item is not self._item:
+                # Release the results of the previous item
+                self._item = item
+                self._previews = {}
+                self.stageCache = {}
+            cache = self.stageCache.get(factor)
+            if cache is None or len(cache) != len(stages):
+                cache = self.stageCache[factor] = len(stages) * [None]
+            try:
+                imageData = self.inputImage(item, factor)
+                for idx, stage in enumerate(stages):
+                    if self.isStale(generation):
+                        break
+                    imageData = self.processStage(cache, idx, item,
+                                                  imageData, *stage)
+                else:
+                    self.resultSignal.emit(generation, imageData, factor)
+            except Exception as error:
+                # Keep the thread alive for the next job
+                self.stageCache[factor] = len(stages) * [None]
+                self.errorSignal.emit(generation,
+                    'ToolChainWorker.run -- %s' % error, factor)
+
+    def inputImage(self, item, factor):
+        """
+        :param DataItem item: Item whose array is processed
+        :param int factor: Decimation factor
+        :returns: The item array or its decimated copy
+        :rtype: numpy.ndarray
+        """
+        if factor <= 1:
+            return item.array
+        if factor not in self._previews:
+            self._previews[factor] = Manipulation.blockMean(item.array,
+                                                            {'factor': factor})
+        return self._previews[factor]
+
+    def processStage(self, cache, idx, item, imageData, tool, active,
+                     parameters):
+        """
+        :param list cache: Stage cache of the decimation factor
+        :param int idx: Position of the stage in the chain
+        :param DataItem item: Item whose array is processed
+        :param numpy.ndarray imageData: Input of the stage, i.e. the output of
+            the previous stage
+        :param AbstractToolWindow tool: Tool processing the stage
+        :param bool active: Inactive tools pass their input on
+        :param dict parameters: Tool parameters
+        :returns: Output of the stage
+        :rtype: numpy.ndarray
+
+        The cached output is reused as long as the input is the same object
+        and the tool, its state and its parameters are unchanged. Since a
+        recalculated stage returns a new object, every following stage is
+        recalculated as well.
+        """
+        stageKey = (id(tool), active, sorted(parameters.items()))
+        cached = cache[idx]
+        if cached is not None and cached[0] is imageData and \
+                cached[1] == stageKey:
+            if DEBUG >= 1:
+                print('ToolChainWorker.processStage -- stage %d cached' % idx)
+            return cached[2]
+
+        result = imageData
+        if active:
+            parameters = dict(parameters)
+            if imageData is item.array:
+                #
+                # Unmodified image: pass the cached extrema, so tools do not
+                # need to scan the image again
+                #
+                stats = item.statistics()
+                parameters.setdefault('min', stats['min'])
+                parameters.setdefault('max', stats['max'])
+            result = tool.process(imageData, parameters)
+        cache[idx] = (imageData, stageKey, result)
+        return result
+
+
 class RixsMaskImageWidget(MaskImageWidget.MaskImageWidget):
 
     __doc__ = """Image visualization derived from :py:class:`MaskImageWidget`.
@@ -58,7 +233,29 @@ class RixsMaskImageWidget(MaskImageWidget.MaskImageWidget):
 
     **TODO:**
         * Get tool windows in left dock widget area to align in the top area of
-        the dock widget area evenly"""
+        the dock widget area evenly
+
+     .. py:attribute:: DEBOUNCE_INTERVAL
+
+        Milliseconds without parameter change before the image is processed
+
+     .. py:attribute:: PREVIEW_FACTOR
+
+        Decimation of the preview image in preview mode
+
+     .. py:attribute:: PREVIEW_INTERVAL
+
+        Milliseconds without parameter change before the preview is processed
+
+     .. py:attribute:: IDLE_INTERVAL
+
+        Milliseconds without parameter change before the preview is replaced
+        by the full resolution image"""
+
+    DEBOUNCE_INTERVAL = 150
+    PREVIEW_FACTOR = 4
+    PREVIEW_INTERVAL = 30
+    IDLE_INTERVAL = 500
 
     def __init__(self, parent=None):
         MaskImageWidget.MaskImageWidget.__init__(
@@ -95,6 +292,29 @@ class RixsMaskImageWidget(MaskImageWidget.MaskImageWidget):
         # ]
         self.toolList = 3 * [None]
 
+        # WORKER: The tools process the image in a separate thread. Parameter
+        # changes are collected by processingTimer before the calculation is
+        # started.
+        self.processingThread = ToolChainWorker(self)
+        self.processingThread.resultSignal.connect(self._handleResult)
+        self.processingThread.errorSignal.connect(self._handleError)
+        self.processingThread.start()
+        self.processingTimer = qt.QTimer(self)
+        self.processingTimer.setSingleShot(True)
+        self.processingTimer.setInterval(self.DEBOUNCE_INTERVAL)
+        self.processingTimer.timeout.connect(self.processImage)
+
+        # PREVIEW: While parameters change, a decimated image is processed.
+        # The full resolution follows once the parameters are idle.
+        self.previewMode = True
+        self.previewTimer = qt.QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(self.PREVIEW_INTERVAL)
+        self.previewTimer.timeout.connect(self.processPreview)
+        application = qt.QApplication.instance()
+        if application is not None:
+            application.aboutToQuit.connect(self.stopProcessing)
+
         # FLIPPING
         self.flipWidget = FlipWidget()
         self.flipWidget.valuesChangedSignal.connect(
@@ -186,46 +406,131 @@ class RixsMaskImageWidget(MaskImageWidget.MaskImageWidget):
 
         Function is triggered by
         :py:func:`RixsTool.widgets.ToolWindows.AbstractToolWindow.valuesChangedSignal`.
-        The dictionary parameter is not used and should be removed. The present
-        function requests the tool parameter using the
+        The dictionary parameter is not used and should be removed.
+
+        Changes are debounced: the calculation still running is cancelled and
+        a new one is started by :py:func:`processImage` once no further
+        change occured for :py:attr:`DEBOUNCE_INTERVAL` milliseconds.
+
+        In preview mode, :py:func:`processPreview` is started after
+        :py:attr:`PREVIEW_INTERVAL` milliseconds and the full resolution image
+        follows after :py:attr:`IDLE_INTERVAL` milliseconds.
+        """
+        if not self.currentImageItem:
+            return
+        self.processingThread.cancel()
+        if self.previewMode and \
+                min(self.currentImageItem.shape()) >= 2 * self.PREVIEW_FACTOR:
+            self.previewTimer.start()
+            self.processingTimer.setInterval(self.IDLE_INTERVAL)
+        else:
+            self.processingTimer.setInterval(self.DEBOUNCE_INTERVAL)
+        self.processingTimer.start()
+
+    def setPreviewMode(self, enabled):
+        """
+        :param bool enabled: Process a decimated image while the parameters
+            change, c.f. :py:func:`toolWindowValuesChanged`
+        """
+        self.previewMode = bool(enabled)
+        if not self.previewMode:
+            self.previewTimer.stop()
+
+    def processPreview(self):
+        """
+        Processes a copy of the current image decimated by
+        :py:attr:`PREVIEW_FACTOR`. Parameters given in pixels are adapted by
+        :py:func:`RixsTool.widgets.ToolWindows.AbstractToolWindow.previewValues`.
+        """
+        self.processImage(self.PREVIEW_FACTOR)
+
+    def processImage(self, factor=1):
+        """
+        :param int factor: Decimation factor, 1 processes the full image
+
+        Requests the tool parameters using the
         :py:func:`RixsTool.widgets.ToolWindows.AbstractToolWindow.getValues`
-        function and calls the generic
+        function and passes them to the :py:class:`ToolChainWorker`. The
+        worker calls the generic
         :py:func:`RixsTool.widgets.ToolWindows.AbstractToolWindow.process`
-        function to obtain the result.
+        function of every tool.
 
         To allow the image processing, the process function must be implemented
         in subclasses of
         :py:func:`RixsTool.widgets.ToolWindows.AbstractToolWindow.process` and
         has to feature a two parameter interface. The first parameter is the
         current image itself, the second is a dictionary of parameter values.
+        Since it runs in the worker thread, it must not access the GUI.
 
-        Calculated results are displayed using the :py:func:`addImage` function.
+        The result is displayed by :py:func:`_handleResult`.
         """
-
-        #
-        # AVOID RECALCULATION: If change occured in tool at position idx,
-        # perform recalculation for self.toolList[idx:] ...
-        #
         if not self.currentImageItem:
             return
-        key = self.currentImageItem.key()
-        imageData = self.currentImageItem.array
-
+        stages = []
         for tool in self.toolList:
-            if not tool.active():
-                continue
-            parameters = tool.getValues()
-            imageData = tool.process(imageData, parameters)
+            active = bool(tool.active())
+            parameters = tool.getValues() if active else {}
+            if active and factor > 1:
+                parameters = tool.previewValues(parameters, factor)
+            stages.append((tool, active, parameters))
+        generation = self.processingThread.submit(self.currentImageItem,
+                                                  stages, factor)
         if DEBUG >= 1:
-            print("RixsMaskImageWidget.toolWindowValuesChanged -- key: '%s'" %
-                key)
+            print("RixsMaskImageWidget.processImage -- key: '%s', "
+                  "generation: %d, factor: %d" %
+                  (self.currentImageItem.key(), generation, factor))
+
+    @staticmethod
+    def _decimatedScale(scale, factor):
+        """
+        :param tuple scale: Origin and step width of an image axis or None
+        :param int factor: Decimation factor
+        :returns: Scale of the decimated axis
+        :rtype: tuple or None
+        """
+        if factor <= 1:
+            return scale
+        origin, delta = scale if scale is not None else (0., 1.)
+        return origin, delta * factor
+
+    def _handleResult(self, generation, imageData, factor):
+        """
+        Displays the result of the worker using the :py:func:`setImageData`
+        function, unless newer parameters were set in the meantime. Previews
+        are stretched to the extent of the full image.
+        """
+        if self.processingThread.isStale(generation):
+            if DEBUG >= 1:
+                print('RixsMaskImageWidget._handleResult -- stale result '
+                      'discarded, generation: %d' % generation)
+            return
         self.setImageData(
             data=imageData,
             clearmask=False,
-            xScale=self.currentImageItem.scaleX,
-            yScale=self.currentImageItem.scaleY
+            xScale=self._decimatedScale(self.currentImageItem.scaleX, factor),
+            yScale=self._decimatedScale(self.currentImageItem.scaleY, factor)
         )
 
+    def _handleError(self, generation, message, factor):
+        """
+        Reports a failed calculation, unless newer parameters were set in the
+        meantime. Failed previews are not reported, the full resolution image
+        processed with the same parameters fails as well.
+        """
+        if DEBUG >= 1:
+            print('RixsMaskImageWidget._handleError -- %s' % message)
+        if factor != 1 or self.processingThread.isStale(generation):
+            return
+        qt.QMessageBox.warning(self, 'Image processing', message)
+
+    def stopProcessing(self):
+        """
+        Cancels pending calculations and ends the worker thread.
+        """
+        self.previewTimer.stop()
+        self.processingTimer.stop()
+        self.processingThread.stop()
+
     def hflip(self, **kw):
         __doc__ = """Flips the current image. This function is triggered by the
             re-directed horizontal flip button of the graphics window. It
@@ -277,6 +582,9 @@ class RixsMaskImageWidget(MaskImageWidget.MaskImageWidget):
 
     def setImageItem(self, projectItem):
         self.currentImageItem = projectItem
+        self.previewTimer.stop()
+        self.processingTimer.stop()
+        self.processingThread.cancel()
         imageData = self.currentImageItem.array
 
         self.setImageData(
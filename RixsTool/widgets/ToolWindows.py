@@ -33,11 +33,11 @@ from PyMca5.PyMca import PyMcaQt as qt
 from PyQt4 import uic
 
 from ..UiPaths import UiPaths
-from ..Operations import Filter, SlopeCorrection, Integration
 from ..Items import FunctionItem
+from ..Steps import FlipStep, BandPassStep, BandPassID32Step, AlignmentStep, \
+    SumStep
 
 import platform
-import numpy
 
 DEBUG = 0
 PLATFORM = platform.system()
@@ -83,18 +83,36 @@ class AbstractToolWindow(qt.QDockWidget):
     #
     valuesChangedSignal = qt.pyqtSignal(object)
 
-    def __init__(self, uiPath=None, parent=None):
+    def __init__(self, uiPath=None, parent=None, step=None):
+        """
+        :param str uiPath: Path to the ui-file
+        :param ProcessingStep step: Step whose parameters the tool edits, c.f.
+            :py:mod:`RixsTool.Steps`. Tools without step must set process.
+        """
         super(AbstractToolWindow, self).__init__(parent)
         self._values = {}
         self.__active = None  # True or False
         self.__uiLoaded = False
         self.__uiPath = uiPath
-        self.process = None
+        self.step = step
+        self.process = step.process if step is not None else None
 
     def emitValuesChangedSignal(self, **kw):
-        ddict = self.getValues()
+        ddict = self.updateStep()
         self.valuesChangedSignal.emit(ddict)
 
+    def updateStep(self):
+        """
+        Copies the values of the GUI elements to the parameters of the step.
+
+        :returns: Current values, c.f. :py:func:`getValues`
+        :rtype: dict
+        """
+        ddict = self.getValues()
+        if self.step is not None:
+            self.step.setParameters(ddict)
+        return ddict
+
     def setWindowTitle(self, title):
         titleBar = self.titleBarWidget()
         if isinstance(titleBar, AbstractToolTitleBar):
@@ -139,7 +157,7 @@ class AbstractToolWindow(qt.QDockWidget):
             titleBar.titleLabel.setEnabled(True)
             self.__active = True
         # self.toolStateChangedSignal.emit(state, self)
-        parameters = self.getValues()
+        parameters = self.updateStep()
         self.valuesChangedSignal.emit(parameters)
 
     def getValues(self):
@@ -168,6 +186,28 @@ class AbstractToolWindow(qt.QDockWidget):
             ddict[key] = val
         return ddict
 
+    def batchStep(self):
+        """
+        :returns: Copy of the step with the current parameters. It does not
+            depend on the GUI, c.f. :py:mod:`RixsTool.Batch`
+        :rtype: ProcessingStep
+        """
+        self.updateStep()
+        return self.step.copy()
+
+    def previewValues(self, ddict, factor):
+        """
+        :param dict ddict: Parameters as returned by :py:func:`getValues`
+        :param int factor: Decimation of the preview image, c.f.
+            :py:func:`RixsTool.Operations.Manipulation.blockMean`
+        :returns: Parameters to process the decimated image with, c.f.
+            :py:func:`RixsTool.Steps.ProcessingStep.previewParameters`
+        :rtype: dict
+        """
+        if self.step is None:
+            return ddict
+        return self.step.previewParameters(ddict, factor)
+
     def setValues(self, ddict):
         for key, val in ddict.items():
             obj = self._values[key]
@@ -200,7 +240,8 @@ class FlipWidget(AbstractToolWindow):
 
     def __init__(self, parent=None):
         uiPath = UiPaths.flipWidgetUiPath()
-        super(FlipWidget, self).__init__(uiPath=uiPath, parent=parent)
+        super(FlipWidget, self).__init__(uiPath=uiPath, parent=parent,
+            step=FlipStep())
         self.setUI()
         self.setWindowTitle('Flip Image')
 
@@ -208,40 +249,27 @@ class FlipWidget(AbstractToolWindow):
             'flipped': self.flipRadioButton
         }
 
-        self.setValues({
-            'flipped': False
-        })
+        self.setValues(self.step.parameters())
 
         #
         # Connect the Flip Image radio button
         #
+        self.flipRadioButton.toggled.connect(self.setFlipLabel)
         self.flipRadioButton.toggled.connect(self.emitValuesChangedSignal)
 
-        #
-        # Process
-        #
-        self.process = self.flipImage
-
-    def flipImage(self, image, params):
-        flipped = params.get('flipped', False)
-        if flipped:
-            if DEBUG >= 1:
-                print('FlipWidget.process --  numpy.flipud called')
-            self.flipLabel.setText('Flipped')
-            self.flipLabel.show()
-            return numpy.flipud(image)
-        else:
-            if DEBUG >= 1:
-                print('FlipWidget.process --  numpy.flipud not called')
-            self.flipLabel.setText('Normal')
-            self.flipLabel.show()
-            return image
+    def setFlipLabel(self, flipped):
+        """
+        :param bool flipped: Shows the flip state of the image
+        """
+        self.flipLabel.setText('Flipped' if flipped else 'Normal')
+        self.flipLabel.show()
 
 
 class BandPassFilterWindow(AbstractToolWindow):
     def __init__(self, parent=None):
         uiPath = UiPaths.bandPassFilterUiPath()
-        super(BandPassFilterWindow, self).__init__(uiPath=uiPath, parent=parent)
+        super(BandPassFilterWindow, self).__init__(uiPath=uiPath, parent=parent,
+            step=BandPassStep())
         self.setUI()
         self.setWindowTitle('Band Pass Filter')
 
@@ -252,12 +280,7 @@ class BandPassFilterWindow(AbstractToolWindow):
             'replace': self.replaceSpinBox
         }
 
-        self.setValues({
-            'high': 800.,
-            'low': 8.,
-            'offset': 114.,
-            'replace': 0.
-        })
+        self.setValues(self.step.parameters())
 
         #
         # Connect the Bandpass Filter spin boxes
@@ -269,16 +292,12 @@ class BandPassFilterWindow(AbstractToolWindow):
         self.offsetSpinBox.valueChanged.connect(self.emitValuesChangedSignal)
         self.replaceSpinBox.valueChanged.connect(self.emitValuesChangedSignal)
 
-        #
-        # Process
-        #
-        self.process = Filter.bandPassFilter
-
 
 class BandPassID32Window(AbstractToolWindow):
     def __init__(self, parent=None):
         uiPath = UiPaths.bandPassFilterID32UiPath()
-        super(BandPassID32Window, self).__init__(uiPath=uiPath, parent=parent)
+        super(BandPassID32Window, self).__init__(uiPath=uiPath, parent=parent,
+            step=BandPassID32Step())
         self.setUI()
         self.setWindowTitle('Band Pass Filter ID32')
 
@@ -330,11 +349,6 @@ class BandPassID32Window(AbstractToolWindow):
         self.exposureEdit.returnPressed.connect(self.emitValuesChangedSignal)
         self.dcEdit.returnPressed.connect(self.emitValuesChangedSignal)
 
-        #
-        # Process
-        #
-        self.process = Filter.bandPassFilterID32
-
     def getValues(self):
         ddict = AbstractToolWindow.getValues(self)
         for key, value in ddict.items():
@@ -345,7 +359,8 @@ class BandPassID32Window(AbstractToolWindow):
 class ImageAlignmentWindow(AbstractToolWindow):
     def __init__(self, parent=None):
         uiPath = UiPaths.alignmentFilterUiPath()
-        super(ImageAlignmentWindow, self).__init__(uiPath=uiPath, parent=parent)
+        super(ImageAlignmentWindow, self).__init__(uiPath=uiPath, parent=parent,
+            step=AlignmentStep())
         self.setUI()
         self.setWindowTitle('Image Alignment')
 
@@ -356,12 +371,7 @@ class ImageAlignmentWindow(AbstractToolWindow):
             'oversamp': self.oversampSpinBox
         }
 
-        self.setValues({
-            'a': -5.25,
-            'b': 0.18877,
-            'c': 0.,
-            'oversamp': 2
-        })
+        self.setValues(self.step.parameters())
 
         #
         # Connect the Image Alignment spin boxes
@@ -371,30 +381,6 @@ class ImageAlignmentWindow(AbstractToolWindow):
         self.cSpinBox.valueChanged.connect(self.emitValuesChangedSignal)
         self.oversampSpinBox.valueChanged.connect(self.emitValuesChangedSignal)
 
-        #
-        # Process
-        #
-        self.process = self.alignImage  # Expects smile function
-
-    def alignImage(self, image, params):
-        func = FunctionItem('Slope Function', '')
-        expression = lambda x, a, b, c: a * x ** 2 + b * x + c
-        params = self.getValues()
-
-        # Account for the "E-5" suffix of the "Smile" parameter
-        params['a'] *= 10.** -5
-
-        func.setExpression(expression)
-        # func.setParameters(params)
-        func.setParameters({
-            'a': params['a'],
-            'b': params['b'],
-            'c': params['c'],
-        })
-        oversamp = params['oversamp']
-
-        return SlopeCorrection.alignImage(image, func, oversamp)
-
 
 class SumImageTool(AbstractToolWindow):
     __doc__ = """GUI to transform image to spectrum by summation along
@@ -405,7 +391,8 @@ class SumImageTool(AbstractToolWindow):
 
     def __init__(self, parent=None):
         uiPath = UiPaths.sumToolUiPath()
-        super(SumImageTool, self).__init__(uiPath=uiPath, parent=parent)
+        super(SumImageTool, self).__init__(uiPath=uiPath, parent=parent,
+            step=SumStep())
         self.setUI()
         self.setWindowTitle('Integration')
 
@@ -418,9 +405,7 @@ class SumImageTool(AbstractToolWindow):
             'rows'
         ])
 
-        self.setValues({
-            'axis': 'columns'
-        })
+        self.setValues(self.step.parameters())
 
         #
         # Connect the Sum Image buttons
@@ -428,22 +413,6 @@ class SumImageTool(AbstractToolWindow):
         self.currentButton.clicked.connect(self.exportCurrentSignal.emit)
         self.selectedButton.clicked.connect(self.exportSelectedSignal.emit)
 
-        #
-        # Process
-        #
-        self.process = self.sumImage
-
-    def sumImage(self, image, param=None):
-        params = self.getValues()
-        if str(params['axis']) == 'columns':
-            axis = 1
-        else:
-            axis = 0
-
-        if DEBUG >= 1:
-            print('SumImageTool.sumImage -- called')
-        return Integration.axisSum(image, {'axis': axis})
-
 
 class EnergyScaleTool(AbstractToolWindow):
     __doc__ = """GUI to set an energy scale to the project"""
@@ -44,5 +44,5 @@ distribution = setup(
     platforms='any',
     packages=['RixsTool', 'RixsTool.widgets'],
     package_data={'RixsTool': ['ui/*.ui', 'icons/*.ico']},
-    scripts=["scripts/rixstool"]
+    scripts=["scripts/rixstool", "scripts/rixstool-batch"]
 )